@@ -7,9 +7,11 @@ from circuitscape.compute import Compute
 
 if len(sys.argv) == 1:
     print 'Error: Circuitscape configuration (.ini) file required.'
+    print 'Usage: csrun.py <configuration file> [--resume]'
 else:
     configFile = sys.argv[1]
     cs = Compute(configFile, 'Screen')
-    resistances = cs.compute()
+    resume = '--resume' in sys.argv[2:] # continue an interrupted run from its checkpoint
+    resistances = cs.compute(resume)
     print resistances
 
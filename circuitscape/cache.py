@@ -0,0 +1,93 @@
+import os, hashlib, pickle, tempfile
+import numpy as np
+from scipy import sparse
+from pyamg.multilevel import multilevel_solver
+from pyamg.relaxation.smoothing import change_smoothers
+
+class CSCache:
+    """Content addressed on-disk cache of habitat graphs, Laplacians and AMG hierarchies.
+
+    Entries are keyed by a hash of everything they are computed from, so a rerun on the same
+    landscape with the same connection and solver options finds them, while any change to the
+    inputs gives new keys. Entries are never evicted; the cache directory can be deleted at any time.
+    """
+    logger = None
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        if not os.path.isdir(cache_dir):
+            try:
+                os.makedirs(cache_dir)
+            except:
+                raise RuntimeError('Cannot create cache directory: ' + cache_dir + '.')
+
+    @staticmethod
+    def key(*parts):
+        """Returns a hash of parts, which may be arrays, sparse matrices or values with a stable repr."""
+        h = hashlib.sha1()
+        for part in parts:
+            if sparse.issparse(part):
+                part = part.tocsr()
+                h.update('csr' + repr(part.shape))
+                for arr in [part.data, part.indices, part.indptr]:
+                    h.update(str(arr.dtype))
+                    h.update(np.ascontiguousarray(arr).data)
+            elif isinstance(part, np.ndarray):
+                h.update('ndarray' + str(part.dtype) + repr(part.shape))
+                h.update(np.ascontiguousarray(part).data)
+            elif isinstance(part, dict):
+                h.update(repr(sorted(part.items())))
+            else:
+                h.update(repr(part))
+            h.update('|')
+        return h.hexdigest()
+
+    def _path(self, kind, key):
+        return os.path.join(self.cache_dir, kind + '_' + key + '.pkl')
+
+    def load(self, kind, key):
+        """Returns the cached entry, or None if there is none."""
+        path = self._path(kind, key)
+        if not os.path.isfile(path):
+            return None
+        try:
+            with open(path, 'rb') as f:
+                value = pickle.load(f)
+        except:
+            CSCache.logger.warning('Ignoring unreadable cache entry ' + path)
+            return None
+        CSCache.logger.debug('Loaded ' + kind + ' from cache')
+        return value
+
+    def store(self, kind, key, value):
+        """Writes an entry. Concurrent runs writing the same entry are safe, as the file is renamed into place."""
+        (fd, tmp_path) = tempfile.mkstemp(dir=self.cache_dir, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                pickle.dump(value, f, pickle.HIGHEST_PROTOCOL)
+            os.rename(tmp_path, self._path(kind, key))
+        except:
+            CSCache.logger.warning('Could not write ' + kind + ' to cache')
+            try:
+                os.remove(tmp_path)
+            except:
+                pass
+
+    def load_amg_hierarchy(self, key, amg_options):
+        """Returns the cached AMG hierarchy, with smoothers and coarse solver set up from amg_options."""
+        levels_data = self.load('amg', key)
+        if levels_data is None:
+            return None
+        levels = []
+        for level_data in levels_data:
+            level = multilevel_solver.level()
+            level.__dict__.update(level_data)
+            levels.append(level)
+        ml = multilevel_solver(levels, coarse_solver=amg_options.get('coarse_solver', 'pinv2'))
+        change_smoothers(ml, amg_options.get('presmoother', ('block_gauss_seidel', {'sweep': 'symmetric'})), amg_options.get('postsmoother', ('block_gauss_seidel', {'sweep': 'symmetric'})))
+        return ml
+
+    def store_amg_hierarchy(self, key, ml):
+        # smoothers are closures and cannot be pickled; they are rebuilt on load
+        levels_data = [dict([(name, val) for (name, val) in level.__dict__.items() if name not in ['presmoother', 'postsmoother']]) for level in ml.levels]
+        self.store('amg', key, levels_data)
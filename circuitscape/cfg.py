@@ -3,7 +3,7 @@ import ConfigParser, os, copy, ast, codecs
 class CSConfig:
     """Represents a Circuitscape configuration object"""
     
-    FILE_PATH_PROPS = ['polygon_file', 'source_file', 'ground_file', 'mask_file', 'output_file', 'habitat_file', 'point_file', 'reclass_file']
+    FILE_PATH_PROPS = ['polygon_file', 'source_file', 'ground_file', 'scenario_file', 'mask_file', 'output_file', 'habitat_file', 'point_file', 'reclass_file']
     
     DEFAULTS = {
         'Version': {
@@ -23,7 +23,8 @@ class CSConfig:
             'ground_file_is_resistances': True, 
             'use_unit_currents': False, 
             'use_direct_grounds': False,
-            'remove_src_or_gnd': 'keepall' 
+            'remove_src_or_gnd': 'keepall',
+            'scenario_file': 'None'        # list of source and ground file pairs (or a directory of <name>_source and <name>_ground files) to solve as a batch against the same habitat, instead of source_file and ground_file
         }, 
         'Mask file': {
             'mask_file': 'None', 
@@ -36,11 +37,32 @@ class CSConfig:
             'max_parallel': 0,            # passing 0 results in using all available cpus
             'print_timings': False, 
             'print_rusages': False, 
-            'solver': 'cg+amg'
+            'solver': 'cg+amg',                # one of 'cg+amg', 'amg' or 'cholesky' (direct sparse factorization, reused across solves where possible)
+            'reuse_amg_hierarchy': False,  # ground each component at a fixed node and build one AMG hierarchy for all its focal pairs in pairwise mode
+            'solver_batch_size': 1,        # number of focal pairs sharing an anchor node to solve together as one multi-rhs solve in pairwise mode
+            'warm_start_history': 0,       # number of earlier solutions combined into the initial guess of iterative solves in pairwise mode. 0 disables warm starts
+            'solver_tol': 1e-6,            # convergence tolerance of iterative solvers, relative to the norm of the right hand side
+            'solver_maxiter': 100000,      # maximum number of iterations of iterative solvers
+            'solver_residual_check': 1e-3, # solves that leave a larger residual norm are treated as failed
+            'amg_strength': 'symmetric',   # strength of connection measure for AMG, e.g. 'symmetric', 'classical', 'evolution' or a (name, parameters) tuple as taken by pyamg
+            'amg_aggregate': 'standard',   # aggregation method for AMG, e.g. 'standard', 'lloyd' or 'naive'
+            'amg_smoother': 'block_gauss_seidel', # pre and post smoother for AMG, e.g. 'block_gauss_seidel', 'gauss_seidel', 'jacobi' or 'richardson'
+            'amg_max_levels': 10,          # maximum number of levels in the AMG hierarchy
+            'amg_coarse_solver': 'pinv2',  # solver on the coarsest AMG level, e.g. 'pinv2', 'splu', 'lu' or 'cholesky'. Only 'pinv' and 'pinv2' handle graphs with ungrounded components
+            'amg_cycle': 'V',              # multigrid cycle, one of 'V', 'W' or 'F'
+            'amg_autotune': False,         # time a few AMG presets on the first system solved and use the fastest for the rest of the run
+            'pairwise_resistance_method': 'shortcut', # 'shortcut', 'pinv' or 'approximate'. With 'pinv', resistances are computed from one solve per focal node (batched by solver_batch_size) when no maps are written. 'approximate' uses random projections instead
+            'approximate_resistance_eps': 0.1, # relative error bound of resistances with the 'approximate' pairwise resistance method
+            'cache_dir': 'None',           # directory of an on-disk cache of habitat graphs, Laplacians and AMG hierarchies, reused by later runs on the same landscape
+            'distributed_dir': 'None',     # directory shared by the processes of a distributed pairwise run, which split the focal pairs between them. Holds the cache unless cache_dir is set
+            'distributed_role': 'coordinator', # 'coordinator' (solves pairs, then merges and writes all results) or 'worker' (only solves pairs) in a distributed run
+            'distributed_timeout': 600,    # seconds after which pairs claimed by a process that stopped responding are solved by other processes
+            'checkpoint_interval': 'None'  # seconds between checkpoints of pairwise and one-to-all runs, saved to <output base>_checkpoint.pkl. Shorter intervals than a minute are raised to one
         }, 
         'Options for one-to-all and all-to-one modes': {
             'use_variable_source_strengths': False, 
-            'variable_source_file': 'None'
+            'variable_source_file': 'None',
+            'join_source_with_last_polygon': False  # with included pairs and polygons, short the source together with the highest numbered polygon, as releases up to 4.0.5 did. Only to reproduce results of those releases
         }, 
         'Output options': {
             'set_null_currents_to_nodata': False, 
@@ -52,7 +74,8 @@ class CSConfig:
             'set_null_voltages_to_nodata': False, 
             'set_focal_node_currents_to_zero': False, 
             'write_volt_maps': False, 
-            'write_cur_maps': False
+            'write_cur_maps': False,
+            'write_solver_report': False   # write iterations, residual and timings of each solve to <output base>_solver_report.csv
         }, 
         'Habitat raster or graph': {
             'habitat_map_is_resistances': True,
@@ -177,7 +200,7 @@ class CSConfig:
         if self.options['scenario'] not in ['pairwise', 'one-to-all']:
             del checks['point_file']
 
-        if self.options['scenario'] != 'advanced':
+        if (self.options['scenario'] != 'advanced') or (self.options['scenario_file'] not in [None, 'None', '']):
             for key in ['source_file', 'ground_file']:#, 'ground_file_is_resistances']:
                 del checks[key]
 
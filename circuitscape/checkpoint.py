@@ -0,0 +1,83 @@
+import os, time, pickle, tempfile
+
+class Checkpoint:
+    """Progress of a long pairwise or one-to-all run, saved periodically so that an interrupted run can be resumed.
+
+    The run is split into tasks (focal nodes, focal pairs or components) whose results are merged
+    into a resistance matrix and cumulative and maximum current maps as they complete. A checkpoint
+    holds the tasks done with the partial resistances and maps they produced, and in partial any
+    other state of tasks in progress. It is identified by a key of the run inputs and settings, so
+    that it is only resumed by the same run.
+    """
+    logger = None
+    MIN_INTERVAL = 60           # seconds. Each save pickles the whole current maps, which should not take longer than the solves between saves
+    DEFAULT_INTERVAL = 600      # seconds between saves of a resumed run with no interval set
+
+    def __init__(self, filename, interval, resume):
+        self.filename = filename
+        if interval is None:
+            interval = Checkpoint.DEFAULT_INTERVAL if resume else None
+        elif interval < Checkpoint.MIN_INTERVAL:
+            Checkpoint.logger.info('Saving checkpoints every ' + str(Checkpoint.MIN_INTERVAL) + ' seconds, the shortest interval')
+            interval = Checkpoint.MIN_INTERVAL
+        self.interval = interval        # seconds between saves, or None to never save
+        self.resume = resume
+        self.key = None
+        self.done = set()
+        self.partial = {}
+        self.last_save_time = time.time()
+
+    def start(self, key, resistances, out):
+        """Starts the run identified by key.
+
+        When resuming a saved run of key, restores resistances and the current maps of out. Returns the tasks already done.
+        """
+        self.key = key
+        self.done = set()
+        self.partial = {}
+        self.last_save_time = time.time()
+        if not (self.resume and os.path.isfile(self.filename)):
+            return self.done
+
+        with open(self.filename, 'rb') as f:
+            saved = pickle.load(f)
+        if saved['key'] != key:
+            Checkpoint.logger.warning('Ignoring checkpoint ' + self.filename + ', which was saved by a run with different inputs or options')
+            return self.done
+
+        resistances[...] = saved['resistances']
+        with out.lock:
+            out.current_maps.update(saved['current_maps'])
+        self.done = set(saved['done'])
+        self.partial = saved.get('partial', {})
+        Checkpoint.logger.info('Resuming from checkpoint with ' + str(len(self.done)) + ' tasks done')
+        return self.done
+
+    def task_done(self, task, resistances, out):
+        """Records that the results of task are in resistances and out, saving a checkpoint if one is due."""
+        self.done.add(task)
+        if (self.interval is not None) and ((time.time() - self.last_save_time) >= self.interval):
+            self.save(resistances, out)
+
+    def save(self, resistances, out):
+        """Writes the checkpoint. A checkpoint that cannot be written is skipped with a warning, and the run goes on."""
+        # written to a temporary file first, so that a run stopped while saving leaves the last checkpoint intact
+        tmp_path = None
+        try:
+            (fd, tmp_path) = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(self.filename)), suffix='.tmp')
+            with os.fdopen(fd, 'wb') as f:
+                with out.lock:
+                    pickle.dump({'key': self.key, 'done': self.done, 'partial': self.partial, 'resistances': resistances, 'current_maps': out.current_maps}, f, pickle.HIGHEST_PROTOCOL)
+            os.rename(tmp_path, self.filename)
+        except (IOError, OSError, pickle.PicklingError):
+            Checkpoint.logger.warning('Could not write checkpoint ' + self.filename)
+            if (tmp_path is not None) and os.path.isfile(tmp_path):
+                os.remove(tmp_path)
+            return
+        self.last_save_time = time.time()
+        Checkpoint.logger.debug('Saved checkpoint with ' + str(len(self.done)) + ' tasks done')
+
+    def remove(self):
+        """Removes the checkpoint of a completed run."""
+        if os.path.isfile(self.filename):
+            os.remove(self.filename)
@@ -3,22 +3,46 @@ __author__ = 'Brad McRae, Viral B. Shah, and Tanmay Mohapatra'
 __email__ = 'mcrae@circuitscape.org'
 
 
-import time, logging
+import os, time, multiprocessing
 import numpy as np
 from scipy import sparse
 
-from compute_base import ComputeBase, FocalPoints, IncludeExcludePairs, HabitatGraph, Output
-from profiler import print_rusage, gc_after, LowMemRetry
+from compute_base import ComputeBase, FocalPoints, IncludeExcludePairs, HabitatGraph, Output, SolutionHistory
+from profiler import print_rusage, gc_after, LowMemRetry, SolverStats
 from io import CSIO
+from cache import CSCache
+from distributed import DistributedRun
+from checkpoint import Checkpoint
 
 class Compute(ComputeBase):
     def __init__(self, configFile, ext_log_handler):
         super(Compute, self).__init__(configFile, ext_log_handler)
 
     @print_rusage
-    def compute(self):
-        """Main function for Circuitscape."""  
+    def compute(self, resume=False):
+        """Main function for Circuitscape.
+        
+        With resume, an interrupted run continues from its checkpoint, skipping the focal nodes and pairs already solved.
+        """  
         self.state.start_time = time.time()
+        ComputeBase.solver_tol = self.options.solver_tol
+        ComputeBase.solver_maxiter = self.options.solver_maxiter
+        ComputeBase.solver_residual_check = self.options.solver_residual_check
+        SolverStats.init_stats(self.options.write_solver_report)
+        self.set_amg_options()
+        self.state.cache = CSCache(self.options.cache_dir) if (self.options.cache_dir not in [None, 'None', '']) else None
+        self.state.distributed = None
+        if self.options.distributed_dir not in [None, 'None', '']:
+            if (self.options.data_type != 'raster') or (self.options.scenario != 'pairwise'):
+                raise RuntimeError('Distributed runs are only supported in pairwise mode with raster data.')
+            self.state.distributed = DistributedRun(self.options.distributed_dir, self.options.distributed_role, self.options.distributed_timeout)
+            if self.state.cache is None: # processes share graphs and hierarchies through the run directory
+                self.state.cache = CSCache(os.path.join(self.options.distributed_dir, 'cache'))
+        self.state.checkpoint = None
+        checkpoint_interval = self.options.checkpoint_interval if (self.options.checkpoint_interval not in [None, 'None', '']) else None
+        if ((checkpoint_interval is not None) or resume) and (self.state.distributed is None): # results of distributed runs persist anyway
+            (out_base, _out_extn) = os.path.splitext(self.options.output_file)
+            self.state.checkpoint = Checkpoint(out_base + '_checkpoint.pkl', checkpoint_interval, resume)
 
         #Test write privileges by writing config file to output directory
         self.options.write(self.options.output_file, True)
@@ -26,9 +50,14 @@ class Compute(ComputeBase):
         if self.options.data_type=='network':
             result, solver_failed = self.compute_network() # Call module for solving arbitrary graphs (not raster grids)
             self.log_complete_job()
-            return result, solver_failed #Fixme: add in solver failed check
+        else:
+            result, solver_failed = self.compute_raster()
 
-        return self.compute_raster()
+        if self.options.write_solver_report:
+            CSIO.write_solver_report(self.options.output_file, SolverStats.FIELDS, SolverStats.records)
+        if self.state.checkpoint is not None: # all results are written
+            self.state.checkpoint.remove()
+        return result, solver_failed #Fixme: add in solver failed check
 
 
     @print_rusage
@@ -44,10 +73,13 @@ class Compute(ComputeBase):
             focal_nodes = self.read_focal_nodes(self.options.point_file)
             fp = FocalPoints(focal_nodes, self.state.included_pairs, True)            
         elif self.options.scenario == 'advanced':
-            self.state.source_map = CSIO.read_point_strengths(self.options.source_file)
-            self.state.ground_map = CSIO.read_point_strengths(self.options.ground_file)        
+            if self.options.scenario_file not in [None, 'None', '']:
+                self.state.scenarios = CSIO.read_scenario_list(self.options.scenario_file)
+            else:
+                self.state.source_map = CSIO.read_point_strengths(self.options.source_file)
+                self.state.ground_map = CSIO.read_point_strengths(self.options.ground_file)        
         
-        g_habitat = HabitatGraph(g_graph=g_graph, node_names=node_names)
+        g_habitat = HabitatGraph(g_graph=g_graph, node_names=node_names, cache=self.state.cache)
         out = Output(self.options, self.state, False, node_names)
         if self.options.write_cur_maps:
             out.alloc_c_map('')
@@ -62,15 +94,19 @@ class Compute(ComputeBase):
             result1 = resistances_3col # Differs from raster mode, where resistance matrix is returned.
         elif self.options.scenario == 'advanced':
             self.options.write_max_cur_maps = False
-            voltages, current_map, solver_failed = self.advanced_module(g_habitat, out, self.state.source_map, self.state.ground_map)
-            if self.options.write_cur_maps:
-                full_branch_currents, full_node_currents, _bca, _np = current_map
-            result1 = voltages
+            if self.state.scenarios is not None:
+                # maps of each scenario are written as they are solved
+                (result1, solver_failed) = self.advanced_batch_module(g_habitat, out, self.state.scenarios)
+            else:
+                voltages, current_map, solver_failed = self.advanced_module(g_habitat, out, self.state.source_map, self.state.ground_map)
+                if self.options.write_cur_maps:
+                    full_branch_currents, full_node_currents, _bca, _np = current_map
+                result1 = voltages
             
         if solver_failed == True:
             Compute.logger.error('Solver failed')
             
-        elif self.options.write_cur_maps: # Fixme? No currents if solver failed
+        elif self.options.write_cur_maps and (self.state.scenarios is None): # Fixme? No currents if solver failed
             full_branch_currents = Output._convert_graph_to_3_col(full_branch_currents, node_names)
             full_node_currents = Output._append_names_to_node_currents(full_node_currents, node_names)
 
@@ -156,10 +192,13 @@ class Compute(ComputeBase):
         elif self.options.scenario == 'advanced':
             self.options.write_max_cur_maps = False
             Compute.logger.info('Calling solver module.')
-            g_habitat = HabitatGraph(g_map=self.state.g_map, poly_map=self.state.poly_map, connect_using_avg_resistances=self.options.connect_using_avg_resistances, connect_four_neighbors_only=self.options.connect_four_neighbors_only)
+            g_habitat = HabitatGraph(g_map=self.state.g_map, poly_map=self.state.poly_map, connect_using_avg_resistances=self.options.connect_using_avg_resistances, connect_four_neighbors_only=self.options.connect_four_neighbors_only, cache=self.state.cache)
             out = Output(self.options, self.state, False)
             Compute.logger.info('Graph has ' + str(g_habitat.num_nodes) + ' nodes and '+ str(g_habitat.num_components)+ ' components.')
-            voltages, _current_map, solver_failed = self.advanced_module(g_habitat, out, self.state.source_map, self.state.ground_map)
+            if self.state.scenarios is not None:
+                (voltages, solver_failed) = self.advanced_batch_module(g_habitat, out, self.state.scenarios)
+            else:
+                voltages, _current_map, solver_failed = self.advanced_module(g_habitat, out, self.state.source_map, self.state.ground_map)
             self.log_complete_job()
             if solver_failed == True:
                 Compute.logger.error('Solver failed')
@@ -172,19 +211,67 @@ class Compute(ComputeBase):
             
     
     @staticmethod
-    def get_overlap_polymap(point, point_map, poly_map, new_poly_num): 
-        """Creates a map of polygons (aka short-circuit or zero resistance regions) overlapping a focal node."""
-        point_poly = np.where(point_map == point, 1, 0) 
-        poly_point_overlap = np.multiply(point_poly, poly_map)
-        overlap_vals = np.unique(np.asarray(poly_point_overlap))
-        rows = np.where(overlap_vals > 0)
-        overlap_vals = overlap_vals[rows] #LIST OF EXISTING POLYGONS THAT OVERLAP WITH POINT
-        for a in range(0, overlap_vals.size):
-            poly_map = np.where(poly_map==overlap_vals[a], new_poly_num, poly_map)
-        poly_map = np.where(point_map == point, new_poly_num, poly_map)
+    def get_overlap_polymap_for_points(points, point_map, poly_map, new_poly_nums):
+        """Creates a map of polygons (aka short-circuit or zero resistance regions) overlapping focal nodes.
+        
+        Each focal node and the polygons overlapping it become polygon new_poly_nums[i], as if points
+        were burned into the polygon map in turn. Polygons that
+        overlap several focal nodes join them, under the number of the last. The merges are found with
+        a union-find over polygon numbers, and the map is then relabeled in a single pass.
+        """
+        points = np.asarray(points).ravel()
+        point_map = np.asarray(point_map)
+        poly_map = np.asarray(poly_map)
+        
+        # polygons overlapping each focal node, by index in the sorted unique focal nodes
+        point_cells = np.flatnonzero(np.in1d(point_map, points))
+        cell_points = point_map.flat[point_cells]
+        cell_polys = poly_map.flat[point_cells]
+        overlap = (cell_polys > 0)
+        unique_points = np.unique(points)
+        (polynums, poly_idxs) = np.unique(cell_polys[overlap], return_inverse=True)
+        num_polys = max(polynums.size, 1)
+        pairs = np.unique(np.searchsorted(unique_points, cell_points[overlap]).astype('int64') * num_polys + poly_idxs)
+        overlap_polys = [[] for _point in unique_points]
+        for (point_idx, poly_idx) in zip(pairs // num_polys, pairs % num_polys):
+            overlap_polys[point_idx].append(int(polynums[poly_idx]))
+        
+        parent = {}
+        def find(polynum):
+            root = polynum
+            while parent.get(root, root) != root:
+                root = parent[root]
+            while polynum != root:
+                (parent[polynum], polynum) = (root, parent[polynum])
+            return root
+        
+        point_polys = {}    # last polygon each focal node was burned into
+        for (point, new_poly_num) in zip(points.tolist(), np.asarray(new_poly_nums).ravel().tolist()):
+            merged = overlap_polys[np.searchsorted(unique_points, point)]
+            if point in point_polys:
+                merged = merged + [point_polys[point]]
+            for polynum in merged:
+                root = find(polynum)
+                if (root > 0) and (root != new_poly_num):
+                    parent[root] = new_poly_num
+            point_polys[point] = new_poly_num
+        
+        polynums = parent.keys()
+        poly_map = ComputeBase.replace_values(poly_map, polynums, [find(polynum) for polynum in polynums])
+        burned = point_polys.keys()
+        poly_map.flat[point_cells] = ComputeBase.replace_values(cell_points, burned, [find(point_polys[point]) for point in burned])
         return poly_map
 
 
+    @staticmethod
+    def get_focal_regions(point_map, point_ids):
+        """Returns the flat indices of the cells of each of point_ids in point_map."""
+        cells = np.flatnonzero(point_map)
+        cells = cells[np.argsort(point_map.flat[cells], kind='mergesort')]
+        starts = np.searchsorted(point_map.flat[cells], point_ids, 'left')
+        ends = np.searchsorted(point_map.flat[cells], point_ids, 'right')
+        return [cells[starts[pt_idx]:ends[pt_idx]] for pt_idx in range(0, point_ids.size)]
+
     def append_names_to_resistances(self, point_ids, resistances):        
         """Adds names of focal nodes to resistance matrices."""  
         resistances = np.insert(resistances, 0, point_ids, axis = 0)
@@ -208,10 +295,8 @@ class Compute(ComputeBase):
         fp = FocalPoints(fp.get_unique_coordinates(), self.state.included_pairs, False)
         point_ids = fp.point_ids
         points_rc_unique = fp.points_rc
-        included_pairs = self.state.included_pairs
             
         resistance_vector = np.zeros((point_ids.size,2), float)
-        solver_failed_somewhere = False
         
         if self.options.use_included_pairs==False: #Will do this each time later if using included pairs
             point_map = np.zeros((self.state.nrows, self.state.ncols), int)
@@ -224,82 +309,59 @@ class Compute(ComputeBase):
 
             (strength_map, strengths_rc) = self.get_strength_map(points_rc_unique, self.state.point_strengths)            
 
-            g_habitat = HabitatGraph(g_map=g_map, poly_map=poly_map_temp, connect_using_avg_resistances=self.options.connect_using_avg_resistances, connect_four_neighbors_only=self.options.connect_four_neighbors_only)
+            g_habitat = HabitatGraph(g_map=g_map, poly_map=poly_map_temp, connect_using_avg_resistances=self.options.connect_using_avg_resistances, connect_four_neighbors_only=self.options.connect_four_neighbors_only, cache=self.state.cache)
             Compute.logger.info('Graph has ' + str(g_habitat.num_nodes) + ' nodes and '+ str(g_habitat.num_components) + ' components.')
             component_with_points = g_habitat.unique_component_with_points(unique_point_map)
+            regions = None
         else:
-            if Compute.logger.isEnabledFor(logging.DEBUG):
-                g_habitat = HabitatGraph(g_map=g_map, poly_map=poly_map, connect_using_avg_resistances=self.options.connect_using_avg_resistances, connect_four_neighbors_only=self.options.connect_four_neighbors_only)
-                Compute.logger.info('Graph has ' + str(g_habitat.num_nodes) + ' nodes and '+ str(g_habitat.num_components) + ' components.')
+            # The graph is built once, and the focal nodes included with each source are contracted into it
+            point_map = np.zeros((self.state.nrows, self.state.ncols), int)
+            point_map[points_rc[:,1], points_rc[:,2]] = points_rc[:,0]
+            regions = Compute.get_focal_regions(point_map, point_ids)
+            if poly_map == []: # focal nodes in no included pair are left in the point map, which is then the polygon map
+                g_habitat_poly_map = np.where(np.in1d(point_map, point_ids).reshape(point_map.shape), 0, point_map)
+            else:
+                g_habitat_poly_map = poly_map
+            g_habitat = HabitatGraph(g_map=g_map, poly_map=g_habitat_poly_map, connect_using_avg_resistances=self.options.connect_using_avg_resistances, connect_four_neighbors_only=self.options.connect_four_neighbors_only, cache=self.state.cache)
+            Compute.logger.info('Graph has ' + str(g_habitat.num_nodes) + ' nodes and '+ str(g_habitat.num_components) + ' components.')
+            g_habitat.get_laplacian() # built here when the graph is taken from the cache, rather than for each focal node
+            unique_point_map = strength_map = strengths_rc = None # created for each focal node
             component_with_points = None
 
+        parallelize = self.options.parallelize and (self.options.low_memory_mode == False)
+        Compute.logger.debug('parallel: possible=' + str(point_ids.size) + ', enforced=' + str(self.options.max_parallel) + ', enabled=' + str(parallelize))
+        if parallelize:
+            self._autotune_amg_before_jobs(g_habitat)
+            self.state.worker_pool_create(self.options.max_parallel, False)
+        
+        checkpoint = self.state.checkpoint
+        done = set()
+        solver_failed_somewhere = [False]
+        if checkpoint is not None:
+            done = checkpoint.start(self._checkpoint_key(g_map, (poly_map if (poly_map != []) else None), points_rc, self.state.point_strengths), resistance_vector, out)
+            solver_failed_somewhere[0] = bool((resistance_vector[:,1] == -777).any())
+        
         for pt_idx in range(0, point_ids.size): # These are the 'src' nodes, pt_idx.e. the 'one' in all-to-one and one-to-all
+            if pt_idx in done:
+                continue
 
             Compute.logger.info('Solving focal node ' + str(pt_idx+1) + ' of ' + str(point_ids.size))
-
-            if self.options.use_included_pairs==True: # Done above otherwise    
-                #######################   
-                points_rc_unique_temp = np.copy(points_rc_unique)
-                point_map = np.zeros((self.state.nrows, self.state.ncols), int)
-                point_map[points_rc[:,1], points_rc[:,2]] = points_rc[:,0]       
-
-                #loop thru exclude[point,:], delete included pairs of focal point from point_map and points_rc_unique_temp
-                for pair in range(0, point_ids.size):
-                    if (pt_idx !=  pair) and not self.state.included_pairs.is_included_pair(point_ids[pt_idx], point_ids[pair]):
-                        pt_id = point_ids[pair]
-                        point_map = np.where(point_map==pt_id, 0, point_map)
-                        points_rc_unique_temp[pair, 0] = 0 #point will not be burned in to unique_point_map
-
-                poly_map_temp = self.get_poly_map_temp2(poly_map, point_map, points_rc_unique_temp, included_pairs, pt_idx)
-                g_habitat = HabitatGraph(g_map=g_map, poly_map=poly_map_temp, connect_using_avg_resistances=self.options.connect_using_avg_resistances, connect_four_neighbors_only=self.options.connect_four_neighbors_only)
-
-                unique_point_map = np.zeros((self.state.nrows, self.state.ncols),int)
-                unique_point_map[points_rc_unique_temp[:,1], points_rc_unique_temp[:,2]] = points_rc_unique_temp[:,0]
-                
-                (strength_map, strengths_rc) = self.get_strength_map(points_rc_unique_temp, self.state.point_strengths)
-                ###########################################
-                
-            src = point_ids[pt_idx]
-            if unique_point_map.sum() == src: # src is the only point
-                resistance_vector[pt_idx,0] = src
-                resistance_vector[pt_idx,1] = -1            
-            else: # there are points to connect with src point
-                if self.options.scenario == 'one-to-all':
-                    strength = strengths_rc[pt_idx,0] if self.options.use_variable_source_strengths else 1
-                    source_map = np.where(unique_point_map == src, strength, 0)
-                    ground_map =  np.where(unique_point_map == src, 0, unique_point_map)
-                    ground_map =  np.where(ground_map, np.Inf, 0) 
-                    self.options.remove_src_or_gnd = 'rmvgnd'
-                else: # all-to-one
-                    if self.options.use_variable_source_strengths==True:
-                        source_map = np.where(unique_point_map == src, 0, strength_map)
-                    else:
-                        source_map = np.where(unique_point_map, 1, 0)
-                        source_map = np.where(unique_point_map == src, 0, source_map)
-                    ground_map =  np.where(unique_point_map == src, np.Inf, 0)                    
-                    self.options.remove_src_or_gnd = 'rmvsrc'
-                #FIXME: right now one-to-all *might* fail if there is just one node that is not grounded (I haven't encountered this problem lately BHM Nov 2009).
-                
-                resistance, current_map, solver_failed = self.advanced_module(g_habitat, out, source_map, ground_map, src, component_with_points)
-                if not solver_failed:
-                    if self.options.write_cur_maps:
-                        out.accumulate_c_map_with_values('', current_map)
-                        if self.options.write_max_cur_maps:    
-                            out.store_max_c_map_values('max', current_map)
-                else:
-                    Compute.logger.warning('Solver failed for at least one focal node. Focal nodes with failed solves will be marked with value of -777 in output resistance list.')
-    
-                resistance_vector[pt_idx,0] = src
-                if solver_failed==True:
-                    solver_failed_somewhere = True
-                    resistance_vector[pt_idx,1] = -777
-                else:
-                    resistance_vector[pt_idx,1] = resistance
+            
+            post_solve = self._post_one_to_all_solve(out, resistance_vector, point_ids[pt_idx], pt_idx, solver_failed_somewhere)
+            if checkpoint is not None:
+                post_solve = self._post_checkpoint_task(post_solve, pt_idx, resistance_vector, out)
+            if parallelize:
+                self.state.worker_pool_submit(Compute._one_to_all_solve_job, post_solve, self, poly_map, fp, g_habitat, regions, unique_point_map, strength_map, strengths_rc, component_with_points, pt_idx)
+            else:
+                post_solve(self._one_to_all_solve(poly_map, fp, g_habitat, regions, unique_point_map, strength_map, strengths_rc, component_with_points, out, pt_idx))
 
             (hours,mins,_secs) = ComputeBase.elapsed_time(last_write_time)
             if mins > 2 or hours > 0: 
                 last_write_time = time.time()
                 CSIO.write_resistances(self.options.output_file, resistance_vector, incomplete=True)
+        
+        self.state.worker_pool_wait()
+        solver_failed_somewhere = solver_failed_somewhere[0]
       
         if not solver_failed_somewhere:
             if self.options.write_cur_maps:
@@ -311,6 +373,86 @@ class Compute(ComputeBase):
        
         return resistance_vector, solver_failed_somewhere 
 
+    def _one_to_all_solve(self, poly_map, fp, g_habitat, regions, unique_point_map, strength_map, strengths_rc, component_with_points, out, pt_idx):
+        """Solves for focal node pt_idx in one-to-all and all-to-one modes.
+        
+        Returns the results of advanced_module, with a resistance of -1 if there are no other focal nodes to connect with.
+        """
+        point_ids = fp.point_ids
+        points_rc_unique = fp.points_rc
+        
+        if self.options.use_included_pairs==True: # Done by the caller otherwise    
+            #######################   
+            # focal nodes not included with the source are left as habitat, and out of the source and ground maps
+            points_rc_unique_temp = np.copy(points_rc_unique)
+            is_included = self.state.included_pairs.get_included_pairs_of(point_ids[pt_idx], point_ids)
+            is_included[pt_idx] = True
+            included = np.flatnonzero(is_included)
+            excluded = np.flatnonzero(~is_included)
+            points_rc_unique_temp[excluded, 0] = 0 #point will not be burned in to unique_point_map
+            src_region = regions[pt_idx]
+            if self.options.join_source_with_last_polygon and (poly_map != []) and (np.max(poly_map) > 0):
+                # releases up to 4.0.5 burned the source into the polygon map under the number of the last polygon
+                src_region = np.union1d(src_region, np.flatnonzero(poly_map == np.max(poly_map)))
+            g_habitat = g_habitat.contract_regions([src_region] + [regions[pair] for pair in included if pair != pt_idx])
+
+            unique_point_map = np.zeros((self.state.nrows, self.state.ncols),int)
+            unique_point_map[points_rc_unique_temp[:,1], points_rc_unique_temp[:,2]] = points_rc_unique_temp[:,0]
+            
+            (strength_map, strengths_rc) = self.get_strength_map(points_rc_unique_temp, self.state.point_strengths)
+            ###########################################
+            
+        src = point_ids[pt_idx]
+        if unique_point_map.sum() == src: # src is the only point
+            return (-1, None, False)
+        
+        if self.options.scenario == 'one-to-all':
+            strength = strengths_rc[pt_idx,0] if self.options.use_variable_source_strengths else 1
+            source_map = np.where(unique_point_map == src, strength, 0)
+            ground_map =  np.where(unique_point_map == src, 0, unique_point_map)
+            ground_map =  np.where(ground_map, np.Inf, 0) 
+            self.options.remove_src_or_gnd = 'rmvgnd'
+        else: # all-to-one
+            if self.options.use_variable_source_strengths==True:
+                source_map = np.where(unique_point_map == src, 0, strength_map)
+            else:
+                source_map = np.where(unique_point_map, 1, 0)
+                source_map = np.where(unique_point_map == src, 0, source_map)
+            ground_map =  np.where(unique_point_map == src, np.Inf, 0)                    
+            self.options.remove_src_or_gnd = 'rmvsrc'
+        #FIXME: right now one-to-all *might* fail if there is just one node that is not grounded (I haven't encountered this problem lately BHM Nov 2009).
+        
+        return self.advanced_module(g_habitat, out, source_map, ground_map, src, component_with_points)
+
+    @staticmethod
+    def _one_to_all_solve_job(compute, poly_map, fp, g_habitat, regions, unique_point_map, strength_map, strengths_rc, component_with_points, pt_idx):
+        # Runs in a forked process. Maps for the focal node are written here, and the cumulative
+        # maps are accumulated by the parent from the returned current map.
+        compute.state.worker_pool = None
+        compute.options.parallelize = False
+        out = Output(compute.options, compute.state, False)
+        return compute._one_to_all_solve(poly_map, fp, g_habitat, regions, unique_point_map, strength_map, strengths_rc, component_with_points, out, pt_idx)
+
+    def _post_one_to_all_solve(self, out, resistance_vector, src, pt_idx, solver_failed_somewhere):
+        def _post_callback(result):
+            resistance_vector[pt_idx,0] = src
+            if result is None: # parallel job failed
+                (resistance, current_map, solver_failed) = (-777, None, True)
+            else:
+                (resistance, current_map, solver_failed) = result
+            
+            if not solver_failed:
+                if self.options.write_cur_maps and (current_map is not None):
+                    out.accumulate_c_map_with_values('', current_map)
+                    if self.options.write_max_cur_maps:    
+                        out.store_max_c_map_values('max', current_map)
+                resistance_vector[pt_idx,1] = resistance
+            else:
+                Compute.logger.warning('Solver failed for at least one focal node. Focal nodes with failed solves will be marked with value of -777 in output resistance list.')
+                solver_failed_somewhere[0] = True
+                resistance_vector[pt_idx,1] = -777
+        return _post_callback
+
     def get_poly_map_temp(self, poly_map, point_map, point_ids):
         """Returns polygon map for each solve given source and destination nodes.  
         Used in all-to-one and one-to-all modes only.
@@ -318,33 +460,12 @@ class Compute(ComputeBase):
         if poly_map == []:
             poly_map_temp = point_map
         else:
-            poly_map_temp = poly_map
-            new_poly_num = np.max(poly_map)
-            for pt_idx in range(0, point_ids.shape[0]):
-                new_poly_num = new_poly_num+1
-                poly_map_temp = self.get_overlap_polymap(point_ids[pt_idx], point_map, poly_map_temp, new_poly_num) 
+            new_poly_nums = np.max(poly_map) + 1 + np.arange(point_ids.shape[0])
+            poly_map_temp = self.get_overlap_polymap_for_points(point_ids, point_map, poly_map, new_poly_nums)
                 
         return poly_map_temp
 
         
-    def get_poly_map_temp2(self, poly_map, point_map, points_rc, included_pairs, pt1_idx):
-        """Returns polygon map for each solve given source and destination nodes.  
-        Used in all-to-one and one-to-all modes when included/excluded pairs are used.
-        """  
-        if poly_map == []:
-            poly_map_temp = point_map
-        else:
-            poly_map_temp = poly_map
-            new_poly_num = np.max(poly_map)
-            #burn in src pt_idx to polygon map
-            poly_map_temp = self.get_overlap_polymap(points_rc[pt1_idx,0], point_map, poly_map_temp, new_poly_num)                     
-            for pt_idx in range(0, points_rc.shape[0]): #burn in dst points to polygon map
-                if included_pairs.is_included_pair(points_rc[pt1_idx,0], points_rc[pt_idx,0]):
-                    new_poly_num = new_poly_num+1
-                    poly_map_temp = self.get_overlap_polymap(points_rc[pt_idx,0], point_map, poly_map_temp, new_poly_num) 
-        return poly_map_temp
-
-
     @print_rusage
     def pairwise_module(self, g_map, poly_map, points_rc):
         """Overhead module for pairwise mode with raster data."""  
@@ -362,9 +483,12 @@ class Compute(ComputeBase):
         else:
             self.state.point_file_contains_polygons = False
 
+        if (self.state.distributed is not None) and self.state.point_file_contains_polygons:
+            raise RuntimeError('Distributed runs do not support focal regions.')
+
         if self.state.point_file_contains_polygons == False:
             fp = FocalPoints(points_rc, self.state.included_pairs, False)
-            g_habitat = HabitatGraph(g_map=g_map, poly_map=poly_map, connect_using_avg_resistances=self.options.connect_using_avg_resistances, connect_four_neighbors_only=self.options.connect_four_neighbors_only)
+            g_habitat = HabitatGraph(g_map=g_map, poly_map=poly_map, connect_using_avg_resistances=self.options.connect_using_avg_resistances, connect_four_neighbors_only=self.options.connect_four_neighbors_only, cache=self.state.cache)
             
             while LowMemRetry.retry():
                 with LowMemRetry():
@@ -376,6 +500,9 @@ class Compute(ComputeBase):
                 '\n~6 orders of magnitude. Pairs with failed solves will be '
                 '\nmarked with value of -777 in output resistance matrix.\n')
 
+            if (self.state.distributed is not None) and not self.state.distributed.is_coordinator():
+                return None, solver_failed # results are written by the coordinator
+
             point_ids = fp.point_ids
         else:
             point_map = np.zeros((self.state.nrows, self.state.ncols), int)
@@ -385,6 +512,12 @@ class Compute(ComputeBase):
             fp = FocalPoints(fp.get_unique_coordinates(), self.state.included_pairs, False)
             point_ids = fp.point_ids
             
+            # The graph is built once, and the regions of each pair are contracted into it
+            g_habitat = HabitatGraph(g_map=g_map, poly_map=poly_map, connect_using_avg_resistances=self.options.connect_using_avg_resistances, connect_four_neighbors_only=self.options.connect_four_neighbors_only, cache=self.state.cache)
+            Compute.logger.info('Graph has ' + str(g_habitat.num_nodes) + ' nodes and '+ str(g_habitat.num_components)+ ' components.')
+            g_habitat.get_laplacian() # built here when the graph is taken from the cache, rather than for each pair
+            regions = Compute.get_focal_regions(point_map, point_ids)
+            
             numpoints = point_ids.size
             resistances = -1 * np.ones((numpoints, numpoints), dtype='float64')
             
@@ -400,18 +533,32 @@ class Compute(ComputeBase):
             Compute.logger.debug('parallel: possible=' + str(num_points_to_solve) + ', enforced=' + str(self.options.max_parallel) + ', enabled=' + str(parallelize))
             
             if parallelize:
+                self._autotune_amg_before_jobs(g_habitat)
                 self.state.worker_pool_create(self.options.max_parallel, False)
             
+            checkpoint = self.state.checkpoint
+            done = set()
             solver_failed = [False]
+            if checkpoint is not None:
+                done = checkpoint.start(self._checkpoint_key(g_map, (poly_map if (poly_map != []) else None), points_rc), resistances, out)
+                solver_failed[0] = bool((resistances == -777).any())
+            
             for (pt1_idx, pt2_idx) in fp.point_pair_idxs():
                 if pt2_idx == -1:
                     continue    # we don't need to do anything special for row end condition
                 
                 num_points_solved += 1
+                if (pt1_idx, pt2_idx) in done:
+                    continue
                 msg = str(num_points_solved) + ' of ' + str(num_points_to_solve)
                 Compute.logger.info('Solving focal pair ' + msg)
-                post_solve = self._post_pairwise_polygon_solve(resistances, pt1_idx, pt2_idx, solver_failed, msg)                
-                self.state.worker_pool_submit(Compute._pairwise_polygon_solve, post_solve, self, g_map, fp, out, poly_map, point_ids, point_map, pt1_idx, pt2_idx)
+                post_solve = self._post_pairwise_polygon_solve(out, resistances, pt1_idx, pt2_idx, solver_failed, msg)                
+                if checkpoint is not None:
+                    post_solve = self._post_checkpoint_task(post_solve, (pt1_idx, pt2_idx), resistances, out)
+                if parallelize:
+                    self.state.worker_pool_submit(Compute._pairwise_polygon_solve_job, post_solve, self, g_habitat, fp, regions, pt1_idx, pt2_idx)
+                else:
+                    self.state.worker_pool_submit(Compute._pairwise_polygon_solve, post_solve, self, g_habitat, fp, regions, pt1_idx, pt2_idx, out)
 
             self.state.worker_pool_wait()
             solver_failed = solver_failed[0]
@@ -431,30 +578,59 @@ class Compute(ComputeBase):
 
 
     @staticmethod
-    def _pairwise_polygon_solve(compute, g_map, fp, out, poly_map, point_ids, point_map, pt1_idx, pt2_idx):
-        if poly_map == []:
-            poly_map_temp = np.zeros((compute.state.nrows, compute.state.ncols), int)
-            new_poly_num = 1
-        else:
-            poly_map_temp = poly_map
-            new_poly_num = np.max(poly_map) + 1
+    def _pairwise_polygon_solve(compute, g_habitat, fp, regions, pt1_idx, pt2_idx, out):
+        """Solves focal region pair pt1_idx, pt2_idx.
         
-        poly_map_temp = Compute.get_overlap_polymap(point_ids[pt1_idx], point_map, poly_map_temp, new_poly_num) 
-        poly_map_temp = Compute.get_overlap_polymap(point_ids[pt2_idx], point_map, poly_map_temp, new_poly_num+1) 
-    
+        Maps of the pair are written here, and its currents are added into the cumulative and maximum maps of out.
+        Returns the resistances of the pair, or None if its solve failed.
+        """
         # create a subset of points_rc by getting first instance of each point in points_rc
         fp_subset = fp.get_subset([pt1_idx, pt2_idx])
-        g_habitat = HabitatGraph(g_map=g_map, poly_map=poly_map_temp, connect_using_avg_resistances=compute.options.connect_using_avg_resistances, connect_four_neighbors_only=compute.options.connect_four_neighbors_only)
+        g_pair = g_habitat.contract_regions([regions[pt1_idx], regions[pt2_idx]])
         
-        (pairwise_resistance, solver_failed) = compute.single_ground_all_pair_resistances(g_habitat, fp_subset, out, False)
-
-        del poly_map_temp        
-        return None if solver_failed else pairwise_resistance
+        (pairwise_resistance, solver_failed) = compute.single_ground_all_pair_resistances(g_pair, fp_subset, out, False)
+        return None if solver_failed else (pairwise_resistance, None)
 
-    def _post_pairwise_polygon_solve(self, resistances, pt1_idx, pt2_idx, solver_failed, msg):
-        def _post_callback(pairwise_resistance):
-            if pairwise_resistance is not None:
+    @staticmethod
+    def _pairwise_polygon_solve_job(compute, g_habitat, fp, regions, pt1_idx, pt2_idx):
+        """Solves focal region pair pt1_idx, pt2_idx serially in a forked process.
+        
+        Returns the resistances of the pair with the cells of the component it was solved in, and
+        the cumulative and maximum currents at those cells, for the caller to merge into its maps.
+        """
+        compute.state.worker_pool = None
+        compute.options.parallelize = False
+        out = Output(compute.options, compute.state, False)
+        if compute.options.write_cur_maps:
+            out.alloc_c_map('')
+            if compute.options.write_max_cur_maps:
+                out.alloc_c_map('max')
+        
+        fp_subset = fp.get_subset([pt1_idx, pt2_idx])
+        g_pair = g_habitat.contract_regions([regions[pt1_idx], regions[pt2_idx]])
+        (pairwise_resistance, solver_failed) = compute.single_ground_all_pair_resistances(g_pair, fp_subset, out, False)
+        if solver_failed:
+            return None
+        
+        currents = None
+        if compute.options.write_cur_maps:
+            # only cells of the component of the pair carry currents
+            points_rc = fp_subset.get_coordinates()
+            components = np.unique(g_pair.component_map[points_rc[:,1], points_rc[:,2]])
+            cells = [np.ravel_multi_index(g_pair.component_cells(c), g_pair.component_map.shape) for c in components[components > 0]]
+            cells = np.concatenate(cells) if (len(cells) > 0) else np.zeros(0, dtype='int64')
+            max_map = out.get_c_map('max')
+            currents = (cells, out.get_c_map('').flat[cells], None if (max_map is None) else max_map.flat[cells])
+        return (pairwise_resistance, currents)
+
+    def _post_pairwise_polygon_solve(self, out, resistances, pt1_idx, pt2_idx, solver_failed, msg):
+        def _post_callback(result):
+            if result is not None:
+                (pairwise_resistance, currents) = result
                 resistances[pt2_idx, pt1_idx] = resistances[pt1_idx, pt2_idx] = pairwise_resistance[0,1]
+                if currents is not None:
+                    (cells, cell_currents, max_cell_currents) = currents
+                    out.accumulate_c_map_at_cells('', cells, cell_currents, 'max' if (max_cell_currents is not None) else None, max_cell_currents)
                 Compute.logger.info("Solved focal pair " + msg)
             else:
                 resistances[pt2_idx, pt1_idx] = resistances[pt1_idx, pt2_idx] = -777
@@ -472,9 +648,13 @@ class Compute(ComputeBase):
         last_write_time = time.time()
         numpoints = fp.num_points()
         parallelize = options.parallelize
+        
+        # Direct solves need a positive definite matrix, which per-anchor grounding does not give.
+        # Grounding once per component also lets one factorization serve all pairs in the component.
+        reuse_hierarchy = options.reuse_amg_hierarchy or (options.solver == 'cholesky')
 
-        # TODO: revisit to see if restriction can be removed 
-        if options.low_memory_mode==True or self.state.point_file_contains_polygons==True:
+        # Pairs of focal regions are solved in parallel by the caller, which sets options.parallelize for solves within them
+        if options.low_memory_mode==True:
             parallelize = False
         
         if (self.state.point_file_contains_polygons == True) or (options.write_cur_maps == True) or (options.write_volt_maps == True) or (options.use_included_pairs==True) or (options.data_type=='network'): #TODO: Can shortcut be used in network mode?
@@ -483,6 +663,9 @@ class Compute(ComputeBase):
             use_resistance_calc_shortcut = True # We use this when there are no focal regions.  It saves time when we are also not creating maps
             shortcut_resistances = -1 * np.ones((numpoints, numpoints), dtype='float64') 
            
+        if use_resistance_calc_shortcut and (options.pairwise_resistance_method in ['pinv', 'approximate']) and (self.state.distributed is None):
+            return self.batched_all_pair_resistances(g_habitat, fp, report_status)
+        
         solver_failed_somewhere = [False]
         
         Compute.logger.info('Graph has ' + str(g_habitat.num_nodes) + ' nodes, ' + str(numpoints) + ' focal nodes and '+ str(g_habitat.num_components)+ ' components.')
@@ -508,64 +691,161 @@ class Compute(ComputeBase):
         
         Compute.logger.debug('parallel: possible=' + str(max_parallel) + ', enforced=' + str(options.max_parallel) + ', enabled=' + str(parallelize))
         
-        num_points_solved = 0
-        for c in range(1, int(g_habitat.num_components+1)):
-            if not fp.exists_points_in_component(c, g_habitat):
-                continue
-                        
-            G_pruned, local_node_map = g_habitat.prune_nodes_for_component(c)
-            G = ComputeBase.laplacian(G_pruned)
-            del G_pruned 
+        components = [c for c in range(1, int(g_habitat.num_components+1)) if fp.exists_points_in_component(c, g_habitat)]
+        num_points_solved = [0]
+        
+        # Pairs of focal regions are solved one at a time without status reports, and checkpointed by the caller
+        checkpoint = self.state.checkpoint if report_status else None
+        if checkpoint is not None:
+            inputs = [g_habitat.g_graph] if g_habitat.is_network else [g_habitat.g_map, (g_habitat.poly_map if (g_habitat.poly_map != []) else None)]
+            target = shortcut_resistances if use_resistance_calc_shortcut else resistances
+            done = checkpoint.start(self._checkpoint_key(*(inputs + [fp.points_rc, use_resistance_calc_shortcut])), target, cs)
+            solver_failed_somewhere[0] = bool((target == -777).any())
+            components = [c for c in components if (c, None) not in done]
+        
+        if self.state.distributed is not None:
+            self._distributed_pairs(g_habitat, fp, cs, components, resistances, shortcut_resistances if use_resistance_calc_shortcut else None, numpoints, parallelize, reuse_hierarchy, use_resistance_calc_shortcut, solver_failed_somewhere)
+            components = []
+        
+        # Components with focal nodes are independent, so when there are several they are solved as
+        # parallel jobs, largest first to balance the load. Jobs pass back their part of the cumulative
+        # and maximum current maps, which are added into those of cs here.
+        if parallelize and (len(components) > 1):
+            component_sizes = np.bincount(np.asarray(g_habitat.components, dtype='int64').ravel())
+            components.sort(key=lambda c: -component_sizes[c])
+            Compute.logger.debug('parallel: solving ' + str(len(components)) + ' components as separate jobs')
             
-            if use_resistance_calc_shortcut:
-                voltmatrix = np.zeros((numpoints,numpoints), dtype='float64')     #For resistance calc shortcut
+            self._autotune_amg_before_jobs(g_habitat)
+            self.state.worker_pool_create(options.max_parallel)
+            for c in components:
+                post_component = self._post_single_ground_component(g_habitat, fp, c, resistances, shortcut_resistances if use_resistance_calc_shortcut else None, solver_failed_somewhere, report_status, cs)
+                if checkpoint is not None:
+                    post_component = self._post_checkpoint_task(post_component, (c, None), target, cs)
+                self.state.worker_pool_submit(self._single_ground_component_fork_job, post_component, g_habitat, fp, cs, c, numpoints, reuse_hierarchy, use_resistance_calc_shortcut)
+            self.state.worker_pool_wait()
+            components = []
+        
+        for c in components:
+            self._single_ground_component_pairs(g_habitat, fp, cs, c, resistances, shortcut_resistances if use_resistance_calc_shortcut else None, numpoints, parallelize, reuse_hierarchy, use_resistance_calc_shortcut, solver_failed_somewhere, report_status, num_points_solved, num_points_to_solve)
+            self.state.del_amg_hierarchy()
+            if checkpoint is not None:
+                checkpoint.task_done((c, None), target, cs)
+                checkpoint.partial.pop(c, None)
+    
+            (hours,mins,_secs) = ComputeBase.elapsed_time(last_write_time)
+            if mins > 2 or hours > 0: 
+                last_write_time = time.time()
+                CSIO.write_resistances(options.output_file, resistances, incomplete=True)# Save incomplete resistances
+
+        self.state.del_amg_hierarchy()
+
+        # Finally, resistance to self is 0.
+        if use_resistance_calc_shortcut==True: 
+            resistances = shortcut_resistances
+        for i in range(0, numpoints):
+            resistances[i, i] = 0
+
+        return resistances, solver_failed_somewhere[0]
+
+
+    def _autotune_amg_before_jobs(self, g_habitat):
+        """Tunes AMG on the largest component of g_habitat before jobs are forked, as each job would otherwise tune on its own."""
+        if (not self.options.amg_autotune) or self.state.amg_autotuned:
+            return
+        component_sizes = np.bincount(np.asarray(g_habitat.components, dtype='int64').ravel())
+        (G, _local_node_map) = g_habitat.laplacian_for_component(int(np.argmax(component_sizes)))
+        self.autotune_amg(ComputeBase.ground_reference_node(G))
+
 
-            G_dst_dst = local_dst = None
+    def _single_ground_component_pairs(self, g_habitat, fp, cs, c, resistances, shortcut_resistances, numpoints, parallelize, reuse_hierarchy, use_resistance_calc_shortcut, solver_failed_somewhere, report_status, num_points_solved, num_points_to_solve, anchor=None):
+        """Solves all focal pairs in component c, or only those of anchor focal node if given, filling in resistances (or shortcut_resistances)."""
+        options = self.options
+        G, local_node_map = g_habitat.laplacian_for_component(c)
+        
+        if reuse_hierarchy:
+            # Ground the component once, so that one hierarchy serves all anchor nodes in it
+            ComputeBase.ground_reference_node(G)
+        
+        checkpoint = self.state.checkpoint if report_status else None
+        pool_rows = None
+        if use_resistance_calc_shortcut:
+            voltmatrix = np.zeros((numpoints,numpoints), dtype='float64')     #For resistance calc shortcut
+            # only voltages at the focal nodes are read, so only those are passed back by the solver pool
+            points_rc = fp.get_coordinates()
+            pool_rows = np.unique(local_node_map[points_rc[:,1], points_rc[:,2]]) - 1
+            pool_rows = pool_rows[pool_rows >= 0]
+            if checkpoint is not None:
+                # each solve of the anchor is checkpointed, with the voltages and resistances it gave
+                if c in checkpoint.partial:
+                    (voltmatrix[...], resistances[...]) = checkpoint.partial[c]
+                checkpoint.partial[c] = (voltmatrix, resistances)
+        
+        try:
+            local_dst = None
+            batch = []
             for (pt1_idx, pt2_idx) in fp.point_pair_idxs_in_component(c, g_habitat):
+                if (anchor is not None) and (pt1_idx != anchor):
+                    continue
+                if (checkpoint is not None) and (((c, pt1_idx) in checkpoint.done) or ((c, pt1_idx, pt2_idx) in checkpoint.done)):
+                    continue
                 if pt2_idx == -1:
-                    if parallelize:
-                        self.state.worker_pool_wait()                        
-                    self.state.del_amg_hierarchy()
-                    
-                    if (local_dst is not None) and (G_dst_dst is not None):
-                        G[local_dst, local_dst] = G_dst_dst
-                        local_dst = G_dst_dst = None
-                    
+                    if len(batch) > 0:
+                        self._flush_single_ground_batch(G, batch, local_dst, parallelize)
+                        batch = []
+                    if parallelize and ((checkpoint is not None) or use_resistance_calc_shortcut):
+                        self.state.solver_pool_wait() # results of all pairs of the anchor are needed below
+                    local_dst = None
+                
+                    if (checkpoint is not None) and not use_resistance_calc_shortcut:
+                        checkpoint.task_done((c, pt1_idx), resistances, cs)
+                
                     if (use_resistance_calc_shortcut==True):
                         Compute.get_shortcut_resistances(pt1_idx, voltmatrix, numpoints, resistances, shortcut_resistances)
                         break #No need to continue, we've got what we need to calculate resistances
                     else:
                         continue
 
-                if parallelize:
-                    self.state.worker_pool_create(options.max_parallel, True)
-
                 msg = None
                 if report_status==True:
-                    num_points_solved += 1
-                    msg = str(num_points_solved) + ' of '+ str(num_points_to_solve)
+                    num_points_solved[0] += 1
+                    msg = str(num_points_solved[0]) + ' of '+ str(num_points_to_solve)
                     msg = ('focal node ' if use_resistance_calc_shortcut else 'focal pair ') + msg
                     Compute.logger.info('Solving ' + msg)
-                
+            
+                label = str(int(fp.point_id(pt1_idx))) + '-' + str(int(fp.point_id(pt2_idx)))
                 local_src = fp.get_graph_node_idx(pt2_idx, local_node_map)
                 if local_dst is None:
                     local_dst = fp.get_graph_node_idx(pt1_idx, local_node_map)
-                    G_dst_dst = G[local_dst, local_dst]
-                    G[local_dst, local_dst] = 0
 
-                if self.state.amg_hierarchy is None:
-                    self.state.create_amg_hierarchy(G, self.options.solver)
+                if self.state.solver_pool is None:
+                    # Set up here for solves in this process, or for the pool forked below, whose workers
+                    # inherit G and the hierarchy and set up those of later anchors on their own.
+                    if reuse_hierarchy:
+                        if self.state.amg_hierarchy is None:
+                            self._create_hierarchy(G, label)
+                    else:
+                        self._ground_anchor(G, local_dst, label)
+                    if parallelize:
+                        self.state.solver_pool_create(options.max_parallel, self._single_ground_pool_solve, (G, reuse_hierarchy), G.shape[0], max(options.solver_batch_size, 1), pool_rows)
 
                 if use_resistance_calc_shortcut:
                     post_solve = self._post_single_ground_solve(G, fp, cs, resistances, numpoints, pt1_idx, pt2_idx, local_src, local_dst, local_node_map, solver_failed_somewhere, use_resistance_calc_shortcut, voltmatrix, msg=msg)
+                    if checkpoint is not None:
+                        post_solve = self._post_checkpoint_task(post_solve, (c, pt1_idx, pt2_idx), shortcut_resistances, cs)
                 else:
                     post_solve = self._post_single_ground_solve(G, fp, cs, resistances, numpoints, pt1_idx, pt2_idx, local_src, local_dst, local_node_map, solver_failed_somewhere, msg=msg)
-                
-                if parallelize:
-                    self.state.worker_pool_submit(Compute.single_ground_solver, post_solve, G, local_src, local_dst, options.solver, self.state.amg_hierarchy)
+            
+                if options.solver_batch_size > 1:
+                    batch.append((local_src, post_solve, label))
+                    if len(batch) < options.solver_batch_size:
+                        continue
+                    self._flush_single_ground_batch(G, batch, local_dst, parallelize)
+                    batch = []
+                elif parallelize:
+                    self.state.solver_pool.submit(Compute._post_pool_solve(post_solve), 1, [local_src], local_dst, [label])
                 else:
                     try:
-                        result = Compute.single_ground_solver(G, local_src, local_dst, options.solver, self.state.amg_hierarchy)
+                        result = Compute.single_ground_solver(G, local_src, local_dst, options.solver, self.state.amg_hierarchy, self.state.solution_history, label)
                     except MemoryError:
                         raise MemoryError
                     except:
@@ -574,21 +854,251 @@ class Compute(ComputeBase):
 
                 if options.low_memory_mode==True or self.state.point_file_contains_polygons==True:
                     self.state.del_amg_hierarchy()
-    
-            (hours,mins,_secs) = ComputeBase.elapsed_time(last_write_time)
-            if mins > 2 or hours > 0: 
-                last_write_time = time.time()
-                CSIO.write_resistances(options.output_file, resistances, incomplete=True)# Save incomplete resistances    
+        finally:
+            # the solver pool serves all anchors of the component, and is closed with it
+            self.state.solver_pool_close()
+            self._unground_anchor(G)
 
-        self.state.del_amg_hierarchy()
 
-        # Finally, resistance to self is 0.
-        if use_resistance_calc_shortcut==True: 
+    def _single_ground_component_job(self, g_habitat, fp, cs, c, numpoints, reuse_hierarchy, use_resistance_calc_shortcut, parallelize=False, anchor=None):
+        """Solves all focal pairs in component c (or those of anchor) in a worker process or distributed task.
+        
+        Returns the rows of the resistance matrix set by the component, and whether any solve failed.
+        """
+        resistances = -1 * np.ones((numpoints, numpoints), dtype='float64')
+        shortcut_resistances = -1 * np.ones((numpoints, numpoints), dtype='float64') if use_resistance_calc_shortcut else None
+        solver_failed = [False]
+        self._single_ground_component_pairs(g_habitat, fp, cs, c, resistances, shortcut_resistances, numpoints, parallelize, reuse_hierarchy, use_resistance_calc_shortcut, solver_failed, False, [0], 0, anchor)
+        self.state.del_amg_hierarchy()
+        
+        if use_resistance_calc_shortcut:
             resistances = shortcut_resistances
+        pt_idxs = np.where((resistances != -1).any(axis=1))[0]
+        return (pt_idxs, resistances[pt_idxs, :], solver_failed[0])
+
+
+    def _single_ground_component_fork_job(self, g_habitat, fp, cs, c, numpoints, reuse_hierarchy, use_resistance_calc_shortcut):
+        """Solves all focal pairs in component c in a forked process.
+        
+        Returns the result of _single_ground_component_job, followed by the currents that the component
+        adds into the cumulative and maximum maps of cs, or None if these are not written. In raster mode
+        these are the cells of the component and the currents there, and in network mode the whole cumulative map.
+        """
+        job_out = Output(self.options, self.state, False, cs.node_names)
+        for name in ['', 'max']:
+            if cs.get_c_map(name) is not None:
+                job_out.alloc_c_map(name)
+        result = self._single_ground_component_job(g_habitat, fp, job_out, c, numpoints, reuse_hierarchy, use_resistance_calc_shortcut)
+        
+        currents = None
+        if job_out.get_c_map('') is not None:
+            (cum_map, max_map) = (job_out.get_c_map(''), job_out.get_c_map('max'))
+            if g_habitat.is_network:
+                currents = (None, job_out.c_map_values(''), None)
+            else:
+                cells = np.ravel_multi_index(g_habitat.component_cells(c), g_habitat.component_map.shape)
+                currents = (cells, cum_map.flat[cells], None if (max_map is None) else max_map.flat[cells])
+        return result + (currents,)
+
+
+    def _distributed_pairs(self, g_habitat, fp, cs, components, resistances, shortcut_resistances, numpoints, parallelize, reuse_hierarchy, use_resistance_calc_shortcut, solver_failed_somewhere):
+        """Solves focal pairs as tasks of a distributed run shared with other processes.
+        
+        A task holds all pairs of a component when the resistance shortcut is used, and the pairs
+        of one anchor focal node otherwise. Cumulative and maximum current maps are accumulated
+        over the tasks solved by this process, and written once per batch of results.
+        On the coordinator, the results of all tasks are merged into resistances and cs.
+        """
+        options = self.options
+        distributed = self.state.distributed
+        
+        tasks = []
+        for c in components:
+            if use_resistance_calc_shortcut:
+                tasks.append((c, None))
+                continue
+            for (pt1_idx, pt2_idx) in fp.point_pair_idxs_in_component(c, g_habitat):
+                if (pt2_idx != -1) and ((len(tasks) == 0) or (tasks[-1] != (c, pt1_idx))):
+                    tasks.append((c, pt1_idx))
+        
+        settings = [options.solver, reuse_hierarchy, use_resistance_calc_shortcut, options.write_cur_maps, options.write_max_cur_maps, options.write_cum_cur_map_only, options.write_volt_maps, options.set_focal_node_currents_to_zero]
+        distributed.start(CSCache.key(g_habitat.cache_key, fp.points_rc, tasks, settings), len(tasks))
+        
+        def _new_batch_out():
+            batch_out = Output(options, self.state, False)
+            if options.write_cur_maps:
+                batch_out.alloc_c_map('')
+                if options.write_max_cur_maps:
+                    batch_out.alloc_c_map('max')
+            return batch_out
+        batch_out = [_new_batch_out()]
+        
+        def _solve_task(task):
+            (c, anchor) = tasks[task]
+            return self._single_ground_component_job(g_habitat, fp, batch_out[0], c, numpoints, reuse_hierarchy, use_resistance_calc_shortcut, parallelize, anchor)
+        
+        def _take_batch():
+            maps = (batch_out[0].get_c_map(''), batch_out[0].get_c_map('max'))
+            batch_out[0] = _new_batch_out()
+            return maps
+        
+        def _merge_task(task, result):
+            (c, _anchor) = tasks[task]
+            self._post_single_ground_component(g_habitat, fp, c, resistances, shortcut_resistances, solver_failed_somewhere, False)(result)
+        
+        def _merge_batch(maps):
+            (cum_map, max_map) = maps
+            if cum_map is not None:
+                cs.accumulate_c_map_with_values('', cum_map)
+            if max_map is not None:
+                cs.store_max_c_map_values('max', max_map)
+        
+        distributed.run_tasks(_solve_task, _merge_task, _take_batch, _merge_batch)
+
+
+    def _post_single_ground_component(self, g_habitat, fp, c, resistances, shortcut_resistances, solver_failed_somewhere, report_status, cs=None):
+        def _post_callback(result):
+            if report_status==True:
+                Compute.logger.info('Solved component ' + str(c))
+            target = resistances if (shortcut_resistances is None) else shortcut_resistances
+            
+            if result is None:
+                solver_failed_somewhere[0] = True
+                for (pt1_idx, pt2_idx) in fp.point_pair_idxs_in_component(c, g_habitat):
+                    if pt2_idx != -1:
+                        target[pt2_idx, pt1_idx] = target[pt1_idx, pt2_idx] = -777
+                return
+            
+            # Rows only hold values for pairs in the component, and -777 for focal nodes whose solves failed
+            (pt_idxs, rows, solver_failed) = result[0:3]
+            if (len(result) > 3) and (result[3] is not None):
+                (cells, cum_currents, max_currents) = result[3]
+                if cells is None:
+                    cs.accumulate_c_map_with_values('', cum_currents)
+                    if max_currents is not None:
+                        cs.store_max_c_map_values('max', max_currents)
+                else:
+                    cs.accumulate_c_map_at_cells('', cells, cum_currents, 'max' if (max_currents is not None) else None, max_currents)
+            if solver_failed:
+                solver_failed_somewhere[0] = True
+            merged = target[pt_idxs, :]
+            solved = (rows != -1)
+            merged[solved] = rows[solved]
+            target[pt_idxs, :] = merged
+            target[:, pt_idxs] = merged.T
+        
+        return _post_callback
+
+
+    def _post_checkpoint_task(self, post_solve, task, resistances, out):
+        def _post_callback(result):
+            post_solve(result)
+            self.state.checkpoint.task_done(task, resistances, out)
+        return _post_callback
+
+    def _checkpoint_key(self, *inputs):
+        """Identifies a run by its inputs and the options that change its results, so that a checkpoint is only resumed by the same run."""
+        options = self.options
+        settings = [options.scenario, options.connect_four_neighbors_only, options.connect_using_avg_resistances, options.write_cur_maps, options.write_max_cur_maps, options.write_cum_cur_map_only, options.write_volt_maps, options.set_focal_node_currents_to_zero, options.use_variable_source_strengths]
+        parts = list(inputs) + [settings]
+        if self.state.included_pairs is not None:
+            parts += [self.state.included_pairs.is_include, self.state.included_pairs.mat.tocsr()]
+        return CSCache.key(*parts)
+
+
+    def batched_all_pair_resistances(self, g_habitat, fp, report_status):
+        """Computes resistances between all focal nodes from a fixed set of batched solves per component.
+        
+        Each component is grounded at a reference node, and only the rows of the solutions at focal
+        nodes are kept. Resistances come from a matrix K over the focal nodes as
+        R_ij = K_ii + K_jj - 2*K_ij:
+        - 'pinv': G*x = e_i is solved for each focal node i, and K is the focal block of the inverse.
+          As e_i - e_j sums to zero, the grounded inverse gives the same resistances as the
+          Laplacian pseudo-inverse.
+        - 'approximate': the embedding Z = Q*W^(1/2)*B*inv(G) of Spielman and Srivastava is computed
+          with k random projections Q of the weighted edge incidence matrix W^(1/2)*B, and K = Z'*Z.
+          With k from the Johnson-Lindenstrauss bound for the focal nodes of the component, all
+          resistances are within a factor of 1 +/- approximate_resistance_eps with high probability.
+          Components where k would not be smaller than the number of focal nodes are solved exactly.
+        Right hand sides are solved solver_batch_size at a time.
+        """
+        options = self.options
+        numpoints = fp.num_points()
+        resistances = -1 * np.ones((numpoints, numpoints), dtype = 'float64')
+        solver_failed = False
+        Compute.logger.info('Graph has ' + str(g_habitat.num_nodes) + ' nodes, ' + str(numpoints) + ' focal nodes and '+ str(g_habitat.num_components)+ ' components.')
+        
+        point_nodes = np.array([fp.get_graph_node_idx(pt_idx, g_habitat.node_map) for pt_idx in range(0, numpoints)])
+        point_components = np.where(point_nodes >= 0, g_habitat.components[point_nodes], 0)
+        random_state = np.random.RandomState(0) # fixed, so that approximate runs are repeatable
+        
+        for c in range(1, int(g_habitat.num_components+1)):
+            pt_idxs = np.where(point_components == c)[0]
+            if pt_idxs.size < 2:
+                continue
+            
+            G, local_node_map = g_habitat.laplacian_for_component(c)
+            local_nodes = np.array([fp.get_graph_node_idx(pt_idx, local_node_map) for pt_idx in pt_idxs])
+            num_local = pt_idxs.size
+            
+            num_rhs = num_local
+            if options.pairwise_resistance_method == 'approximate':
+                eps = options.approximate_resistance_eps
+                num_rhs = int(np.ceil(4 * np.log(num_local) / (eps**2/2 - eps**3/3)))
+            sketch = (num_rhs < num_local)
+            if sketch:
+                # weighted incidence matrix, one row per edge of the component
+                edges = sparse.triu(-G, 1).tocoo()
+                num_edges = edges.nnz
+                sqrt_w = np.sqrt(edges.data)
+                WB = sparse.csr_matrix((np.concatenate((sqrt_w, -sqrt_w)), (np.tile(np.arange(0, num_edges), 2), np.concatenate((edges.row, edges.col)))), shape=(num_edges, G.shape[0]))
+                K = np.zeros((num_rhs, num_local), dtype='float64')   # focal columns of Z
+                Compute.logger.info('Component ' + str(c) + ': estimating resistances between ' + str(num_local) + ' focal nodes from ' + str(num_rhs) + ' random projections')
+            else:
+                K = np.zeros((num_local, num_local), dtype='float64')
+            
+            ComputeBase.ground_reference_node(G)
+            self.state.create_amg_hierarchy(G, options.solver, 'component ' + str(c))
+            
+            failed = np.zeros(num_local, dtype='bool')
+            batch_size = max(options.solver_batch_size, 1)
+            for start in range(0, num_rhs, batch_size):
+                cols = np.arange(start, min(start + batch_size, num_rhs))
+                if report_status:
+                    Compute.logger.info(('Solving projection ' if sketch else 'Solving focal node ') + str(cols[-1]+1) + ' of ' + str(num_rhs) + ' in component ' + str(c))
+                if sketch:
+                    Q = (2 * random_state.randint(0, 2, (num_edges, cols.size)) - 1) / np.sqrt(num_rhs)
+                    rhs = np.asarray(WB.T * Q)
+                    labels = 'projection'
+                else:
+                    rhs = np.zeros((G.shape[0], cols.size), dtype='float64')
+                    rhs[local_nodes[cols], np.arange(0, cols.size)] = 1
+                    labels = [str(int(fp.point_id(pt_idx))) for pt_idx in pt_idxs[cols]]
+                try:
+                    x = ComputeBase.solve_linear_system(G, rhs, options.solver, self.state.amg_hierarchy, None, labels)
+                    if sketch:
+                        K[cols, :] = x[local_nodes, :].T
+                    else:
+                        K[:, cols] = x[local_nodes, :]
+                except MemoryError:
+                    raise MemoryError
+                except:
+                    if sketch:
+                        failed[:] = True    # every projection contributes to every resistance
+                    else:
+                        failed[cols] = True
+            self.state.del_amg_hierarchy()
+            
+            K = np.dot(K.T, K) if sketch else (K + K.T) / 2
+            diag = np.diag(K)
+            R = diag[:, np.newaxis] + diag[np.newaxis, :] - 2 * K
+            R[failed, :] = R[:, failed] = -777
+            resistances[np.ix_(pt_idxs, pt_idxs)] = R
+            solver_failed = solver_failed or np.any(failed)
+        
         for i in range(0, numpoints):
             resistances[i, i] = 0
-
-        return resistances, solver_failed_somewhere[0]
+        return resistances, solver_failed
 
 
     def _post_single_ground_solve(self, G, fp, cs, resistances, numpoints, pt1_idx, pt2_idx, local_src, local_dst, local_node_map, solver_failed_somewhere, use_resistance_calc_shortcut=False, voltmatrix=None, msg=None):
@@ -620,21 +1130,151 @@ class Compute(ComputeBase):
                     cs.write_v_map(cv_map_name, False, voltages, local_node_map)
                 if options.write_cur_maps:
                     finitegrounds = [-9999] #create dummy value for pairwise case
-                    if options.write_cum_cur_map_only:
-                        cs.store_c_map(cv_map_name, voltages, G, local_node_map, finitegrounds, local_src, local_dst)
+                    if options.write_cum_cur_map_only and (options.data_type == 'raster'):
+                        # currents of the pair are added at the cells of the component, without a map of their own
+                        cs.accumulate_c_map('', voltages, G, local_node_map, finitegrounds, local_src, local_dst, 'max' if options.write_max_cur_maps else None)
                     else:
-                        cs.write_c_map(cv_map_name, False, voltages, G, local_node_map, finitegrounds, local_src, local_dst)
-                    cs.accumulate_c_map_from('', cv_map_name)
-                    if options.write_max_cur_maps:
-                        cs.store_max_c_map('max', cv_map_name)
-                    cs.rm_c_map(cv_map_name)
+                        if options.write_cum_cur_map_only:
+                            cs.store_c_map(cv_map_name, voltages, G, local_node_map, finitegrounds, local_src, local_dst)
+                        else:
+                            cs.write_c_map(cv_map_name, False, voltages, G, local_node_map, finitegrounds, local_src, local_dst)
+                        cs.accumulate_c_map_from('', cv_map_name)
+                        if options.write_max_cur_maps:
+                            cs.store_max_c_map('max', cv_map_name)
+                        cs.rm_c_map(cv_map_name)
     
         return _post_callback
 
         
+    def _flush_single_ground_batch(self, G, batch, local_dst, parallelize):
+        """Solves a batch of focal pairs sharing the same anchor (dst) node in a single multi-rhs solve."""
+        srcs = [local_src for (local_src, _post_solve, _label) in batch]
+        post_solves = [post_solve for (_local_src, post_solve, _label) in batch]
+        labels = [label for (_local_src, _post_solve, label) in batch]
+        
+        def _post_batch(results):
+            for idx in range(0, len(post_solves)):
+                post_solves[idx](None if (results is None) else results[idx])
+        
+        if parallelize:
+            self.state.solver_pool.submit(_post_batch, len(srcs), srcs, local_dst, labels)
+        else:
+            try:
+                results = Compute.single_ground_batch_solver(G, srcs, local_dst, self.options.solver, self.state.amg_hierarchy, self.state.solution_history, labels)
+            except MemoryError:
+                raise MemoryError
+            except:
+                results = None
+            _post_batch(results)
+        
+        if self.options.low_memory_mode==True or self.state.point_file_contains_polygons==True:
+            self.state.del_amg_hierarchy()
+
+
+    @staticmethod
+    def _post_pool_solve(post_solve):
+        def _post_callback(results):
+            post_solve(results[0])
+        return _post_callback
+
+
+    def _single_ground_pool_solve(self, G, reuse_hierarchy, srcs, dst, labels):
+        """Solver run by SolverPool workers in pairwise mode, for one focal pair or a batch of pairs sharing dst.
+        
+        Workers run on their own copies of G, the hierarchy and the solution history. Unless one hierarchy
+        serves the whole component, a worker grounds its G at the anchor dst of its task, and sets up the
+        hierarchy for it when the anchor differs from that of its previous task.
+        """
+        if not reuse_hierarchy:
+            self._ground_anchor(G, dst, labels[0])
+        (solver_type, ml, history) = (self.options.solver, self.state.amg_hierarchy, self.state.solution_history)
+        if len(srcs) > 1:
+            return Compute.single_ground_batch_solver(G, srcs, dst, solver_type, ml, history, labels)
+        try:
+            return [Compute.single_ground_solver(G, srcs[0], dst, solver_type, ml, history, labels[0])]
+        except MemoryError:
+            raise MemoryError
+        except:
+            return [None]
+
+
+    def _create_hierarchy(self, G, label):
+        """Sets up the hierarchy (and the solution history, if kept) of G."""
+        self.autotune_amg(G)
+        self.state.create_amg_hierarchy(G, self.options.solver, label)
+        if self.options.warm_start_history > 0:
+            self.state.solution_history = SolutionHistory(G, self.options.warm_start_history)
+
+
+    def _ground_anchor(self, G, local_dst, label):
+        """Grounds G at anchor node local_dst in place and sets up its hierarchy, unless both are done already.
+        
+        The node G was grounded at before is restored first.
+        """
+        if (self.state.grounded_node is not None) and (self.state.grounded_node[0] != local_dst):
+            self._unground_anchor(G)
+        if self.state.grounded_node is None:
+            self.state.grounded_node = (local_dst, G[local_dst, local_dst])
+            G[local_dst, local_dst] = 0
+        if self.state.amg_hierarchy is None:
+            self._create_hierarchy(G, label)
+
+
+    def _unground_anchor(self, G):
+        """Restores the diagonal entry of the anchor node G is grounded at, if any, and drops its hierarchy."""
+        if self.state.grounded_node is None:
+            return
+        (node, G_node_node) = self.state.grounded_node
+        G[node, node] = G_node_node
+        self.state.grounded_node = None
+        self.state.del_amg_hierarchy()
+
+
+    @staticmethod
+    @print_rusage
+    def single_ground_batch_solver(G, srcs, dst, solver_type, ml, history=None, labels=None):
+        """Solver used for pairwise mode when pairs with the same anchor node are batched.
+        
+        Returns a list of voltage vectors, one per source. Entries are None for pairs whose solve failed.
+        """
+        n = G.shape[0]
+        numsrcs = len(srcs)
+        rhs = np.zeros((n, numsrcs), dtype = 'float64')
+        for idx in range(0, numsrcs):
+            if srcs[idx] != dst:
+                rhs[dst, idx] = -1
+                rhs[srcs[idx], idx] = 1
+        
+        try:
+            voltages = ComputeBase.solve_linear_system(G, rhs, solver_type, ml, history, labels)
+            voltages -= voltages[dst,:].copy()
+            return [voltages[:,idx] for idx in range(0, numsrcs)]
+        except MemoryError:
+            raise MemoryError
+        except RuntimeError as error:
+            failed_columns = getattr(error, 'failed_columns', None)
+            if failed_columns is None:
+                failed_columns = range(0, numsrcs)
+                results = [None] * numsrcs
+            else:
+                voltages = error.x - error.x[dst,:]
+                results = [voltages[:,idx] for idx in range(0, numsrcs)]
+        
+        # Solve the columns that did not converge individually to isolate failed pairs.
+        Compute.logger.warning('Batched solve failed for ' + str(len(failed_columns)) + ' of ' + str(numsrcs) + ' pairs with anchor node ' + str(dst) + '. Solving these individually: ' + 
+                               ', '.join([str(srcs[idx]) if (labels is None) else str(labels[idx]) for idx in failed_columns]))
+        for idx in failed_columns:
+            try:
+                results[idx] = Compute.single_ground_solver(G, srcs[idx], dst, solver_type, ml, history, None if (labels is None) else labels[idx])
+            except MemoryError:
+                raise MemoryError
+            except:
+                results[idx] = None
+        return results
+
     @staticmethod
     @print_rusage
-    def single_ground_solver(G, src, dst, solver_type, ml):
+    def single_ground_solver(G, src, dst, solver_type, ml, history=None, label=None):
         """Solver used for pairwise mode."""  
         n = G.shape[0]
         rhs = np.zeros(n, dtype = 'float64')
@@ -643,111 +1283,45 @@ class Compute(ComputeBase):
         else:
             rhs[dst] = -1
             rhs[src] = 1
-            voltages = ComputeBase.solve_linear_system (G, rhs, solver_type, ml)
+            voltages = ComputeBase.solve_linear_system (G, rhs, solver_type, ml, history, label)
+            voltages -= voltages[dst] # Report voltages relative to dst when G was grounded elsewhere
 
         return voltages
 
     @print_rusage
     def advanced_module(self, g_habitat, out, source_map, ground_map, source_id=None, component_with_points=None):
-        solver_called = False
-        solver_failed = False
-        node_map = None 
-        if component_with_points is not None:
-            G = g_habitat.get_graph()
-            G = ComputeBase.laplacian(G)
-            node_map = g_habitat.node_map
+        solver_called = [False]
+        solver_failed = [False]
         
         vc_map_id = '' if (source_id is None) else str(source_id)
         out.alloc_v_map(vc_map_id)
         
         if self.options.write_cur_maps:
             out.alloc_c_map(vc_map_id)
+        
+        components = range(1, g_habitat.num_components+1)
+        if component_with_points is not None:
+            components = [component_with_points]
+        
+        # Components are set up and solved as parallel jobs, largest first to balance the load
+        parallelize = self.options.parallelize and (self.options.low_memory_mode == False) and (len(components) > 1)
+        if parallelize:
+            component_sizes = np.bincount(np.asarray(g_habitat.components, dtype='int64').ravel())
+            components.sort(key=lambda comp: -component_sizes[comp])
+            self._autotune_amg_before_jobs(g_habitat)
+            self.state.worker_pool_create(self.options.max_parallel)
             
-        for comp in range(1, g_habitat.num_components+1):
-            if (component_with_points is not None) and (comp != component_with_points):
-                continue
-
-            if component_with_points is None:
-                (G, node_map) = g_habitat.prune_nodes_for_component(comp)
-                G = ComputeBase.laplacian(G)
-
-            if self.options.data_type == 'raster':
-                c_map = np.where(g_habitat.component_map == comp, 1, 0)
-                local_source_map = np.multiply(c_map, source_map)
-                local_ground_map = np.where(c_map, ground_map, 0) 
-                del c_map
-                have_sources = (np.where(local_source_map, 1, 0)).sum() > 0
-                have_grounds = (np.where(local_ground_map, 1, 0)).sum() > 0
+        for comp in components:
+            label = ('component ' + str(comp)) if (source_id is None) else vc_map_id
+            post_solve = self._post_advanced_component(out, vc_map_id, solver_called, solver_failed)
+            if parallelize:
+                self.state.worker_pool_submit(self._advanced_component_job, post_solve, g_habitat, out, comp, source_map, ground_map, component_with_points, label)
             else:
-                c_map = np.where(g_habitat.components == comp, 1, 0)
-                sources = np.zeros(g_habitat.num_nodes)
-                for idx in range(0, source_map.shape[0]):
-                    sources = np.where(g_habitat.node_map == source_map[idx,0], source_map[idx,1], sources)
-                grounds = -9999 * np.ones(g_habitat.num_nodes)
-                for idx in range(0, ground_map.shape[0]):
-                    grounds = np.where(g_habitat.node_map == ground_map[idx,0], ground_map[idx,1], grounds)
-                if self.options.ground_file_is_resistances:
-                    _grounds = 1 / grounds
-                    grounds = np.where(grounds == -9999, 0, _grounds)
-                else:
-                    grounds = np.where(grounds == -9999, 0, grounds)
-                    
-                if component_with_points is None:
-                    sources = g_habitat.prune_for_component(comp, sources)
-                    grounds = g_habitat.prune_for_component(comp, grounds)
-                                                            
-                have_sources = (np.where(sources, 1, 0)).sum() > 0
-                have_grounds = (np.where(grounds, 1, 0)).sum() > 0
-            
-            if not (have_sources and have_grounds):
-                continue
-                
-            if self.options.data_type == 'raster':
-                (rows, cols) = np.where(local_source_map)
-                values = local_source_map[rows,cols]
-                local_sources_rc = np.c_[values,rows,cols]
-                
-                (rows, cols) = np.where(local_ground_map)
-                values = local_ground_map[rows,cols]
-                local_grounds_rc = np.c_[values,rows,cols]
-                
-                del rows, cols, values, local_source_map, local_ground_map 
-    
-                numnodes = node_map.max()
-                sources = np.zeros(numnodes)
-                grounds = np.zeros(numnodes)
-                num_local_sources = local_sources_rc.shape[0]
-                num_local_grounds = local_grounds_rc.shape[0]
-    
-                for source in range(0, num_local_sources):
-                    src = self.grid_to_graph(local_sources_rc[source,1], local_sources_rc[source,2], node_map)
-                    # Possible to have more than one source at a node when there are polygons
-                    sources[src] += local_sources_rc[source,0] 
-    
-                for ground in range(0, num_local_grounds):
-                    gnd = self.grid_to_graph (local_grounds_rc[ground,1], local_grounds_rc[ground,2], node_map)
-                    # Possible to have more than one ground at a node when there are polygons
-                    grounds[gnd] += local_grounds_rc[ground,0] 
-
-            (sources, grounds, finitegrounds) = self.resolve_conflicts(sources, grounds)
-
-            solver_called = True
-            try:
-                voltages = self.multiple_solver(G, sources, grounds, finitegrounds)
-                del sources, grounds
-            except MemoryError:
-                raise MemoryError
-            except:
-                voltages = -777
-                solver_failed = True
-
-            if solver_failed==False:
-                ##Voltage and current mapping are cumulative, since there may be independent components.
-                if self.options.write_volt_maps or (self.options.scenario=='one-to-all'):
-                    out.accumulate_v_map(vc_map_id, voltages, node_map)
-                    
-                if self.options.write_cur_maps:
-                    out.accumulate_c_map(vc_map_id, voltages, G, node_map, finitegrounds, None, None)
+                post_solve(self._advanced_component_job(g_habitat, out, comp, source_map, ground_map, component_with_points, label))
+        
+        if parallelize:
+            self.state.worker_pool_wait()
+        solver_failed = solver_failed[0]
         
         voltages = out.get_v_map(vc_map_id)
         if solver_failed==False and self.options.write_volt_maps:
@@ -767,12 +1341,231 @@ class Compute(ComputeBase):
 
         out.rm_v_map(vc_map_id)
         # Advanced mode will return voltages of the last component solved only for verification purposes.  
-        if solver_called==False:
+        if solver_called[0]==False:
             voltages = -1
 
         return voltages, out.get_c_map(vc_map_id, True), solver_failed
 
         
+    def advanced_batch_module(self, g_habitat, out, scenarios):
+        """Solves a batch of advanced mode scenarios against the same habitat.
+        
+        scenarios holds the (name, source file, ground file) of each scenario. Scenarios are read
+        and solved solver_batch_size at a time (times the number of workers when parallelized), so
+        that the maps of only that many scenarios are held at once. Within each component, scenarios
+        with the same grounds share a system and are solved as one multi-rhs solve, and such groups
+        are solved in parallel when parallelize is set. Voltage and current maps of each scenario
+        are written with its name.
+        
+        Returns the names of the scenarios solved, and whether any solve failed.
+        """
+        options = self.options
+        parallelize = options.parallelize and (options.low_memory_mode == False)
+        batch_size = max(options.solver_batch_size, 1)
+        if parallelize:
+            batch_size *= min(multiprocessing.cpu_count(), options.max_parallel) if (options.max_parallel > 0) else multiprocessing.cpu_count()
+        
+        components = range(1, g_habitat.num_components+1)
+        if parallelize:
+            component_sizes = np.bincount(np.asarray(g_habitat.components, dtype='int64').ravel())
+            components.sort(key=lambda comp: -component_sizes[comp])
+        
+        solver_failed = False
+        for start in range(0, len(scenarios), batch_size):
+            batch = []
+            for (name, source_file, ground_file) in scenarios[start:start+batch_size]:
+                Compute.logger.info('Reading scenario ' + name)
+                if options.data_type == 'raster':
+                    (source_map, ground_map) = CSIO.read_source_and_ground_maps(source_file, ground_file, self.state, options)
+                else:
+                    (source_map, ground_map) = (CSIO.read_point_strengths(source_file), CSIO.read_point_strengths(ground_file))
+                batch.append((name, source_map, ground_map, [False]))
+                if options.write_volt_maps:
+                    out.alloc_v_map(name)
+                if options.write_cur_maps:
+                    out.alloc_c_map(name)
+            
+            if parallelize:
+                self.state.worker_pool_create(options.max_parallel)
+            for comp in components:
+                (G, node_map) = g_habitat.laplacian_for_component(comp)
+                
+                groups = {}
+                group_keys = []
+                for (name, source_map, ground_map, scenario_failed) in batch:
+                    (sources, grounds) = self.component_sources_and_grounds(g_habitat, comp, node_map, source_map, ground_map, True)
+                    if sources is None:
+                        continue
+                    (sources, grounds, finitegrounds) = self.resolve_conflicts(sources, grounds)
+                    key = grounds.tostring()
+                    if key not in groups:
+                        groups[key] = (grounds, finitegrounds, [])
+                        group_keys.append(key)
+                    groups[key][2].append((name, sources, scenario_failed))
+                
+                for key in group_keys:
+                    (grounds, finitegrounds, members) = groups[key]
+                    names = [name for (name, _sources, _failed) in members]
+                    Compute.logger.info('Solving scenario' + ('s ' if (len(names) > 1) else ' ') + ', '.join(names) + ' in component ' + str(comp))
+                    if len(members) > 1:
+                        sources = np.column_stack([sources for (_name, sources, _failed) in members])
+                        label = names
+                    else:
+                        sources = members[0][1]
+                        label = names[0]
+                    post_solves = [self._post_multiple_solve(out, name, G, node_map, finitegrounds, scenario_failed) for (name, _sources, scenario_failed) in members]
+                    post_solve = Compute._post_multiple_batch_solve(post_solves)
+                    if parallelize:
+                        self.autotune_amg(G)
+                        self.state.worker_pool_submit(self.multiple_solver, post_solve, G, sources, grounds, finitegrounds, label)
+                    else:
+                        try:
+                            voltages = self.multiple_solver(G, sources, grounds, finitegrounds, label)
+                        except MemoryError:
+                            raise MemoryError
+                        except:
+                            voltages = None
+                        post_solve(voltages)
+            self.state.worker_pool_wait()
+            
+            for (name, _source_map, _ground_map, scenario_failed) in batch:
+                if scenario_failed[0]:
+                    Compute.logger.error('Solver failed for scenario ' + name)
+                    solver_failed = True
+                else:
+                    if options.write_volt_maps:
+                        out.write_v_map(name)
+                    if options.write_cur_maps:
+                        out.write_c_map(name, node_map=g_habitat.node_map)
+                out.rm_v_map(name)
+                out.rm_c_map(name)
+        
+        return [name for (name, _source_file, _ground_file) in scenarios], solver_failed
+
+
+    @staticmethod
+    def _post_multiple_batch_solve(post_solves):
+        def _post_callback(voltages):
+            for idx in range(0, len(post_solves)):
+                if (voltages is None) or (len(post_solves) == 1):
+                    post_solves[idx](voltages)
+                else:
+                    post_solves[idx](voltages[:,idx])
+        return _post_callback
+
+
+    def component_sources_and_grounds(self, g_habitat, comp, node_map, source_map, ground_map, prune):
+        """Returns the source and ground vectors of component comp in advanced mode, or (None, None) if it lacks either.
+        
+        In network mode, vectors are pruned to the component if prune is True.
+        """
+        if self.options.data_type == 'raster':
+            (rows, cols) = g_habitat.component_cells(comp)
+            local_sources = source_map[rows,cols]
+            local_grounds = ground_map[rows,cols]
+            have_sources = np.any(local_sources)
+            have_grounds = np.any(local_grounds)
+        else:
+            node_names = g_habitat.node_map[g_habitat.component_nodes(comp)] if prune else g_habitat.node_map
+            sources = self.node_values(node_names, source_map, 0)
+            grounds = self.node_values(node_names, ground_map, -9999)
+            if self.options.ground_file_is_resistances:
+                _grounds = 1 / grounds
+                grounds = np.where(grounds == -9999, 0, _grounds)
+            else:
+                grounds = np.where(grounds == -9999, 0, grounds)
+                                                        
+            have_sources = (np.where(sources, 1, 0)).sum() > 0
+            have_grounds = (np.where(grounds, 1, 0)).sum() > 0
+        
+        if not (have_sources and have_grounds):
+            return (None, None)
+            
+        if self.options.data_type == 'raster':
+            # Possible to have more than one source or ground at a node when there are polygons, and their values add up
+            numnodes = node_map.max()
+            nodes = self.grid_to_graph(rows, cols, node_map)
+            is_source = (local_sources != 0)
+            sources = np.bincount(nodes[is_source], weights=local_sources[is_source], minlength=numnodes)
+            is_ground = (local_grounds != 0)
+            grounds = np.bincount(nodes[is_ground], weights=local_grounds[is_ground], minlength=numnodes)
+
+        return (sources, grounds)
+
+
+    def _advanced_component_job(self, g_habitat, out, comp, source_map, ground_map, component_with_points, label):
+        """Sets up and solves component comp in advanced mode, in this process or as a parallel job.
+        
+        Returns (None, None, None) if the component has no sources, and otherwise its node map, its
+        voltages and its currents from out.component_currents if current maps are written. Voltages
+        are None if the solve failed.
+        """
+        if component_with_points is None:
+            (G, node_map) = g_habitat.laplacian_for_component(comp)
+        else:
+            G = g_habitat.get_laplacian()
+            node_map = g_habitat.node_map
+
+        (sources, grounds) = self.component_sources_and_grounds(g_habitat, comp, node_map, source_map, ground_map, component_with_points is None)
+        if sources is None:
+            return (None, None, None)
+
+        (sources, grounds, finitegrounds) = self.resolve_conflicts(sources, grounds)
+        try:
+            voltages = self.multiple_solver(G, sources, grounds, finitegrounds, label)
+        except MemoryError:
+            raise MemoryError
+        except:
+            return (node_map, None, None)
+        del sources, grounds
+        
+        currents = None
+        if self.options.write_cur_maps:
+            currents = out.component_currents(voltages, G, node_map, finitegrounds)
+        return (node_map, voltages, currents)
+
+
+    def _post_advanced_component(self, out, vc_map_id, solver_called, solver_failed):
+        def _post_callback(result):
+            if result is None:
+                # the job failed before returning
+                solver_called[0] = solver_failed[0] = True
+                return
+            
+            (node_map, voltages, currents) = result
+            if node_map is None:
+                return
+            solver_called[0] = True
+            if voltages is None:
+                solver_failed[0] = True
+                return
+            
+            ##Voltage and current mapping are cumulative, since there may be independent components.
+            if self.options.write_volt_maps or (self.options.scenario=='one-to-all'):
+                out.accumulate_v_map(vc_map_id, voltages, node_map)
+                
+            if currents is not None:
+                out.accumulate_component_currents(vc_map_id, currents)
+        
+        return _post_callback
+
+
+    def _post_multiple_solve(self, out, vc_map_id, G, node_map, finitegrounds, solver_failed):
+        def _post_callback(voltages):
+            if voltages is None:
+                solver_failed[0] = True
+                return
+            
+            ##Voltage and current mapping are cumulative, since there may be independent components.
+            if self.options.write_volt_maps or (self.options.scenario=='one-to-all'):
+                out.accumulate_v_map(vc_map_id, voltages, node_map)
+                
+            if self.options.write_cur_maps:
+                out.accumulate_c_map(vc_map_id, voltages, G, node_map, finitegrounds, None, None)
+        
+        return _post_callback
+    
+    
     def resolve_conflicts(self, sources, grounds):
         """Handles conflicting grounds and sources for advanced mode according to user preferences."""  
         finitegrounds = np.where(grounds < np.Inf, grounds, 0)
@@ -799,8 +1592,11 @@ class Compute(ComputeBase):
 
 
     @print_rusage
-    def multiple_solver(self, G, sources, grounds, finitegrounds):
-        """Solver used for advanced mode."""  
+    def multiple_solver(self, G, sources, grounds, finitegrounds, label=None):
+        """Solver used for advanced mode.
+        
+        sources may have one column per scenario, all sharing the same grounds.
+        """  
         Gsolve = G
         if finitegrounds[0] != -9999:
             Gsolve = G + sparse.spdiags(finitegrounds.T, 0, G.shape[0], G.shape[0])
@@ -818,76 +1614,66 @@ class Compute(ComputeBase):
             keep = np.delete(np.arange(0, sources.shape[0]), dst)
             sources = sources[keep]            
         Gsolve = ComputeBase.deleterowcol(Gsolve, delrow = dst_to_delete, delcol = dst_to_delete)
+        if self.options.solver == 'cholesky':
+            Gsolve = ComputeBase.ground_floating_components(Gsolve)
         
-        self.state.create_amg_hierarchy(Gsolve, self.options.solver)
-        voltages = ComputeBase.solve_linear_system(Gsolve, sources, self.options.solver, self.state.amg_hierarchy)
+        self.autotune_amg(Gsolve)
+        self.state.create_amg_hierarchy(Gsolve, self.options.solver, label)
+        voltages = ComputeBase.solve_linear_system(Gsolve, sources, self.options.solver, self.state.amg_hierarchy, None, label)
         del Gsolve
         self.state.del_amg_hierarchy()
 
         numinfgrounds = infgroundlist.shape[0]
+        voltages = np.asarray(voltages).reshape((sources.shape[0], -1))
         if numinfgrounds>0:
             #replace infinite grounds in voltage vector
             for ground in range(numinfgrounds,0, -1): 
                 node = infgroundlist[numinfgrounds - ground] 
-                voltages = np.asmatrix(np.insert(voltages,node,0)).T
-        return np.asarray(voltages).reshape(voltages.size)
+                voltages = np.insert(voltages, node, 0, axis=0)
+        return voltages.reshape(voltages.shape[0]) if (sources.ndim == 1) else voltages
             
 
-    @print_rusage
-    def create_voltage_map(self, node_map, voltages):
-        """Creates raster map of voltages given node voltage vector."""
-        voltage_map = np.zeros((self.state.nrows, self.state.ncols), dtype = 'float64')
-        ind = node_map > 0
-        voltage_map[np.where(ind)] = np.asarray(voltages[node_map[ind]-1]).flatten()
-        return voltage_map
-            
- 
     def get_voltmatrix(self, i, j, numpoints, local_node_map, voltages, fp, resistances, voltmatrix):                                            
         """Returns a matrix of pairwise voltage differences between focal nodes.
         
         Used for shortcut calculations of effective resistance when no
-        voltages or currents are mapped.
+        voltages or currents are mapped. Voltages are read at the focal nodes
+        through the node map, without building a voltage raster.
         
         """  
-        voltvector = np.zeros((numpoints,1),dtype = 'float64')  
-        voltage_map = self.create_voltage_map(local_node_map,voltages) 
-        for point in range(1,numpoints):
-            voltageAtPoint = voltage_map[fp.get_coordinates(point)]
-            voltageAtPoint = 1-(voltageAtPoint/resistances[i, j])
-            voltvector[point] = voltageAtPoint
-        voltmatrix[:,j] = voltvector[:,0] 
+        points_rc = np.asarray(fp.get_coordinates()[1:numpoints], dtype='int32')
+        nodes = local_node_map[points_rc[:,1], points_rc[:,2]] - 1
+        voltages = np.asarray(voltages).ravel()
+        voltages_at_points = np.where(nodes >= 0, voltages[np.maximum(nodes, 0)], 0)
+        voltmatrix[0, j] = 0
+        voltmatrix[1:numpoints, j] = 1 - (voltages_at_points / resistances[i, j])
 
 
     @staticmethod
-    def get_shortcut_resistances(anchor_point, voltmatrix, numpoints, resistances, shortcut_resistances): #FIXME: no solver failed capability
+    def get_shortcut_resistances(anchor_point, voltmatrix, numpoints, resistances, shortcut_resistances):
         """Calculates all resistances to each focal node at once.
         
         Greatly speeds up resistance calculations if not mapping currents or voltages.
+        A failed solve (-777) for a focal node marks all resistances involving it as failed.
         
         """  
-        for pointx in range(0, numpoints): #anchor_point is source node, i.e. the 1 in R12.  point 2 is the dst node.
-            R1x = resistances[anchor_point, pointx]
-            if R1x!= -1:
-                shortcut_resistances[pointx, anchor_point] = shortcut_resistances[anchor_point, pointx] = R1x
-                # for point2 in range(0, numpoints): # Doing redundant calc as check
-                for point2 in range(pointx, numpoints):
-                    R12 = resistances[anchor_point, point2] 
-                    if R12!= -1:
-                        if R1x!= -777:
-                            shortcut_resistances[anchor_point, point2] = shortcut_resistances[point2, anchor_point] = R12
-                            Vx = voltmatrix[pointx, point2]
-                            R2x = 2*R12*Vx + R1x - R12
-                            # prev_result = shortcut_resistances[point2, pointx]
-                            # if point2 < pointx and prev_result != -777:
-                                # pct_diff = 100*(prev_result - R2x)/prev_result 
-                                # if pct_diff > 1: # If two results differ by 1%, can we trust result?
-                                    # print '***************************************************'
-                                    # print 'Warning: there is a difference in results for different shortcut solves. '
-                                    # print 'For point idx values', pointx,point2, 'Percent difference is', pct_diff
-                            if shortcut_resistances[point2, pointx] != -777: # If solver didn't fail for point2's iteration
-                                shortcut_resistances[point2, pointx] = shortcut_resistances[pointx, point2] = R2x
-                        else: # Assume solver failure with point2 means cannot trust result for any pair that includes point2
-                            shortcut_resistances[pointx, :] = shortcut_resistances[:, pointx] = -777
+        R1 = resistances[anchor_point, 0:numpoints] # anchor_point is source node, i.e. the 1 in R12
+        solved = (R1 != -1)
+        failed = solved & (R1 == -777)
+        
+        shortcut_resistances[anchor_point, solved] = R1[solved]
+        shortcut_resistances[solved, anchor_point] = R1[solved]
+        
+        # R2x = 2*R12*Vx + R1x - R12 for pairs (x, 2) of solved nodes with 2 >= x, where x solved successfully
+        (X, P) = np.meshgrid(np.where(solved & ~failed)[0], np.where(solved)[0], indexing='ij')
+        R2x = 2*R1[P]*voltmatrix[X, P] + R1[X] - R1[P]
+        use = (P >= X) & (shortcut_resistances[P, X] != -777)
+        (X, P, R2x) = (X[use], P[use], R2x[use])
+        shortcut_resistances[P, X] = R2x
+        shortcut_resistances[X, P] = R2x
+        
+        shortcut_resistances[failed, :] = -777
+        shortcut_resistances[:, failed] = -777
 
     def write_resistances(self, point_ids, resistances):
         """Writes resistance file to disk."""  
@@ -971,7 +1757,10 @@ class Compute(ComputeBase):
 
         if self.options.scenario=='advanced':
             self.state.points_rc = []
-            (self.state.source_map, self.state.ground_map) = CSIO.read_source_and_ground_maps(self.options.source_file, self.options.ground_file, self.state, self.options)
+            if self.options.scenario_file not in [None, 'None', '']:
+                self.state.scenarios = CSIO.read_scenario_list(self.options.scenario_file) # source and ground maps are read as each scenario is solved
+            else:
+                (self.state.source_map, self.state.ground_map) = CSIO.read_source_and_ground_maps(self.options.source_file, self.options.ground_file, self.state, self.options)
         else:        
             self.state.points_rc = CSIO.read_point_map(self.options.point_file, "Focal node", self.state)
             self.state.source_map = []
@@ -1,4 +1,4 @@
-import sys, time, logging, copy
+import sys, time, logging, copy, threading, warnings
 import numpy as np
 from scipy.sparse.linalg import cg
 from scipy import sparse
@@ -7,11 +7,27 @@ from scipy.sparse.csgraph import connected_components, _validation #_validation
 from cfg import CSConfig
 from state import CSState
 from io import CSIO
-from profiler import ResourceLogger, print_rusage, gc_before, GCPreempt, LowMemRetry
+from cache import CSCache
+from distributed import DistributedRun
+from checkpoint import Checkpoint
+from profiler import ResourceLogger, print_rusage, gc_before, GCPreempt, LowMemRetry, SolverStats
 
 
 class ComputeBase(object):
     logger = None
+    solver_tol = 1e-6               # convergence tolerance of iterative solvers, relative to the norm of rhs
+    solver_maxiter = 100000
+    solver_residual_check = 1e-3    # solves with a larger residual norm are treated as failed
+    amg_cycle = 'V'                 # multigrid cycle used by the AMG solver and preconditioner
+    
+    # AMG settings tried by the autotuner, as changes to the configured ones
+    AMG_PRESETS = [
+        {},
+        {'amg_strength': ('symmetric', {'theta': 0.25})},
+        {'amg_strength': 'evolution'},
+        {'amg_cycle': 'W'},
+        {'amg_smoother': 'gauss_seidel', 'amg_cycle': 'F'},
+    ]
     
     """Circuitscape base class, common across all circuitscape modules"""
     def __init__(self, configFile, ext_log_handler):
@@ -97,7 +113,7 @@ class ComputeBase(object):
         
         formatter = ComputeBase._create_formatter(log_lvl, printDashes)
         
-        CSIO.logger = CSState.logger = ComputeBase.logger = ComputeBase._create_logger('circuitscape', log_lvl, self.options.log_file, self.options.screenprint_log, ext_log_handler, formatter)
+        CSIO.logger = CSState.logger = CSCache.logger = DistributedRun.logger = Checkpoint.logger = ComputeBase.logger = ComputeBase._create_logger('circuitscape', log_lvl, self.options.log_file, self.options.screenprint_log, ext_log_handler, formatter)
 
         if (self.options.profiler_log_file != self.options.log_file) and (self.options.profiler_log_file is not None):
             res_logger = ComputeBase._create_logger('circuitscape_profile', logging.DEBUG, self.options.profiler_log_file, self.options.screenprint_log, ext_log_handler, formatter)
@@ -120,6 +136,7 @@ class ComputeBase(object):
         cs = self
         @staticmethod
         def _set_low_memory_mode(etype, ex, traceback):
+            cs.state.solver_pool_close()
             cs.state.del_amg_hierarchy()
             ComputeBase.logger.exception("Circuitscape is running low on memory. Closing other programs can help free memory resources.")
             if not cs.options.low_memory_mode:
@@ -132,20 +149,213 @@ class ComputeBase(object):
     @staticmethod
     @gc_before
     @print_rusage
-    def solve_linear_system(G, rhs, solver_type, ml):
-        """Solves system of equations."""
+    def solve_linear_system(G, rhs, solver_type, ml, history=None, label=None):
+        """Solves system of equations.
+        
+        When a SolutionHistory of earlier solutions of the same G is passed, iterative solvers
+        start from its initial guess, and the new solutions are added to it.
+        label identifies the solve (or each rhs column) in the solver report.
+        A RuntimeError raised for failed solves carries the failed rhs columns in failed_columns
+        and the solution in x, so that callers can keep the columns that were solved.
+        """
         # Solve G*x = rhs
+        # A 2-d rhs holds one right hand side per column, all sharing the same G and hierarchy.
+        tol = ComputeBase.solver_tol
+        maxiter = ComputeBase.solver_maxiter
         x = []
+        x0 = None
+        if (history is not None) and (solver_type in ['amg', 'cg+amg']):
+            x0 = history.initial_guess(rhs)
+        else:
+            history = None
+        
+        iters = None
+        t1 = time.time()
         if solver_type == 'cg+amg':
-            G.psolve = ml.psolve
-            (x, flag) = cg(G, rhs, tol = 1e-6, maxiter = 100000)
-            if flag !=  0 or np.linalg.norm(G*x-rhs) > 1e-3:
-                raise RuntimeError('CG did not converge. May need more iterations.') 
+            G.psolve = ComputeBase.amg_preconditioner(ml)
+            if rhs.ndim > 1:
+                (x, flag, iters) = ComputeBase.batch_cg(G, rhs, G.psolve, tol, maxiter, x0)
+            else:
+                iters = [0]
+                def _count_iter(_xk):
+                    iters[0] += 1
+                (x, flag) = cg(G, rhs, x0 = x0, tol = tol, maxiter = maxiter, callback = _count_iter)
+            ComputeBase._log_iterations('CG', iters, x0)
         elif solver_type == 'amg':
-            x = ml.solve(rhs, tol = 1e-6);
+            if rhs.ndim > 1:
+                x = np.zeros(rhs.shape, dtype='float64')
+                iters = []
+                for col in range(0, rhs.shape[1]):
+                    residuals = []
+                    x[:,col] = ml.solve(rhs[:,col], x0 = (None if (x0 is None) else x0[:,col]), tol = tol, maxiter = maxiter, cycle = ComputeBase.amg_cycle, residuals = residuals)
+                    iters.append(len(residuals) - 1)
+            else:
+                residuals = []
+                x = ml.solve(rhs, x0 = x0, tol = tol, maxiter = maxiter, cycle = ComputeBase.amg_cycle, residuals = residuals);
+                iters = [len(residuals) - 1]
+            ComputeBase._log_iterations('AMG', iters, x0)
+        elif solver_type == 'cholesky':
+            x = ml(rhs)
+        solve_time = time.time() - t1
+        
+        residuals = np.asarray(G*x - rhs).reshape((G.shape[0], -1))
+        residuals = np.sqrt((residuals*residuals).sum(0))
+        SolverStats.record_solve(label, solver_type, G.shape[0], iters, residuals.tolist(), solve_time)
+        
+        failed = (residuals > ComputeBase.solver_residual_check)
+        error = None
+        if solver_type == 'cg+amg':
+            if rhs.ndim > 1:
+                failed[flag] = True
+            elif flag != 0:
+                failed[:] = True
+            if np.any(failed):
+                error = RuntimeError('CG did not converge. May need more iterations.')
+        elif solver_type == 'cholesky':
+            failed |= ~np.isfinite(np.asarray(x).reshape((G.shape[0], -1))).all(0)
+            if np.any(failed):
+                error = RuntimeError('Direct solve failed. Matrix may be singular or badly conditioned.')
+        if error is not None:
+            error.failed_columns = np.flatnonzero(failed)
+            error.x = x
+            raise error
+
+        if history is not None:
+            history.add(x)
+        return x
+
+
+    @staticmethod
+    def amg_preconditioner(ml):
+        """Returns a function applying one multigrid cycle of hierarchy ml."""
+        if ComputeBase.amg_cycle == 'V':
+            return ml.psolve
+        cycle = ComputeBase.amg_cycle
+        def _psolve(b):
+            return ml.solve(b, maxiter=1, cycle=cycle)
+        return _psolve
+
+
+    @staticmethod
+    def amg_solver_options(options):
+        """Returns the keyword arguments of smoothed_aggregation_solver for the AMG settings in options."""
+        smoother = options.amg_smoother
+        if smoother in ['gauss_seidel', 'block_gauss_seidel']:
+            smoother = (smoother, {'sweep': 'symmetric'})
+        return {'strength': options.amg_strength,
+                'aggregate': options.amg_aggregate,
+                'presmoother': smoother,
+                'postsmoother': smoother,
+                'max_levels': options.amg_max_levels,
+                'coarse_solver': options.amg_coarse_solver}
+
+
+    def set_amg_options(self):
+        ComputeBase.amg_cycle = self.options.amg_cycle
+        self.state.amg_options = ComputeBase.amg_solver_options(self.options)
+
+
+    def autotune_amg(self, G):
+        """Picks the fastest of the AMG presets for G, the first system to be solved.
+        
+        Each preset is timed on hierarchy setup plus one solve with a zero-sum random rhs,
+        which is solvable with both grounded and pairwise systems. The winning settings are
+        kept for the rest of the run. Does nothing once tuned, or when tuning is not enabled.
+        """
+        if (not self.options.amg_autotune) or self.state.amg_autotuned or (self.options.solver not in ['amg', 'cg+amg']):
+            return
+        self.state.amg_autotuned = True
+        
+        rhs = np.random.RandomState(0).rand(G.shape[0])
+        rhs -= rhs.mean()
+        configured = dict([(name, getattr(self.options, name)) for name in ['amg_strength', 'amg_aggregate', 'amg_smoother', 'amg_max_levels', 'amg_coarse_solver', 'amg_cycle']])
+        best_time = best_preset = None
+        for preset_idx in range(0, len(ComputeBase.AMG_PRESETS)):
+            for name, value in configured.items() + ComputeBase.AMG_PRESETS[preset_idx].items():
+                setattr(self.options, name, value)
+            self.set_amg_options()
+            t1 = time.time()
+            try:
+                self.state.create_amg_hierarchy(G, self.options.solver, 'autotune preset ' + str(preset_idx))
+                ComputeBase.solve_linear_system(G, rhs, self.options.solver, self.state.amg_hierarchy, None, 'autotune preset ' + str(preset_idx))
+            except MemoryError:
+                raise MemoryError
+            except:
+                ComputeBase.logger.debug('AMG preset ' + str(preset_idx) + ' failed')
+                continue
+            finally:
+                self.state.del_amg_hierarchy()
+            elapsed = time.time() - t1
+            ComputeBase.logger.debug('AMG preset ' + str(preset_idx) + ' took ' + str(elapsed) + ' seconds')
+            if (best_time is None) or (elapsed < best_time):
+                (best_time, best_preset) = (elapsed, preset_idx)
+        
+        for name, value in configured.items() + ComputeBase.AMG_PRESETS[best_preset or 0].items():
+            setattr(self.options, name, value)
+        self.set_amg_options()
+        ComputeBase.logger.info('AMG autotuner picked preset ' + str(best_preset or 0) + ': ' + str(self.state.amg_options) + ', cycle ' + ComputeBase.amg_cycle)
+
+
+    @staticmethod
+    def _log_iterations(method, iters, x0):
+        if (ComputeBase.logger is not None) and ComputeBase.logger.isEnabledFor(logging.DEBUG):
+            ComputeBase.logger.debug(method + ' iterations: ' + ', '.join([str(it) for it in iters]) + (' (warm start)' if (x0 is not None) else ''))
+
+
+    @staticmethod
+    def batch_cg(G, B, psolve, tol, maxiter, X0=None):
+        """Preconditioned conjugate gradients on all columns of B at once.
+
+        Each column runs its own CG recurrence, but the iterations proceed in lockstep
+        so that G is applied to the whole block of search directions with a single
+        sparse matrix-matrix product. Columns stop updating once they converge.
+        Returns the solution block, the columns that failed to converge (empty if all did),
+        and the number of iterations taken by each column.
+        """
+        n, k = B.shape
+        if X0 is None:
+            X = np.zeros((n, k), dtype='float64')
+            R = np.array(B, dtype='float64')
+        else:
+            X = np.array(X0, dtype='float64')
+            R = B - np.asarray(G * X)
+        bnorm = np.sqrt((B*B).sum(0))
+        bnorm[bnorm == 0] = 1
+        iters = np.zeros(k, dtype='int32')
+
+        active = np.arange(0, k)
+        Z = np.zeros((n, k), dtype='float64')
+        for col in active:
+            Z[:,col] = psolve(R[:,col])
+        P = Z.copy()
+        rz = (R*Z).sum(0)
+
+        for _iter in range(0, maxiter):
+            resid = np.sqrt((R[:,active]**2).sum(0)) / bnorm[active]
+            active = active[resid > tol]
+            if active.size == 0:
+                break
+            iters[active] += 1
+
+            Pa = P[:,active]
+            Q = np.asarray(G * Pa)
+            alpha = rz[active] / (Pa*Q).sum(0)
+            X[:,active] += Pa*alpha
+            R[:,active] -= Q*alpha
+            del Pa, Q
+
+            for col in active:
+                Z[:,col] = psolve(R[:,col])
+            rz_new = (R[:,active]*Z[:,active]).sum(0)
+            beta = rz_new / rz[active]
+            P[:,active] = Z[:,active] + P[:,active]*beta
+            rz[active] = rz_new
+        else:
+            resid = np.sqrt((R[:,active]**2).sum(0)) / bnorm[active]
+            active = active[resid > tol]
+
+        return X, active, iters.tolist()
 
-        return x 
- 
          
     @staticmethod
     @print_rusage
@@ -160,11 +370,88 @@ class ComputeBase(object):
         return G
 
 
+    @staticmethod
+    def ground_reference_node(G, ref=0):
+        """Grounds node ref of the Laplacian of a connected component in place.
+        
+        Doubling the diagonal entry of ref makes G positive definite. For any rhs that sums to zero,
+        the solution has zero voltage at ref and is otherwise the same as that of the ungrounded
+        Laplacian, so one grounded matrix (and its AMG hierarchy) can be used for all focal pairs
+        in the component.
+        """
+        G[ref, ref] = 2 * G[ref, ref] if (G[ref, ref] != 0) else 1 # a lone node has nothing to double
+        return G
+
+
+    @staticmethod
+    def ground_floating_components(G):
+        """Grounds components of a grounded Laplacian that have no connection to ground.
+        
+        Iterative solvers leave such components at zero voltage when no current is injected
+        into them, but they make G singular for direct solvers. Adding a unit diagonal to their
+        nodes gives the same zero voltages and a matrix that can be factored.
+        """
+        (_num_components, C) = connected_components(G)
+        diag = G.diagonal()
+        rowsums = np.asarray(G.sum(1)).flatten()
+        grounded = np.unique(C[rowsums > 1e-8 * np.abs(diag)])
+        floating = np.logical_not(np.in1d(C, grounded))
+        if not np.any(floating):
+            return G
+        n = G.shape[0]
+        return G + sparse.spdiags(np.where(floating, 1, 0), 0, n, n)
+
+
     @staticmethod
     def grid_to_graph (x, y, node_map):
         """Returns node corresponding to x-y coordinates in input grid."""  
         return node_map[x, y] - 1
         
+    @staticmethod
+    def node_values(node_names, named_values, default):
+        """Returns the value at each of node_names from rows of node name and value, or default for nodes not listed.
+        
+        Nodes are looked up by binary search. Where a node is listed more than once, its last value is used.
+        """
+        values = default * np.ones(node_names.size)
+        if (node_names.size == 0) or (named_values.shape[0] == 0):
+            return values
+        # keep only the last row of each node, as assignment through repeated indices has no defined order
+        (_names, last_rows) = np.unique(named_values[::-1,0], return_index=True)
+        named_values = named_values[named_values.shape[0] - 1 - last_rows]
+        order = np.argsort(node_names)
+        idxs = order[np.minimum(np.searchsorted(node_names, named_values[:,0], sorter=order), node_names.size-1)]
+        found = (node_names[idxs] == named_values[:,0])
+        values[idxs[found]] = named_values[found,1]
+        return values
+
+    @staticmethod
+    def replace_values(arr, old_values, new_values):
+        """Returns a copy of arr with each of old_values replaced by the matching new value.
+
+        Values are replaced in a single pass, through a lookup table indexed by value when the range of
+        values is no larger than arr, and by binary search of the old values otherwise.
+        """
+        arr = np.asarray(arr)
+        old_values = np.asarray(old_values, dtype=arr.dtype)
+        new_values = np.asarray(new_values)
+        if old_values.size == 0:
+            return arr.copy()
+        dtype = np.result_type(arr, new_values)
+        lo = min(arr.min(), old_values.min())
+        hi = max(arr.max(), old_values.max())
+        if (int(hi) - int(lo)) < arr.size:
+            table = np.arange(lo, hi+1, dtype=dtype)
+            table[old_values-lo] = new_values
+            return table[arr-lo]
+
+        order = np.argsort(old_values)
+        idxs = order[np.minimum(np.searchsorted(old_values, arr, sorter=order), old_values.size-1)]
+        found = (old_values[idxs] == arr)
+        replaced = arr.astype(dtype)
+        replaced[found] = new_values[idxs[found]]
+        return replaced
+
     
     @staticmethod
     def elapsed_time(startTime): 
@@ -217,76 +504,113 @@ class ComputeBase(object):
 
 
 class IncludeExcludePairs:
-    """Represents a set of focal points that are to be included/excluded during computation"""
+    """Represents a set of focal points that are to be included/excluded during computation
+    
+    Pairs are indexed by a symmetric boolean CSR matrix of linked point ids, whose rows hold
+    the sorted ids linked with each point id.
+    """
     def __init__(self, filename):
         mode, point_ids, mat = CSIO.read_included_pairs(filename)
         self.is_include = (mode == "include")
         self.point_ids = point_ids
-        self.mat = mat.tocoo()
+        self.mat = mat.tocsr()
         self.max_id = int(np.max(point_ids)) + 1
-
-    def has_pair(self, r, c):
-        if not ((r < self.max_id) and (c < self.max_id)):
-            return 0
-        has_rows = (self.mat.row == r)
-        if not any(has_rows):
-            return 0
-        has_cols = (self.mat.col[has_rows] == c)
-        if not any(has_rows):
-            return 0
-        valid_data = self.mat.data[has_rows]
-        return np.sum(valid_data[has_cols])
+        self._index()
+
+    def _index(self):
+        mat = self.mat.tocoo()
+        rows = mat.row[mat.data != 0]
+        cols = mat.col[mat.data != 0]
+        linked = sparse.csr_matrix((np.ones(2*rows.size, bool), (np.append(rows, cols), np.append(cols, rows))), shape=mat.shape)
+        linked.sum_duplicates()
+        self.linked = linked
+        self.point_id_set = set(self.point_ids.tolist())
+
+    def _linked_ids_of(self, r):
+        if not ((r >= 0) and (r < self.linked.shape[0])):
+            return np.array([], int)
+        r = int(r)
+        return self.linked.indices[self.linked.indptr[r]:self.linked.indptr[r+1]]
 
     def get_possible_pair(self, r):
-        pt2list = np.array([])
-        
-        if (r >= self.max_id):
-            return pt2list
-        
-        has_ids = np.where(self.mat.row == r)
-        if np.any(has_ids):
-            pt2list = np.append(pt2list, self.mat.col[has_ids])
-        
-        has_ids = np.where(self.mat.col == r)
-        if np.any(has_ids):
-            pt2list = np.append(pt2list, self.mat.row[has_ids])
-        
-        pt2list = np.unique(pt2list)
-        return pt2list[np.where(pt2list > r)]
-        
-
-    def has(self, r):
-        if not (r < self.max_id):
-            return 0
-        has_rows = (self.mat.row == r)
-        has_cols = (self.mat.col == r)
-        has_any = has_rows | has_cols
-        if not np.any(has_any):
-            return 0
-        return np.sum(self.mat.data[has_any])
+        """Returns the sorted ids greater than r that are paired with r."""
+        pt2list = self._linked_ids_of(r)
+        return pt2list[pt2list > r]
 
     def is_included_pair(self, point_id1, point_id2):
-        return ((self.has_pair(point_id1, point_id2) + self.has_pair(point_id2, point_id1)) > 0) == self.is_include
+        pt2list = self._linked_ids_of(point_id1)
+        idx = np.searchsorted(pt2list, point_id2)
+        return ((idx < pt2list.size) and (pt2list[idx] == point_id2)) == self.is_include
 
     def is_included(self, point_id):
-        return ((self.has(point_id) > 0) == self.is_include)
+        return (self._linked_ids_of(point_id).size > 0) == self.is_include
     
     def is_present(self, point_id):
-        return (point_id in self.point_ids)
+        return (point_id in self.point_id_set)
+
+    def get_included_pairs_of(self, point_id, point_ids):
+        """Returns a boolean array of whether each of point_ids is in an included pair with point_id."""
+        return np.in1d(point_ids, self._linked_ids_of(point_id)) == self.is_include
+
+    def get_linked_pair_idxs(self, point_ids):
+        """Returns index arrays (idx1, idx2) into point_ids of all pairs listed in the file with idx1 < idx2, in row-major order."""
+        point_ids = np.asarray(point_ids).astype(int)
+        in_mat = np.flatnonzero((point_ids >= 0) & (point_ids < self.linked.shape[0]))
+        sub = self.linked[point_ids[in_mat],:][:,point_ids[in_mat]].tocoo()
+        (idx1, idx2) = (in_mat[sub.row], in_mat[sub.col])
+        upper = (idx1 < idx2)
+        (idx1, idx2) = (idx1[upper], idx2[upper])
+        order = np.lexsort((idx2, idx1))
+        return (idx1[order], idx2[order])
+
+    def get_included_pair_idxs(self, point_ids):
+        """Returns index arrays (idx1, idx2) into point_ids of all included pairs with idx1 < idx2, in row-major order."""
+        (idx1, idx2) = self.get_linked_pair_idxs(point_ids)
+        if self.is_include:
+            return (idx1, idx2)
+        # in exclude mode, each row holds the indices after it that it is not linked with
+        numpoints = len(point_ids)
+        if numpoints == 0:
+            return (idx1, idx2)
+        bounds = np.searchsorted(idx1, np.arange(0, numpoints+1))
+        rows = []
+        cols = []
+        for pt1_idx in range(0, numpoints):
+            others = np.arange(pt1_idx+1, numpoints)
+            others = others[~np.in1d(others, idx2[bounds[pt1_idx]:bounds[pt1_idx+1]])]
+            rows.append(np.repeat(pt1_idx, others.size))
+            cols.append(others)
+        return (np.concatenate(rows), np.concatenate(cols))
+
+    def has_pair(self, r, c):
+        """Returns the sum of the entries of the file pairing r with c, in that order.
+        Deprecated, use is_included_pair or get_included_pair_idxs instead."""
+        warnings.warn('IncludeExcludePairs.has_pair is deprecated, use is_included_pair instead', DeprecationWarning, stacklevel=2)
+        if not ((0 <= r < self.mat.shape[0]) and (0 <= c < self.mat.shape[1])):
+            return 0
+        return self.mat[r, c]
+
+    def has(self, r):
+        """Returns the sum of the entries of the file pairing r with any point.
+        Deprecated, use is_included instead."""
+        warnings.warn('IncludeExcludePairs.has is deprecated, use is_included instead', DeprecationWarning, stacklevel=2)
+        if not (0 <= r < min(self.mat.shape)):
+            return 0
+        return self.mat.getrow(r).sum() + self.mat.getcol(r).sum() - self.mat[r, r]
     
     def delete_point(self, point_id):
         if(point_id < self.max_id):
-            keep_idxs = (self.mat.col != point_id) & (self.mat.row != point_id)
-            self.mat.data = self.mat.data[keep_idxs]
-            self.mat.row = self.mat.row[keep_idxs]
-            self.mat.col = self.mat.col[keep_idxs]
-            self.point_ids = self.point_ids[self.point_ids != point_id]
+            self.keep_only_points(self.point_ids[self.point_ids != point_id])
 
     def keep_only_points(self, points):
-        ptids = self.point_ids.copy()
-        for point_id in ptids:
-            if point_id not in points:
-                self.delete_point(point_id)
+        keep_ids = np.zeros(max(self.max_id, self.mat.shape[0]), bool)
+        points = np.asarray(points).astype(int)
+        keep_ids[points[(points >= 0) & (points < keep_ids.size)]] = True
+        mat = self.mat.tocoo()
+        keep_idxs = keep_ids[mat.row] & keep_ids[mat.col]
+        self.mat = sparse.csr_matrix((mat.data[keep_idxs], (mat.row[keep_idxs], mat.col[keep_idxs])), shape=mat.shape)
+        self.point_ids = self.point_ids[np.in1d(self.point_ids, points)]
+        self._index()
 
 class FocalPoints:
     """Represents a set of focal points and associate logic to work with them"""
@@ -311,24 +635,15 @@ class FocalPoints:
         if self.incl_pairs is None:
             return
 
-        idx = 0
-        _drop_flag = False
-        
         if self.is_network:
-            while idx < self.point_ids.size: #Prune out any points not in includeList
-                if self.incl_pairs.is_present(self.point_ids[idx]):
-                    idx += 1
-                else:
-                    _drop_flag = True   
-                    self.point_ids = np.delete(self.point_ids, idx)
+            present = np.array([self.incl_pairs.is_present(pt_id) for pt_id in self.point_ids], bool) #Prune out any points not in includeList
+            _drop_flag = not np.all(present)
+            self.point_ids = self.point_ids[present]
             self.incl_pairs.keep_only_points(self.point_ids)
         else:
-            while idx < self.points_rc.shape[0]:
-                if self.incl_pairs.is_present(self.points_rc[idx, 0]):
-                    idx += 1
-                else:
-                    _drop_flag = True
-                    self.points_rc = ComputeBase.deleterow(self.points_rc, idx)
+            present = np.array([self.incl_pairs.is_present(pt_id) for pt_id in self.points_rc[:,0]], bool)
+            _drop_flag = not np.all(present)
+            self.points_rc = self.points_rc[present]
             self.incl_pairs.keep_only_points(self.points_rc[:,0])
             
         if _drop_flag==True:
@@ -448,11 +763,16 @@ class FocalPoints:
                 yield(n1_idx, -1)
         else:        
             numpoints = self.point_ids.size
+            if self.incl_pairs is not None:
+                (idx1, idx2) = self.incl_pairs.get_included_pair_idxs(self.point_ids)
+                bounds = np.searchsorted(idx1, np.arange(0, numpoints+1))
             
             for pt1_idx in range(0, numpoints): 
-                for pt2_idx in range(pt1_idx+1, numpoints):
-                    if (self.incl_pairs is not None) and not self.incl_pairs.is_included_pair(self.point_ids[pt1_idx], self.point_ids[pt2_idx]):
-                        continue
+                if self.incl_pairs is not None:
+                    pt2_idxs = idx2[bounds[pt1_idx]:bounds[pt1_idx+1]].tolist()
+                else:
+                    pt2_idxs = range(pt1_idx+1, numpoints)
+                for pt2_idx in pt2_idxs:
                     yield (pt1_idx, pt2_idx)
                 yield(pt1_idx, -1)
         
@@ -481,32 +801,37 @@ class FocalPoints:
                         yield (n1_idx, n2_idx)
                 yield(n1_idx, -1)
         else:        
-            numpoints = self.points_rc.shape[0]
-            for pt1_idx in range(0, numpoints): 
-                dst = self.get_graph_node_idx(pt1_idx, node_map)
-                if (dst <  0 or components[dst] != comp):
-                    continue
-                if (self.incl_pairs is not None):
-                    ccv = self.points_rc[:, 0]
-                    inc = np.array([])
-                    for pt in self.incl_pairs.get_possible_pair(self.points_rc[pt1_idx, 0]):
-                        cc = np.where(ccv == pt)
-                        if len(cc) > 0:
-                            inc = np.append(inc, cc[0])
+            nodes = self.grid_to_graph(self.points_rc[:,1], self.points_rc[:,2], node_map)
+            in_comp = np.flatnonzero(nodes >= 0)
+            in_comp = in_comp[components[nodes[in_comp]] == comp]
+            if self.incl_pairs is not None:
+                # included pairs of the component at once, each under the point with the lower id and ordered by the other id
+                ids = self.points_rc[in_comp, 0]
+                (idx1, idx2) = self.incl_pairs.get_included_pair_idxs(ids)
+                swap = (ids[idx1] > ids[idx2])
+                (idx1, idx2) = (np.where(swap, idx2, idx1), np.where(swap, idx1, idx2))
+                distinct = (ids[idx1] != ids[idx2])
+                (idx1, idx2) = (idx1[distinct], idx2[distinct])
+                order = np.lexsort((idx2, ids[idx2], idx1))
+                (idx1, idx2) = (idx1[order], in_comp[idx2[order]])
+                bounds = np.searchsorted(idx1, np.arange(0, in_comp.size+1))
+            
+            for (comp_idx, pt1_idx) in enumerate(in_comp.tolist()):
+                if self.incl_pairs is not None:
+                    pt2_idxs = idx2[bounds[comp_idx]:bounds[comp_idx+1]].tolist()
                 else:
-                    inc = range(pt1_idx+1, numpoints)
-
-                for pt2_idx in inc:
-                    src = self.get_graph_node_idx(pt2_idx, node_map)
-                    if (src >=  0 and components[src] == comp):
-                        yield (pt1_idx, pt2_idx)
+                    pt2_idxs = in_comp[comp_idx+1:].tolist()
+                for pt2_idx in pt2_idxs:
+                    yield (pt1_idx, pt2_idx)
                 yield(pt1_idx, -1)
 
 
 
 
 class HabitatGraph:
-    def __init__(self, g_map=None, poly_map=None, connect_using_avg_resistances=False, connect_four_neighbors_only=False, g_graph=None, node_names=None):
+    def __init__(self, g_map=None, poly_map=None, connect_using_avg_resistances=False, connect_four_neighbors_only=False, g_graph=None, node_names=None, cache=None):
+        self.cache = cache
+        self.cache_key = None
         if g_map is not None:
             self.is_network = False
             self.g_map = g_map
@@ -514,8 +839,19 @@ class HabitatGraph:
             self.connect_using_avg_resistances = connect_using_avg_resistances
             self.connect_four_neighbors_only = connect_four_neighbors_only
             
-            self.node_map = HabitatGraph._construct_node_map(g_map, poly_map)
-            (component_map, components) = HabitatGraph._construct_component_map(g_map, self.node_map, connect_using_avg_resistances, connect_four_neighbors_only)
+            self.g_laplacian = None         # built when first needed if the graph is taken from the cache
+            
+            cached = None
+            if cache is not None:
+                self.cache_key = CSCache.key(g_map, (poly_map if (poly_map != []) else None), connect_using_avg_resistances, connect_four_neighbors_only)
+                cached = cache.load('graph', self.cache_key)
+            if cached is not None:
+                (self.node_map, component_map, components) = cached
+            else:
+                self.node_map = HabitatGraph._construct_node_map(g_map, poly_map)
+                (component_map, components, self.g_laplacian) = HabitatGraph._construct_component_map(g_map, self.node_map, connect_using_avg_resistances, connect_four_neighbors_only)
+                if cache is not None:
+                    cache.store('graph', self.cache_key, (self.node_map, component_map, components))
             self.component_map = component_map
             self.components = components
             
@@ -524,7 +860,10 @@ class HabitatGraph:
         else:
             self.is_network = True
             self.g_graph = g_graph          # is the sparse CSR matrix 
+            self.g_laplacian = None
             self.node_map = node_names    # list of node names
+            if cache is not None:
+                self.cache_key = CSCache.key(g_graph, node_names)
             
             (_num_components, C) = connected_components(g_graph)
             C += 1
@@ -532,6 +871,36 @@ class HabitatGraph:
             
             self.num_components = C.max()
             self.num_nodes = self.node_map.size
+        self._component_nodes = None            # node indices grouped by component, built on first use
+        self._component_cells = None            # raster cells grouped by component, built on first use
+    
+    @staticmethod
+    def _group_by_component(idxs, components):
+        """Returns idxs sorted by component, keeping their order within each, and the bounds of each component in them."""
+        order = np.argsort(components, kind='mergesort')
+        bounds = np.searchsorted(components[order], np.arange(1, components.max()+2))
+        return (idxs[order], bounds)
+    
+    def component_nodes(self, keep_component):
+        """Returns the indices of the nodes in keep_component, in increasing order."""
+        if self._component_nodes is None:
+            self._component_nodes = HabitatGraph._group_by_component(np.arange(self.components.size), self.components)
+        (nodes, bounds) = self._component_nodes
+        return nodes[bounds[keep_component-1]:bounds[keep_component]]
+    
+    def component_cells(self, keep_component):
+        """Returns the rows and columns of the raster cells in keep_component, in row-major order.
+        
+        Cells of all components are grouped in one pass over the component map, so that work per
+        component is proportional to its size rather than to the raster.
+        """
+        if self.is_network:
+            raise RuntimeError('Not available in network mode')
+        if self._component_cells is None:
+            cells = np.flatnonzero(self.component_map)
+            self._component_cells = HabitatGraph._group_by_component(cells, self.component_map.flat[cells])
+        (cells, bounds) = self._component_cells
+        return np.unravel_index(cells[bounds[keep_component-1]:bounds[keep_component]], self.component_map.shape)
     
     def get_graph(self):
         if self.is_network:
@@ -539,34 +908,143 @@ class HabitatGraph:
         else:
             return HabitatGraph._construct_g_graph(self.g_map, self.node_map, self.connect_using_avg_resistances, self.connect_four_neighbors_only)
     
+    def get_laplacian(self):
+        """Returns the Laplacian of the whole graph. It is kept, as component Laplacians are sliced from it."""
+        if self.g_laplacian is None:
+            if self.is_network:
+                self.g_laplacian = ComputeBase.laplacian(self.g_graph)
+            else:
+                self.g_laplacian = HabitatGraph._construct_laplacian(self.g_map, self.node_map, self.connect_using_avg_resistances, self.connect_four_neighbors_only)
+        return self.g_laplacian
+    
+    def contract_regions(self, regions):
+        """Returns the graph with the nodes under each of regions contracted into a single node.
+        
+        regions are arrays of flat indices of raster cells. The result is the graph that would be
+        built with each region burned into the polygon map (see Compute.get_overlap_polymap_for_points),
+        with the same numbering of nodes and components, but is derived from this graph. Entries of
+        the Laplacian between nodes that are not contracted are only renumbered, and components
+        touched by a region are joined. Regions sharing a node are contracted together.
+        """
+        node_map = self.node_map
+        groups = []     # nodes and cells of each contracted node
+        for cells in regions:
+            cells = np.asarray(cells)
+            nodes = np.unique(node_map.flat[cells])
+            nodes = nodes[nodes > 0]
+            shared = [np.intersect1d(group_nodes, nodes).size > 0 for (group_nodes, _group_cells) in groups]
+            for (group_nodes, group_cells) in [group for (group, is_shared) in zip(groups, shared) if is_shared]:
+                nodes = np.union1d(nodes, group_nodes)
+                cells = np.concatenate((cells, group_cells))
+            groups = [group for (group, is_shared) in zip(groups, shared) if not is_shared] + [(nodes, cells)]
+        groups = [(nodes, cells) for (nodes, cells) in groups if nodes.size > 0]
+        
+        # nodes are numbered in the order of their first cells, so a contracted node takes the place of its first node
+        numnodes = self.num_nodes
+        contracted_nodes = np.zeros(numnodes+1, dtype=bool)
+        node_table = np.arange(numnodes+1, dtype='int32')
+        for (nodes, _cells) in groups:
+            node_table[nodes] = nodes[0]
+            contracted_nodes[nodes] = True
+        used = np.zeros(numnodes+1, dtype=bool)
+        used[node_table[1:]] = True
+        node_table = np.cumsum(used, dtype='int32')[node_table]
+        num_contracted = node_table.max()
+        idx_table = node_table[1:] - 1
+        contracted_nodes = contracted_nodes[1:]
+        
+        L = self.get_laplacian()
+        def row_entries(rows):
+            counts = L.indptr[rows+1] - L.indptr[rows]
+            return (np.arange(counts.sum()) + np.repeat(L.indptr[rows] - np.cumsum(counts) + counts, counts), np.repeat(rows, counts))
+        
+        # entries of contracted nodes, found from their rows and, as the Laplacian is symmetric, their neighbors' rows
+        contracted_rows = np.flatnonzero(contracted_nodes)
+        (touched, touched_rows) = row_entries(contracted_rows)
+        (neighbor_entries, neighbor_rows) = row_entries(np.setdiff1d(L.indices[touched], contracted_rows))
+        to_contracted = contracted_nodes[L.indices[neighbor_entries]]
+        touched = np.concatenate((touched, neighbor_entries[to_contracted]))
+        touched_rows = np.concatenate((touched_rows, neighbor_rows[to_contracted]))
+        
+        # other entries are only renumbered
+        kept = np.ones(L.nnz, dtype=bool)
+        kept[touched] = False
+        row_counts = np.zeros(num_contracted, dtype=L.indptr.dtype)
+        row_counts[idx_table] = np.diff(L.indptr) - np.bincount(touched_rows, minlength=numnodes)
+        indptr = np.concatenate(([0], np.cumsum(row_counts))).astype(L.indptr.dtype)
+        G = sparse.csr_matrix((L.data[kept], idx_table[L.indices[kept]], indptr), shape=(num_contracted, num_contracted))
+        
+        # conductances from contracted nodes are summed, except those within them, which are dropped with the old degrees
+        (rows, cols, vals) = (idx_table[touched_rows], idx_table[L.indices[touched]], L.data[touched])
+        off_diag = (rows != cols)
+        G_touched = sparse.csr_matrix((vals[off_diag], (rows[off_diag], cols[off_diag])), shape=(num_contracted, num_contracted))
+        group_idxs = np.array([idx_table[nodes[0]-1] for (nodes, _cells) in groups], dtype=idx_table.dtype)
+        degrees = -np.asarray(G_touched[group_idxs, :].sum(axis=1)).ravel()
+        G = G + (G_touched + sparse.csr_matrix((degrees, (group_idxs, group_idxs)), shape=(num_contracted, num_contracted)))
+        
+        # components are numbered in the order of their first nodes too, which joining them keeps
+        comp_table = np.arange(self.num_components+1, dtype='int32')
+        for (nodes, _cells) in groups:
+            comps = np.unique(comp_table[self.components[nodes-1]])
+            comp_table[np.in1d(comp_table, comps)] = comps[0]
+        used = np.zeros(self.num_components+1, dtype=bool)
+        used[comp_table[1:]] = True
+        comp_table = np.cumsum(used, dtype='int32')[comp_table]
+        
+        contracted = copy.copy(self)
+        contracted.cache = contracted.cache_key = None
+        contracted.g_laplacian = G
+        contracted.node_map = node_table[node_map]
+        contracted.component_map = comp_table[self.component_map]
+        contracted.components = np.zeros(num_contracted, dtype=self.components.dtype)
+        contracted.components[idx_table] = comp_table[self.components]
+        for (nodes, cells) in groups:
+            contracted.node_map.flat[cells] = node_table[nodes[0]]
+            contracted.component_map.flat[cells] = comp_table[self.components[nodes[0]-1]]
+        contracted.num_components = contracted.components.max()
+        contracted.num_nodes = num_contracted
+        contracted._component_nodes = contracted._component_cells = None
+        return contracted
+    
     def prune_for_component(self, keep_component, arr):
         if not self.is_network:
             raise RuntimeError('Not available in raster mode')
-        indices = np.where(self.components == keep_component)
-        return arr[indices]
+        return arr[self.component_nodes(keep_component)]
     
     def prune_nodes_for_component(self, keep_component):
         """Removes nodes outside of component being operated on.
         
-        Returns node map and adjacency matrix that only include nodes in keep_component.
+        Returns node map and Laplacian that only include nodes in keep_component. The Laplacian is
+        sliced from that of the whole graph, so that the work is proportional to the size of the
+        component. Nodes keep their order, which numbers them as a graph built from the component
+        alone would. In raster mode the node map is a ComponentNodeMap of the cells of the component.
         """
+        nodes = self.component_nodes(keep_component)
+        rows = self.get_laplacian()[nodes, :]
+        # all neighbors of the nodes are in the component, so only column numbers change
+        G_pruned = sparse.csr_matrix((rows.data, np.searchsorted(nodes, rows.indices), rows.indptr), shape=(nodes.size, nodes.size))
+        
         if self.is_network:
-            del_indices = np.where(self.components != keep_component)
-            pruned_graph = ComputeBase.deleterowcol(self.g_graph, delrow=del_indices, delcol=del_indices)
-            return (pruned_graph, self.prune_for_component(keep_component, self.node_map))
-        else:
-            selector = self.component_map == keep_component
+            return (G_pruned, self.node_map[nodes])
+        
+        (cell_rows, cell_cols) = self.component_cells(keep_component)
+        local_nodes = (np.searchsorted(nodes, self.node_map[cell_rows, cell_cols]-1) + 1).astype('int32')
+        return (G_pruned, ComponentNodeMap(cell_rows, cell_cols, local_nodes, self.node_map.shape))
             
-            g_map_pruned = selector * self.g_map
-            poly_map_pruned = []
-            if self.poly_map !=  []:
-                poly_map_pruned = selector * self.poly_map
     
-            node_map_pruned = HabitatGraph._construct_node_map(g_map_pruned, poly_map_pruned)
-            G_pruned = HabitatGraph._construct_g_graph(g_map_pruned, node_map_pruned, self.connect_using_avg_resistances, self.connect_four_neighbors_only)
-             
-            return (G_pruned, node_map_pruned)
-            
+    def laplacian_for_component(self, keep_component):
+        """Returns the Laplacian and node map of component keep_component, from the cache if possible."""
+        if self.cache is not None:
+            key = CSCache.key(self.cache_key, keep_component)
+            cached = self.cache.load('laplacian', key)
+            if cached is not None:
+                return cached
+        
+        (G, node_map) = self.prune_nodes_for_component(keep_component)
+        if self.cache is not None:
+            self.cache.store('laplacian', key, (G, node_map))
+        return (G, node_map)
+    
     
     def unique_component_with_points(self, point_map):
         components_with_points = self.components_with_points(point_map)
@@ -591,20 +1069,21 @@ class HabitatGraph:
         if poly_map == []:
             return node_map
 
-        # Remove extra points from poly_map that are not in g_map
-        poly_map_pruned = np.zeros(g_map.shape, dtype='int32')
-        poly_map_pruned[np.where(g_map)] = poly_map[np.where(g_map)]
-        
-        polynums = np.unique(poly_map)
-   
-        for i in range(0, polynums.size):
-            polynum = polynums[i]
-            if polynum !=  0:
-                (pi, pj) = np.where(poly_map_pruned == polynum) #
-                (pk, pl) = np.where(poly_map == polynum) #Added 040309 BHM                
-                if len(pi) > 0:  
-                    node_map[pk, pl] = node_map[pi[0], pj[0]] #Modified 040309 BHM  
-        node_map[np.where(node_map)] = ComputeBase.relabel(node_map[np.where(node_map)], 1) #BHM 072409
+        # All cells of a polygon take the node of its first cell with non-zero conductance, if it has one
+        poly_cells = np.flatnonzero(poly_map)
+        (polynums, cell_polys) = np.unique(np.asarray(poly_map).flat[poly_cells], return_inverse=True)
+        in_habitat = (g_map.flat[poly_cells] != 0)
+        (habitat_polys, first_cells) = np.unique(cell_polys[in_habitat], return_index=True)
+        poly_nodes = np.zeros(polynums.size, dtype='int32')
+        poly_nodes[habitat_polys] = node_map.flat[poly_cells[in_habitat][first_cells]]
+        merged = (poly_nodes[cell_polys] != 0)
+        node_map.flat[poly_cells[merged]] = poly_nodes[cell_polys[merged]]
+
+        # Renumber the remaining nodes consecutively, through a table from old node numbers to new
+        used = np.zeros(node_map.max()+1, dtype=bool)
+        used[node_map] = True
+        used[0] = False
+        node_map = np.cumsum(used, dtype='int32')[node_map]
 
         return node_map
 
@@ -615,9 +1094,9 @@ class HabitatGraph:
         """Assigns component numbers to grid corresponding to pixels with non-zero conductances.
         
         Nodes with the same component number are in single, connected components.
-        
+        Also returns the component of each node and the Laplacian they were found from.
         """  
-        G = HabitatGraph._construct_g_graph(g_map, node_map, connect_using_avg_resistances, connect_four_neighbors_only) 
+        G = HabitatGraph._construct_laplacian(g_map, node_map, connect_using_avg_resistances, connect_four_neighbors_only) 
         (_num_components, C) = connected_components(G)
         C += 1 # Number components from 1
 
@@ -627,7 +1106,7 @@ class HabitatGraph:
         component_map = np.zeros(node_map.shape, dtype = 'int32')
         component_map[I, J] = C[nodes-1]
 
-        return (component_map, C)
+        return (component_map, C, G)
     
     @staticmethod
     @print_rusage
@@ -644,6 +1123,45 @@ class HabitatGraph:
         
         return g_graph
 
+    @staticmethod
+    @print_rusage
+    def _construct_laplacian(g_map, node_map, connect_using_avg_resistances, connect_four_neighbors_only):
+        """Construct sparse Laplacian given raster maps of conductances and nodes.
+        
+        Degrees are summed with bincount, and the matrix is sorted into CSR by rows once, from coordinate
+        arrays holding both triangles and the diagonal, rather than built from sums of sparse
+        matrices. Conductances within a node (between cells of a polygon) are dropped, and those
+        between the same nodes add up, as in the Laplacian of the graph from _construct_g_graph.
+        Arrays are released as soon as they are used, which keeps the peak memory down.
+        """
+        numnodes = node_map.max()
+        (node1, node2, conductances) = HabitatGraph._get_conductances(g_map, node_map, connect_using_avg_resistances, connect_four_neighbors_only)
+        keep = np.logical_and(node1 != node2, conductances != 0)
+        if not np.all(keep):
+            (node1, node2, conductances) = (node1[keep], node2[keep], conductances[keep])
+        del keep
+        degrees = np.bincount(node1, conductances, numnodes) + np.bincount(node2, conductances, numnodes)
+        diag = np.flatnonzero(degrees).astype(node1.dtype)
+        
+        nnz = 2*node1.size + diag.size
+        idx_dtype = np.int32 if (nnz < np.iinfo(np.int32).max) else np.int64
+        rows = np.concatenate((node1, node2, diag)).astype(idx_dtype, copy=False)
+        cols = np.concatenate((node2, node1, diag)).astype(idx_dtype, copy=False)
+        del node1, node2
+        values = np.concatenate((conductances, conductances, degrees[diag]))
+        values[0:2*conductances.size] *= -1
+        del conductances, degrees, diag
+        
+        # entries are put in CSR order by row only, with duplicates added up within each row afterwards
+        indptr = np.zeros(numnodes+1, dtype=idx_dtype)
+        np.cumsum(np.bincount(rows, minlength=numnodes), out=indptr[1:])
+        order = np.argsort(rows, kind='mergesort')
+        del rows
+        G = sparse.csr_matrix((values[order], cols[order], indptr), shape=(numnodes, numnodes))
+        del cols, values, order
+        G.sum_duplicates() # in place
+        return G
+
 
     @staticmethod
     def _neighbors_horiz(g_map):
@@ -763,6 +1281,31 @@ class HabitatGraph:
         return (node1, node2, conductances)
 
 
+class ComponentNodeMap(object):
+    """Node map of one component of a raster habitat, holding only the cells of the component.
+    
+    Cells are kept as their rows and columns in row-major order, with the node numbers they have
+    within the component (from 1). It is indexed by rows and columns like a raster node map, with
+    0 for cells outside of the component, but its size is that of the component.
+    """
+    def __init__(self, rows, cols, nodes, shape):
+        self.rows = rows
+        self.cols = cols
+        self.nodes = nodes
+        self.shape = shape
+        self.cells = np.ravel_multi_index((rows, cols), shape)
+    
+    def __getitem__(self, idx):
+        (rows, cols) = idx
+        cells = np.ravel_multi_index((rows, cols), self.shape)
+        pos = np.minimum(np.searchsorted(self.cells, cells), self.cells.size-1)
+        nodes = np.where(self.cells[pos] == cells, self.nodes[pos], 0)
+        return nodes if (nodes.ndim > 0) else int(nodes)
+    
+    def max(self):
+        return self.nodes.max()
+
+
 class Output:
     """Handles output of current and voltage maps"""
     def __init__(self, options, state, report_status, node_names=None):
@@ -776,6 +1319,7 @@ class Output:
         self.scenario = self.options.scenario
         self.voltage_maps = {}
         self.current_maps = {}
+        self.lock = threading.Lock()    # held while updating cumulative maps, which parallel solves update from several threads
 
 
     def get_c_map(self, name, remove=False):
@@ -798,26 +1342,67 @@ class Output:
             self.rm_c_map(name)
             
     def store_max_c_map_values(self, max_name, values):
-        self.current_maps[max_name] = np.maximum(self.current_maps[max_name], values)
+        with self.lock:
+            self.current_maps[max_name] = np.maximum(self.current_maps[max_name], values)
 
     def accumulate_c_map_from(self, name, fromname):
         self.accumulate_c_map_with_values(name, self.current_maps[fromname])
     
+    def c_map_values(self, name):
+        """Returns the current map identified by name in the form taken by accumulate_c_map_with_values."""
+        if self.is_network:
+            (branch_currents, node_currents, _bca, _node_map) = self.current_maps[name]
+            return (None, node_currents, Output._convert_graph_to_3_col(branch_currents, self.nn_sorted), self.nn_sorted)
+        return self.current_maps[name]
+
     def accumulate_c_map_with_values(self, name, values):
         if self.is_network:
             _branch_currents, node_currents, branch_currents_array, node_map = values
-            full_branch_currents, full_node_currents, _bca, _np = self.current_maps[name]
             pos = np.searchsorted(self.nn_sorted, node_map)
-            full_node_currents[pos] += node_currents
             bc_x = np.searchsorted(self.nn_sorted, branch_currents_array[:,0])
             bc_y = np.searchsorted(self.nn_sorted, branch_currents_array[:,1])            
-            full_branch_currents = full_branch_currents + sparse.csr_matrix((branch_currents_array[:,2], (bc_x, bc_y)), shape=full_branch_currents.shape)
-            self.current_maps[name] = (full_branch_currents, full_node_currents, branch_currents_array, node_map)
+            with self.lock:
+                full_branch_currents, full_node_currents, _bca, _np = self.current_maps[name]
+                full_node_currents[pos] += node_currents
+                full_branch_currents = full_branch_currents + sparse.csr_matrix((branch_currents_array[:,2], (bc_x, bc_y)), shape=full_branch_currents.shape)
+                self.current_maps[name] = (full_branch_currents, full_node_currents, branch_currents_array, node_map)
         else:
-            self.current_maps[name] += values
+            with self.lock:
+                self.current_maps[name] += values
             
-    def accumulate_c_map(self, name, voltages, G, node_map, finitegrounds, local_src, local_dst):
-        self._write_store_c_map(name, False, False, True, voltages, G, node_map, finitegrounds, local_src, local_dst)
+    def accumulate_c_map_at_cells(self, name, cells, values, max_name=None, max_values=None):
+        """Adds values to the map identified by name at cells, flat indices of raster cells, and keeps
+        max_values at cells in that identified by max_name if given (raster mode only)."""
+        with self.lock:
+            self.current_maps[name].flat[cells] += values
+            if max_name is not None:
+                max_map = self.current_maps[max_name]
+                max_map.flat[cells] = np.maximum(max_map.flat[cells], max_values)
+
+    def component_currents(self, voltages, G, node_map, finitegrounds):
+        """Returns the currents from voltages of one component, in the form taken by accumulate_component_currents.
+        Only the cells of the component are returned in raster mode, rather than a raster of its own."""
+        if self.is_network:
+            (node_currents, branch_currents) = self._create_current_maps(voltages, G, finitegrounds)
+            return (None, node_currents, Output._convert_graph_to_3_col(branch_currents, node_map), node_map)
+        while LowMemRetry.retry():
+            with LowMemRetry():
+                (rows, cols, _nodes, cell_currents) = self._create_current_maps(voltages, G, finitegrounds, node_map)
+        return (rows, cols, cell_currents)
+
+    def accumulate_component_currents(self, name, currents):
+        """Adds currents returned by component_currents to the map identified by name."""
+        if self.is_network:
+            self.accumulate_c_map_with_values(name, currents)
+        else:
+            (rows, cols, cell_currents) = currents
+            with self.lock:
+                self.current_maps[name][rows, cols] += cell_currents
+
+    def accumulate_c_map(self, name, voltages, G, node_map, finitegrounds, local_src, local_dst, max_name=None):
+        """Adds the currents from voltages to the map identified by name, and keeps their maximum in that
+        identified by max_name if given (raster mode only)."""
+        self._write_store_c_map(name, False, False, True, voltages, G, node_map, finitegrounds, local_src, local_dst, max_name)
 
     def store_c_map(self, name, voltages, G, node_map, finitegrounds, local_src, local_dst):
         self._write_store_c_map(name, False, False, False, voltages, G, node_map, finitegrounds, local_src, local_dst)
@@ -825,7 +1410,7 @@ class Output:
     def write_c_map(self, name, remove=False, voltages=None, G=None, node_map=None, finitegrounds=None, local_src=None, local_dst=None):
         self._write_store_c_map(name, remove, True, False, voltages, G, node_map, finitegrounds, local_src, local_dst)
         
-    def _write_store_c_map(self, name, remove, write, accumulate, voltages, G, node_map, finitegrounds, local_src, local_dst):
+    def _write_store_c_map(self, name, remove, write, accumulate, voltages, G, node_map, finitegrounds, local_src, local_dst, max_name=None):
         if self.is_network:
             if voltages is not None:
                 (node_currents, branch_currents) = self._create_current_maps(voltages, G, finitegrounds)
@@ -842,29 +1427,35 @@ class Output:
             if remove:
                 self.rm_c_map(name)
             elif accumulate:
-                full_branch_currents, full_node_currents, _bca, _np = self.current_maps[name]
-                pos = np.searchsorted(self.nn_sorted, node_map)
-                full_node_currents[pos] += node_currents
-                bc_x = np.searchsorted(self.nn_sorted, branch_currents_array[:,0])
-                bc_y = np.searchsorted(self.nn_sorted, branch_currents_array[:,1])                
-                full_branch_currents = full_branch_currents + sparse.csr_matrix((branch_currents_array[:,2], (bc_x, bc_y)), shape=full_branch_currents.shape)
-                self.current_maps[name] = (full_branch_currents, full_node_currents, branch_currents_array, node_map)
+                self.accumulate_c_map_with_values(name, (branch_currents, node_currents, branch_currents_array, node_map))
             else:
                 self.current_maps[name] = (branch_currents, node_currents, branch_currents_array, node_map)
         else:
+            zero_focal_nodes = (self.options.set_focal_node_currents_to_zero==True) and (local_src is not None) and (local_dst is not None)
             if voltages is not None:
                 while LowMemRetry.retry():
                     with LowMemRetry():
-                        current_map = self._create_current_maps(voltages, G, finitegrounds, node_map)   
+                        (rows, cols, nodes, cell_currents) = self._create_current_maps(voltages, G, finitegrounds, node_map)
+                if zero_focal_nodes:
+                    # set source and target node currents to zero
+                    cell_currents[(nodes == local_src+1) | (nodes == local_dst+1)] = 0
+                if accumulate:
+                    # only the cells with nodes are added to, without a raster of their own
+                    with self.lock:
+                        self.current_maps[name][rows, cols] += cell_currents
+                        if max_name is not None:
+                            max_map = self.current_maps[max_name]
+                            max_map[rows, cols] = np.maximum(max_map[rows, cols], cell_currents)
+                    return
+                current_map = np.zeros((self.state.nrows, self.state.ncols), dtype='float64')
+                current_map[rows, cols] = cell_currents
             else:
-                current_map = self.current_maps[name]                                                                                
-    
-            if (self.options.set_focal_node_currents_to_zero==True) and (local_src is not None) and (local_dst is not None):
-                # set source and target node currents to zero
-                focal_node_pair_map = np.where(node_map == local_src+1, 0, 1)
-                focal_node_pair_map = np.where(node_map == local_dst+1, 0, focal_node_pair_map)                                                
-                current_map = np.multiply(focal_node_pair_map, current_map)
-                del focal_node_pair_map
+                current_map = self.current_maps[name]
+                if zero_focal_nodes:
+                    (rows, cols, nodes) = Output._node_cells(node_map)
+                    focal = (nodes == local_src+1) | (nodes == local_dst+1)
+                    current_map = current_map.copy()
+                    current_map[rows[focal], cols[focal]] = 0
             
             if write:
                 if name=='' and self.scenario != 'advanced': 
@@ -876,7 +1467,8 @@ class Output:
             if remove:
                 self.rm_c_map(name)
             elif accumulate:
-                self.current_maps[name] += current_map
+                with self.lock:
+                    self.current_maps[name] += current_map
             else:
                 self.current_maps[name] = current_map
 
@@ -945,11 +1537,16 @@ class Output:
         """Create and accumulate voltage map into the space identified by name"""
         if self.is_network:
             idxs = np.asarray([np.nonzero(self.node_names == a)[0][0] for a in node_map])
-            vm = self.voltage_maps[name]
-            vm[idxs] += voltages 
-            self.voltage_maps[name] = vm
+            with self.lock:
+                vm = self.voltage_maps[name]
+                vm[idxs] += voltages 
+                self.voltage_maps[name] = vm
         else:
-            self.voltage_maps[name] +=  self._create_voltage_map(node_map, voltages)
+            # only the cells with nodes are added to, without a raster of their own
+            (rows, cols, nodes) = Output._node_cells(node_map)
+            cell_voltages = np.asarray(voltages[nodes-1]).flatten()
+            with self.lock:
+                self.voltage_maps[name][rows, cols] += cell_voltages
             
     def alloc_v_map(self, name):
         """Allocate space for a new voltage map with the given name"""
@@ -962,7 +1559,8 @@ class Output:
     @gc_before
     @print_rusage
     def _create_current_maps(self, voltages, G, finitegrounds, node_map=None):
-        """In raster mode, returns raster current map given node voltage vector, adjacency matrix, etc.
+        """In raster mode, returns the rows, columns, node numbers and currents of the raster cells with
+        nodes in node_map, given node voltage vector, adjacency matrix, etc.
         In network mode returns node and branch currents given voltages in arbitrary graphs.
         """  
         G =  G.tocoo()
@@ -975,11 +1573,8 @@ class Output:
             branch_currents = np.absolute(branch_currents) 
             return node_currents_col, branch_currents
         else:
-            (rows, cols) = np.where(node_map)
-            vals = node_map[rows, cols]-1
-            current_map = np.zeros((self.state.nrows, self.state.ncols), dtype='float64')
-            current_map[rows,cols] = node_currents[vals]    
-            return current_map
+            (rows, cols, nodes) = Output._node_cells(node_map)
+            return (rows, cols, nodes, node_currents[nodes-1])
 
 
     @staticmethod
@@ -1052,10 +1647,19 @@ class Output:
     def _create_voltage_map(self, node_map, voltages):
         """Creates raster map of voltages given node voltage vector."""
         voltage_map = np.zeros((self.state.nrows, self.state.ncols), dtype = 'float64')
-        ind = node_map > 0
-        voltage_map[np.where(ind)] = np.asarray(voltages[node_map[ind]-1]).flatten()
+        (rows, cols, nodes) = Output._node_cells(node_map)
+        voltage_map[rows, cols] = np.asarray(voltages[nodes-1]).flatten()
         return voltage_map
 
+    @staticmethod
+    def _node_cells(node_map):
+        """Returns the rows, columns and node numbers of the raster cells with nodes in node_map,
+        which is either a raster or a ComponentNodeMap."""
+        if isinstance(node_map, ComponentNodeMap):
+            return (node_map.rows, node_map.cols, node_map.nodes)
+        (rows, cols) = np.where(node_map)
+        return (rows, cols, node_map[rows, cols])
+
     @staticmethod
     def _convert_graph_to_3_col(graph, node_names): 
         """Converts a sparse adjacency matrix to 3-column format."""  
@@ -1086,3 +1690,41 @@ class Output:
         return output_node_currents
 
 
+
+
+
+class SolutionHistory(object):
+    """Keeps the last few solutions of a fixed system G*x = b to warm start iterative solves.
+    
+    The initial guess for a new rhs is the Galerkin projection of its solution onto the span
+    of the kept solutions, i.e. the combination of them that is closest in the G-norm.
+    In pairwise mode consecutive focal pairs give strongly correlated voltages, so the
+    guess is often close to the new solution.
+    Parallel solves run in forked processes, each with its own copy of the history as it
+    was at the fork. Solutions found there are kept only in that copy, never in the parent's.
+    """
+    def __init__(self, G, size):
+        self.G = G
+        self.size = size
+        self.X = None       # kept solutions, one per column
+        self.GX = None      # G times kept solutions
+
+    def initial_guess(self, rhs):
+        """Returns an initial guess for G*x = rhs, or None if nothing has been kept yet."""
+        if self.X is None:
+            return None
+        XtGX = np.dot(self.X.T, self.GX)
+        coeffs = np.linalg.lstsq(XtGX, np.dot(self.X.T, rhs))[0]
+        return np.dot(self.X, coeffs)
+
+    def add(self, x):
+        """Keeps solution(s) x, dropping the oldest kept solutions beyond size."""
+        x = np.array(x, dtype='float64').reshape((self.G.shape[0], -1))
+        Gx = np.asarray(self.G * x)
+        if self.X is None:
+            (self.X, self.GX) = (x, Gx)
+        else:
+            self.X = np.hstack((self.X, x))
+            self.GX = np.hstack((self.GX, Gx))
+        self.X = self.X[:, -self.size:]
+        self.GX = self.GX[:, -self.size:]
@@ -0,0 +1,226 @@
+import os, time, pickle, tempfile, threading, socket
+
+class DistributedRun:
+    """Coordinates a run spread over processes, possibly on several machines, that share a directory.
+
+    The run is split into tasks, which every process derives in the same order from the same inputs.
+    A process claims a task by creating its claim file. The results of the tasks a process solves
+    are written together in batches, along with what the tasks accumulated in the process, such as
+    cumulative current maps. A batch is written when the process finds no more tasks to claim, and
+    at least every timeout seconds. Claims are kept fresh until the results of their tasks are
+    written. A claim left stale for longer than timeout seconds, by a process that died, is taken
+    over by another process. Tasks with results in the directory are never solved again, so a
+    restarted run resumes where it stopped.
+
+    All processes solve tasks until none are left. The coordinator then merges the results, while
+    workers just stop.
+    """
+    logger = None
+    POLL_INTERVAL = 1.0     # seconds between checks for tasks released by other processes
+
+    def __init__(self, run_dir, role, timeout):
+        if role not in ['coordinator', 'worker']:
+            raise RuntimeError('Distributed role must be either coordinator or worker.')
+        self.run_dir = run_dir
+        self.role = role
+        self.timeout = timeout
+        self.owner = socket.gethostname() + ':' + str(os.getpid())
+        self.num_tasks = 0
+        self.claims = set()
+        self.claims_lock = threading.Lock()
+        self.done = set()
+        self.batches = {}               # tasks of each batch written in the directory
+
+        for sub_dir in ['claims', 'results']:
+            path = os.path.join(run_dir, sub_dir)
+            if not os.path.isdir(path):
+                try:
+                    os.makedirs(path)
+                except OSError:
+                    if not os.path.isdir(path): # may have been created by another process meanwhile
+                        raise RuntimeError('Cannot create distributed run directory: ' + path + '.')
+
+    def is_coordinator(self):
+        return self.role == 'coordinator'
+
+    def start(self, key, num_tasks):
+        """Checks that all processes work on the same run, identified by key, of num_tasks tasks.
+
+        The coordinator records the run. Workers wait for it to do so.
+        """
+        manifest_file = os.path.join(self.run_dir, 'manifest.pkl')
+        manifest = {'key': key, 'num_tasks': num_tasks}
+        if self.is_coordinator() and not os.path.isfile(manifest_file):
+            self._write(manifest_file, manifest)
+
+        waited = 0
+        while not os.path.isfile(manifest_file):
+            if waited > self.timeout:
+                raise RuntimeError('No coordinator has started a run in ' + self.run_dir + '.')
+            time.sleep(DistributedRun.POLL_INTERVAL)
+            waited += DistributedRun.POLL_INTERVAL
+
+        if self._read(manifest_file) != manifest:
+            raise RuntimeError('Directory ' + self.run_dir + ' holds a different distributed run. Please use an empty directory.')
+
+        self.num_tasks = num_tasks
+        DistributedRun.logger.info('Distributed run of ' + str(num_tasks) + ' tasks in ' + self.run_dir + ', ' + str(self.num_done()) + ' done before')
+
+    def num_done(self):
+        self._find_batches()
+        return len(self.done)
+
+    def run_tasks(self, solve, merge, take_batch=None, merge_batch=None):
+        """Calls solve(task) for each task this process claims, until all tasks are done.
+
+        take_batch() returns what solve accumulated since it was last called, which is written with
+        the results of those tasks. On the coordinator, merge(task, result) is then called for each
+        task in order, and merge_batch(value) for what each batch accumulated.
+        """
+        stop_heartbeat = threading.Event()
+        heartbeat = threading.Thread(target=self._heartbeat, args=(stop_heartbeat,))
+        heartbeat.start()
+        solved = {}
+        last_write_time = time.time()
+        try:
+            while True:
+                self._find_batches()
+                pending = [task for task in range(0, self.num_tasks) if task not in self.done]
+                if len(pending) == 0:
+                    break
+                num_solved = 0
+                for task in pending:
+                    if (task in self.done) or not self._claim(task):
+                        continue
+                    if self._is_done(task): # written by the process that held the claim before
+                        self._release(task)
+                        continue
+                    try:
+                        DistributedRun.logger.info('Solving task ' + str(task+1) + ' of ' + str(self.num_tasks))
+                        solved[task] = solve(task)
+                        num_solved += 1
+                    except:
+                        self._release(task)
+                        raise
+                    if (time.time() - last_write_time) >= self.timeout:
+                        self._write_batch(solved, take_batch)
+                        solved = {}
+                        last_write_time = time.time()
+                if len(solved) > 0:
+                    self._write_batch(solved, take_batch)
+                    solved = {}
+                    last_write_time = time.time()
+                if num_solved == 0:
+                    time.sleep(DistributedRun.POLL_INTERVAL)
+        finally:
+            for task in solved.keys(): # solved, but not written
+                self._release(task)
+            stop_heartbeat.set()
+            heartbeat.join()
+
+        if self.is_coordinator():
+            self._find_batches()
+            results = {}
+            for batch_file in sorted(self.batches.keys()):
+                (batch_results, value) = self._read(batch_file[:-len('.tasks')] + '.pkl')
+                if len(set(batch_results.keys()) & set(results.keys())) > 0:
+                    DistributedRun.logger.warning('Some tasks were solved by two processes, as a process stopped updating its claims for a while. Accumulated results may count them twice.')
+                results.update(batch_results)
+                if merge_batch is not None:
+                    merge_batch(value)
+            for task in range(0, self.num_tasks):
+                merge(task, results[task])
+
+    def _claim_file(self, task):
+        return os.path.join(self.run_dir, 'claims', str(task) + '.claim')
+
+    def _write_batch(self, solved, take_batch):
+        # the results are written before the list of their tasks, which marks the tasks done
+        (fd, batch_file) = tempfile.mkstemp(dir=os.path.join(self.run_dir, 'results'), prefix=self.owner.replace(':', '_') + '_', suffix='.pkl')
+        os.close(fd)
+        batch_name = batch_file[:-len('.pkl')]
+        self._write(batch_file, (solved, None if (take_batch is None) else take_batch()))
+        self._write(batch_name + '.tasks', sorted(solved.keys()))
+        self.done.update(solved.keys())
+        for task in solved.keys():
+            self._release(task)
+
+    def _find_batches(self):
+        results_dir = os.path.join(self.run_dir, 'results')
+        for name in os.listdir(results_dir):
+            batch_file = os.path.join(results_dir, name)
+            if name.endswith('.tasks') and (batch_file not in self.batches):
+                self.batches[batch_file] = self._read(batch_file)
+                self.done.update(self.batches[batch_file])
+
+    def _is_done(self, task):
+        if task not in self.done:
+            self._find_batches()
+        return task in self.done
+
+    def _claim(self, task):
+        claim_file = self._claim_file(task)
+        try:
+            fd = os.open(claim_file, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except OSError:
+            return self._take_over_stale_claim(task)
+        with os.fdopen(fd, 'w') as f:
+            f.write(self.owner)
+        with self.claims_lock:
+            self.claims.add(claim_file)
+        return True
+
+    def _take_over_stale_claim(self, task):
+        claim_file = self._claim_file(task)
+        try:
+            if (time.time() - os.path.getmtime(claim_file)) < self.timeout:
+                return False
+            # only one process can rename the claim away
+            stale_file = claim_file + '.' + self.owner.replace(':', '_')
+            os.rename(claim_file, stale_file)
+        except OSError:
+            return False
+
+        if (time.time() - os.path.getmtime(stale_file)) < self.timeout:
+            # the claim was renewed meanwhile, put it back unless its owner has already released it
+            try:
+                os.link(stale_file, claim_file)
+            except OSError:
+                pass
+            os.remove(stale_file)
+            return False
+
+        with open(stale_file, 'r') as f:
+            DistributedRun.logger.warning('Taking over task ' + str(task+1) + ' from ' + f.read() + ', which stopped updating its claim')
+        os.remove(stale_file)
+        return self._claim(task)
+
+    def _release(self, task):
+        claim_file = self._claim_file(task)
+        with self.claims_lock:
+            self.claims.discard(claim_file)
+        try:
+            os.remove(claim_file)
+        except OSError:
+            pass
+
+    def _heartbeat(self, stop):
+        while not stop.wait(self.timeout / 4.0):
+            with self.claims_lock:
+                claims = list(self.claims)
+            for claim_file in claims:
+                try:
+                    os.utime(claim_file, None)
+                except OSError:
+                    pass
+
+    def _write(self, filename, value):
+        # written to a temporary file first, so that readers never see partial files
+        (fd, tmp_path) = tempfile.mkstemp(dir=os.path.dirname(filename), suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            pickle.dump(value, f, pickle.HIGHEST_PROTOCOL)
+        os.rename(tmp_path, filename)
+
+    def _read(self, filename):
+        with open(filename, 'rb') as f:
+            return pickle.load(f)
@@ -203,6 +203,43 @@ class CSIO:
         i = np.argsort(point_strengths[:,0])
         return point_strengths[i]
     
+    @staticmethod
+    def read_scenario_list(scenario_file):
+        """Returns (name, source file, ground file) of each scenario of a batch advanced mode run.
+        
+        scenario_file is either a text file with one scenario per line as 'name source_file ground_file',
+        with paths relative to the file, or a directory in which each '<name>_source.<ext>' file is
+        paired with a '<name>_ground.<ext>' file.
+        """
+        scenarios = []
+        if os.path.isdir(scenario_file):
+            for filename in sorted(os.listdir(scenario_file)):
+                base, extn = os.path.splitext(filename)
+                if not base.endswith('_source'):
+                    continue
+                name = base[:-len('_source')]
+                ground_files = [f for f in os.listdir(scenario_file) if os.path.splitext(f)[0] == (name + '_ground')]
+                if len(ground_files) == 0:
+                    raise RuntimeError('No ground file found for scenario ' + name + ' in ' + scenario_file)
+                ground_file = (name + '_ground' + extn) if ((name + '_ground' + extn) in ground_files) else sorted(ground_files)[0]
+                scenarios.append((name, os.path.join(scenario_file, filename), os.path.join(scenario_file, ground_file)))
+        else:
+            CSIO._check_file_exists(scenario_file)
+            base_dir = os.path.dirname(scenario_file)
+            with open(scenario_file, 'r') as f:
+                for line in f:
+                    line = line.strip()
+                    if (len(line) == 0) or line.startswith('#'):
+                        continue
+                    vals = line.split()
+                    if len(vals) != 3:
+                        raise RuntimeError('Error reading scenario list. Each line must hold a scenario name, a source file and a ground file.')
+                    scenarios.append((vals[0], os.path.join(base_dir, vals[1]), os.path.join(base_dir, vals[2])))
+        
+        if len(scenarios) == 0:
+            raise RuntimeError('No scenarios found in ' + scenario_file)
+        return scenarios
+    
     @staticmethod
     def deleterow(A, delrow):
         m = A.shape[0]
@@ -591,6 +628,16 @@ class CSIO:
         filename = out_base + '_voltages' + fileadd + '.txt'
         np.savetxt(filename, output_voltages, fmt='%.10g')      
 
+    @staticmethod
+    def write_solver_report(outfile_template, fields, records):
+        """Writes statistics of each linear solve, one per line, to a CSV file."""
+        out_base, _out_extn = os.path.splitext(outfile_template)
+        filename = out_base + '_solver_report.csv'
+        with open(filename, 'w') as f:
+            f.write(','.join(fields) + '\n')
+            for record in records:
+                f.write(','.join([('' if (val is None) else ('%.6g' % val if isinstance(val, float) else str(val))) for val in record]) + '\n')
+
     @staticmethod
     def match_headers(t_file, match_files):
         (ncols, nrows, xllcorner, yllcorner, cellsize, _nodata, _filetype) = CSIO._ascii_grid_read_header(t_file)
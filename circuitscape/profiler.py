@@ -152,6 +152,40 @@ def print_rusage(func):
 
 
 
+class SolverStats:
+    """Collects convergence statistics of linear solves for the solver report.
+    
+    Each record is a tuple with values for the names in FIELDS. Setup of a hierarchy or
+    factorization is recorded on its own, with no solve values.
+    """
+    FIELDS = ['label', 'solver', 'num_nodes', 'num_rhs', 'iterations', 'residual', 'setup_time', 'solve_time']
+    
+    enabled = False
+    records = []
+    
+    @staticmethod
+    def init_stats(enabled):
+        SolverStats.enabled = enabled
+        SolverStats.records = []
+    
+    @staticmethod
+    def record_setup(label, solver, num_nodes, setup_time):
+        if SolverStats.enabled:
+            SolverStats.records.append((label, solver, num_nodes, 0, '', '', setup_time, ''))
+    
+    @staticmethod
+    def record_solve(labels, solver, num_nodes, iterations, residuals, solve_time):
+        """Records one solve per rhs column. Solve time is that of all columns together."""
+        if not SolverStats.enabled:
+            return
+        num_rhs = len(residuals)
+        if not isinstance(labels, list):
+            labels = [labels] * num_rhs
+        for col in range(0, num_rhs):
+            its = '' if (iterations is None) else iterations[col]
+            SolverStats.records.append((labels[col], solver, num_nodes, num_rhs, its, residuals[col], '', solve_time))
+
+
 #---------------------------------------------
 # GC helper classes begin
 #---------------------------------------------
@@ -234,7 +268,8 @@ class LowMemRetry:
 
             if LowMemRetry.retry():
                 return True
-        LowMemRetry.can_retry = False
+        # an exception leaves the retry loop, so the next loop must not see the end of this one
+        LowMemRetry.can_retry = (etype is not None)
         return False
 
     @staticmethod
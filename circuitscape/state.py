@@ -1,14 +1,32 @@
 from multiprocessing.pool import ThreadPool
-import multiprocessing, os, logging, pickle
-from profiler import gc_after, print_rusage
+from multiprocessing.sharedctypes import RawArray
+import multiprocessing, os, logging, pickle, time, threading, Queue
+import numpy as np
+from profiler import gc_after, print_rusage, SolverStats
 from pyamg import smoothed_aggregation_solver
+from scipy.sparse.linalg import splu
+from cache import CSCache
+
+try:
+    from scikits.sparse.cholmod import cholesky
+    cholmod_available = True
+except ImportError:
+    cholmod_available = False
 
 class CSState:
     logger = None
     
     def __init__(self):
         self.worker_pool = None
+        self.solver_pool = None                         # worker processes solving systems of the current component
         self.amg_hierarchy = None
+        self.grounded_node = None                       # anchor node and its diagonal entry, when the system of amg_hierarchy is grounded at an anchor
+        self.solution_history = None                    # earlier solutions of the system amg_hierarchy was built for
+        self.amg_options = {}                           # keyword arguments of smoothed_aggregation_solver
+        self.amg_autotuned = False
+        self.cache = None                               # on-disk cache of graphs, Laplacians and AMG hierarchies
+        self.distributed = None                         # DistributedRun shared with processes on other nodes, if any
+        self.checkpoint = None                          # Checkpoint of the progress of the run, if saved or resumed
         self.cellsize = None
         self.g_map = None
         self.ground_map = None
@@ -21,6 +39,7 @@ class CSState:
         self.points_rc = None                           # focal node map
         self.point_file_contains_polygons = False
         self.poly_map = None                            # habitat short circuit region map
+        self.scenarios = None                           # (name, source file, ground file) of each scenario of a batch advanced mode run
         self.source_map = None
         self.start_time = None
         self.version = None
@@ -58,18 +77,65 @@ class CSState:
             self.worker_pool = None
             #CSState.logger.debug("closing worker pool")
         
+    def solver_pool_create(self, max_workers, function, fixed_args, num_nodes, max_cols, rows=None):
+        """Starts a SolverPool, unless one is running.
+        
+        The workers inherit the hierarchy as it is now, and keep their own copies of it until the pool is closed
+        with solver_pool_close. Deleting the hierarchy here does not affect them.
+        """
+        if self.solver_pool is not None:
+            return
+        max_workers = min(multiprocessing.cpu_count(), max_workers) if (max_workers > 0) else multiprocessing.cpu_count()
+        self.solver_pool = SolverPool(max_workers, function, fixed_args, num_nodes, max_cols, rows)
+
+    def solver_pool_wait(self):
+        if self.solver_pool is not None:
+            self.solver_pool.wait()
+
+    def solver_pool_close(self):
+        if self.solver_pool is not None:
+            self.solver_pool.close()
+            self.solver_pool = None
+
     @gc_after
     def del_amg_hierarchy(self):
         if self.amg_hierarchy is not None:
             self.amg_hierarchy = None
+        self.solution_history = None
 
     @print_rusage
-    def create_amg_hierarchy(self, G, solver): 
+    def create_amg_hierarchy(self, G, solver, label=None): 
         """Creates AMG hierarchy."""  
+        t1 = time.time()
         if solver in ['amg', 'cg+amg']:
             # construct the MG hierarchy
             #  scipy.io.savemat('c:\\temp\\graph.mat',mdict={'d':G})
-            self.amg_hierarchy = smoothed_aggregation_solver(G)
+            if self.cache is None:
+                self.amg_hierarchy = smoothed_aggregation_solver(G, **self.amg_options)
+            else:
+                key = CSCache.key(G, self.amg_options)
+                self.amg_hierarchy = self.cache.load_amg_hierarchy(key, self.amg_options)
+                if self.amg_hierarchy is None:
+                    self.amg_hierarchy = smoothed_aggregation_solver(G, **self.amg_options)
+                    self.cache.store_amg_hierarchy(key, self.amg_hierarchy)
+        elif solver == 'cholesky':
+            # not an AMG hierarchy, but it has the same lifetime and is passed around the same way
+            self.amg_hierarchy = CSState.factorize(G)
+        else:
+            return
+        SolverStats.record_setup(label, solver, G.shape[0], time.time() - t1)
+
+    @staticmethod
+    def factorize(G):
+        """Factors symmetric positive definite G once and returns a function that solves G*x = rhs.
+        
+        Uses CHOLMOD when scikits.sparse is installed, and SuperLU in symmetric mode otherwise.
+        rhs may have multiple columns.
+        """
+        if cholmod_available:
+            return cholesky(G.tocsc()).solve_A
+        lu = splu(G.tocsc(), permc_spec='MMD_AT_PLUS_A', diag_pivot_thresh=0, options=dict(SymmetricMode=True))
+        return lu.solve
 
 
     def async(self, func):
@@ -79,13 +145,15 @@ class CSState:
             if (0 == child_pid):
                 pid = str(os.getpid())
                 logging.disable(logging.CRITICAL) # disable logging in child to avoid python bug : http://bugs.python.org/issue6721
+                num_records = len(SolverStats.records)
                 try:
                     os.close(read_fd)
                     write_file = os.fdopen(write_fd, 'w')
                     result = func(*args)
                 except Exception as e:
                     result = e
-                write_file.write(pickle.dumps(result))
+                # send back the solver statistics recorded in this process along with the result
+                write_file.write(pickle.dumps((result, SolverStats.records[num_records:])))
                 write_file.close()
                 os._exit(os.EX_OK)
             elif (child_pid > 0):
@@ -95,7 +163,8 @@ class CSState:
                     os.close(write_fd)
                     read_file = os.fdopen(read_fd)
                     result = read_file.read()
-                    results = pickle.loads(result)
+                    (results, records) = pickle.loads(result)
+                    SolverStats.records.extend(records)
                     #self.logger.debug("parallel: got results from " + pid)
                     if isinstance(results, Exception):
                         self.logger.exception("parallel: got error from " + pid + ": " + str(results))
@@ -114,3 +183,122 @@ class CSState:
             return results
         wrapper.__name__ = 'async_' + func.func_name
         return wrapper
+
+
+_solver_pool_context = None     # set while forking SolverPool workers, which inherit it
+
+def _solver_pool_init():
+    logging.disable(logging.CRITICAL) # as in CSState.async, to avoid python bug : http://bugs.python.org/issue6721
+
+def _solver_pool_run(slot, num_results, args):
+    (function, fixed_args, buffers, rows, running) = _solver_pool_context
+    running[slot] = os.getpid()
+    num_records = len(SolverStats.records)
+    solved = [False] * num_results
+    try:
+        results = function(*(fixed_args + args))
+        for idx in range(0, num_results):
+            if results[idx] is not None:
+                buffers[slot][idx,:] = results[idx] if (rows is None) else results[idx][rows]
+                solved[idx] = True
+    except Exception:
+        pass
+    running[slot] = 0
+    return (slot, solved, SolverStats.records[num_records:])
+
+
+class SolverPool:
+    """Persistent worker processes that solve many right hand sides of one system.
+    
+    The workers are forked once, after the system and its hierarchy are set up, and inherit them
+    along with function and fixed_args. Tasks carry only the remaining arguments of function,
+    which returns a list of voltage vectors (None for failed solves). Voltages are passed back
+    through slots of a shared memory buffer instead of being pickled. Callbacks get views into
+    a slot, which is reused once the callback returns.
+    
+    When rows is given, only those entries of the voltages are passed back, and callbacks get
+    vectors in which only the entries of rows are set. Tasks of a worker that dies are failed,
+    with None for all their results.
+    """
+    POLL_INTERVAL = 1.0     # seconds between checks for workers that died
+    
+    def __init__(self, num_workers, function, fixed_args, num_nodes, max_cols, rows=None):
+        global _solver_pool_context
+        num_slots = 2 * num_workers
+        self.rows = rows
+        num_cols = num_nodes if (rows is None) else len(rows)
+        self.buffers = [np.frombuffer(RawArray('d', num_cols * max_cols), dtype='float64').reshape((max_cols, num_cols)) for _slot in range(0, num_slots)]
+        self.scratch = None if (rows is None) else np.zeros((max_cols, num_nodes), dtype='float64')
+        self.running = np.frombuffer(RawArray('l', num_slots), dtype=np.int_)    # pid of the worker solving the task of each slot
+        self.free_slots = Queue.Queue()
+        for slot in range(0, num_slots):
+            self.free_slots.put(slot)
+        self.pending = {}                                   # callback and number of results of the task of each busy slot
+        self.pending_changed = threading.Condition()
+        self.num_lost = 0
+        
+        _solver_pool_context = (function, fixed_args, self.buffers, rows, self.running)
+        try:
+            self.pool = multiprocessing.Pool(num_workers, _solver_pool_init)
+        finally:
+            _solver_pool_context = None
+
+    def submit(self, callback, num_results, *args):
+        """Queues a task, blocking while all result slots are in use."""
+        while True:
+            try:
+                slot = self.free_slots.get(True, SolverPool.POLL_INTERVAL)
+                break
+            except Queue.Empty:
+                self._fail_lost_tasks()
+        with self.pending_changed:
+            self.pending[slot] = (callback, num_results)
+        self.pool.apply_async(_solver_pool_run, (slot, num_results, args), callback=self._on_result)
+
+    def _on_result(self, result):
+        (slot, solved, records) = result
+        SolverStats.records.extend(records)
+        self._finish(slot, solved)
+
+    def _finish(self, slot, solved):
+        with self.pending_changed:
+            if slot not in self.pending: # failed already
+                return
+            (callback, num_results) = self.pending.pop(slot)
+            try:
+                if self.rows is None:
+                    callback([(self.buffers[slot][idx,:] if solved[idx] else None) for idx in range(0, num_results)])
+                else:
+                    for idx in range(0, num_results):
+                        self.scratch[idx, self.rows] = self.buffers[slot][idx,:]
+                    callback([(self.scratch[idx,:] if solved[idx] else None) for idx in range(0, num_results)])
+            except:
+                CSState.logger.exception('parallel: exception handling solver results')
+            finally:
+                self.free_slots.put(slot)
+                self.pending_changed.notify_all()
+
+    def _fail_lost_tasks(self):
+        live_pids = set([p.pid for p in multiprocessing.active_children()])
+        with self.pending_changed:
+            lost = [slot for slot in self.pending.keys() if (self.running[slot] != 0) and (self.running[slot] not in live_pids)]
+            for slot in lost:
+                CSState.logger.error('parallel: solver worker ' + str(self.running[slot]) + ' died')
+                self.running[slot] = 0
+                self.num_lost += 1
+                self._finish(slot, [False] * self.pending[slot][1])
+
+    def wait(self):
+        """Waits until all queued tasks are done and their callbacks have returned."""
+        with self.pending_changed:
+            while len(self.pending) > 0:
+                self.pending_changed.wait(SolverPool.POLL_INTERVAL)
+                self._fail_lost_tasks()
+
+    def close(self):
+        self.wait()
+        if self.num_lost > 0: # the pool would wait for the results of lost tasks
+            self.pool.terminate()
+        else:
+            self.pool.close()
+        self.pool.join()
@@ -1,6 +1,12 @@
-import os, sys, unittest
+import os, sys, time, unittest, shutil, multiprocessing, signal, pickle, warnings
 import numpy as np
+from scipy import sparse
 import circuitscape as cscape
+from circuitscape.compute_base import ComputeBase, FocalPoints, HabitatGraph, IncludeExcludePairs
+from circuitscape.checkpoint import Checkpoint
+from circuitscape.profiler import LowMemRetry
+from circuitscape.state import SolverPool
+import circuitscape.state as cs_state
 
 TESTS_ROOT      = 'circuitscape'
 TESTS_CFG       = os.path.join(TESTS_ROOT,  'verify', 'config_files')
@@ -32,13 +38,16 @@ def compare_results(ut, test_name, result_file, compressed):
         saved       = np.loadtxt(os.path.join(TESTS_BASELINE, result_name), 'float64')
     ut.assertEquals(approxEqual(saved, computed), True) 
 
-def load_config(test_name):
+def load_config(test_name, options=None):
     #print test_name
     configFile = os.path.join(TESTS_CFG, test_name + '.ini')
     cs = cscape.Compute(configFile, EXT_LOGGER)
     cs.logger.info("Running test: " + test_name)
     _out_dir, out_file = os.path.split(cs.options.output_file)
     cs.options.output_file = os.path.join(TESTS_OUT, out_file)
+    if options is not None: # run an existing test case with some options changed; results must match the same baseline
+        for name, value in options.items():
+            setattr(cs.options, name, value)
     return cs
 
 def set_paths(root_path=None, out_path=None):
@@ -62,8 +71,8 @@ def cs_verifyall(root_path=None, out_path=None, ext_logger=None, stream=None):
     EXT_LOGGER = None
     return testResult
 
-def test_sg(ut, test_name):
-    cs = load_config(test_name)
+def test_sg(ut, test_name, options=None):
+    cs = load_config(test_name, options)
     resistances_computed, _solver_failed = cs.compute()
     
     resistances_saved = np.loadtxt(os.path.join(TESTS_BASELINE, test_name + '_resistances.txt'))
@@ -78,8 +87,78 @@ def test_sg(ut, test_name):
             compare_results(ut, test_name, 'curmap_max.asc', False) 
         
         
-def test_network_sg(ut, test_name):
-    cs = load_config(test_name)
+class Interrupted(Exception):
+    pass
+
+def test_resumed(ut, run_test, test_name, options=None):
+    """Runs a test case that is interrupted at its first checkpoint, then resumes it from the checkpoint.
+    
+    Returns the tasks done at the interruption.
+    """
+    checkpoint_file = os.path.join(TESTS_OUT, test_name + '_checkpoint.pkl')
+    options = dict(options if (options is not None) else {}, checkpoint_interval=0)
+    
+    (save, min_interval) = (Checkpoint.save, Checkpoint.MIN_INTERVAL)
+    def save_and_interrupt(checkpoint, resistances, out):
+        save(checkpoint, resistances, out)
+        raise Interrupted()
+    Checkpoint.save = save_and_interrupt
+    Checkpoint.MIN_INTERVAL = 0 # saved after the first task
+    try:
+        ut.assertRaises(Interrupted, run_test, ut, test_name, options)
+    finally:
+        (Checkpoint.save, Checkpoint.MIN_INTERVAL) = (save, min_interval)
+    ut.assertTrue(os.path.isfile(checkpoint_file))
+    with open(checkpoint_file, 'rb') as f:
+        done = pickle.load(f)['done']
+    
+    compute = cscape.Compute.compute
+    cscape.Compute.compute = lambda cs: compute(cs, True)
+    try:
+        run_test(ut, test_name, options)
+    finally:
+        cscape.Compute.compute = compute
+    ut.assertFalse(os.path.isfile(checkpoint_file))
+    with open(os.path.join(TESTS_OUT, test_name + '.ini')) as f:
+        ut.assertTrue('resume' not in f.read()) # resuming is not a setting of the run
+    return done
+
+
+def solve_or_die(scale, srcs):
+    """Solver of SolverPool tests, whose worker is killed by a negative source."""
+    if srcs[0] < 0:
+        os.kill(os.getpid(), signal.SIGKILL)
+    return [scale * np.arange(0, 4.0) + src for src in srcs]
+
+def solver_pool_results(pool, tasks):
+    results = {}
+    def collect(task):
+        def _callback(voltages):
+            results[task] = [(None if (v is None) else v.copy()) for v in voltages]
+        return _callback
+    for (task, srcs) in enumerate(tasks):
+        pool.submit(collect(task), len(srcs), srcs)
+    pool.close()
+    return results
+
+
+def run_distributed_worker(test_name, options):
+    cs = load_config(test_name, options)
+    cs.compute()
+
+
+def burn_points_into_polymap(points, point_map, poly_map, new_poly_nums):
+    """Burns each of points and the polygons overlapping it into poly_map in turn, as new_poly_nums."""
+    for (point, new_poly_num) in zip(points, new_poly_nums):
+        overlap_polys = np.unique(poly_map[point_map == point])
+        for polynum in overlap_polys[overlap_polys > 0]:
+            poly_map = np.where(poly_map == polynum, new_poly_num, poly_map)
+        poly_map = np.where(point_map == point, new_poly_num, poly_map)
+    return poly_map
+
+
+def test_network_sg(ut, test_name, options=None):
+    cs = load_config(test_name, options)
 
     # These baseline outputs generated using rasters, with outputs written in graph format using 'write_baseline_results' option.
     resistances_computed, _solver_failed = cs.compute()
@@ -95,8 +174,8 @@ def test_network_sg(ut, test_name):
         compare_results(ut, test_name, 'branch_currents_0_1.txt', False)
 
 
-def test_network_mg(ut, test_name):
-    cs = load_config(test_name)
+def test_network_mg(ut, test_name, options=None):
+    cs = load_config(test_name, options)
         
     _voltages = cs.compute()
 
@@ -105,8 +184,8 @@ def test_network_mg(ut, test_name):
     compare_results(ut, test_name, 'branch_currents.txt', False)
 
 
-def test_one_to_all(ut, test_name):
-    cs = load_config(test_name)
+def test_one_to_all(ut, test_name, options=None):
+    cs = load_config(test_name, options)
 
     resistances_computed, _solver_failed = cs.compute()
 
@@ -118,8 +197,8 @@ def test_one_to_all(ut, test_name):
     compare_results(ut, test_name, 'voltmap_1.asc', False)
    
     
-def test_all_to_one(ut, test_name):
-    cs = load_config(test_name)
+def test_all_to_one(ut, test_name, options=None):
+    cs = load_config(test_name, options)
     
     _resistances_computed, _solver_failed = cs.compute()
 
@@ -128,8 +207,8 @@ def test_all_to_one(ut, test_name):
     compare_results(ut, test_name, 'voltmap_1.asc', False)
 
         
-def test_mg(ut, test_name):
-    cs = load_config(test_name)
+def test_mg(ut, test_name, options=None):
+    cs = load_config(test_name, options)
         
     _voltages = cs.compute()
 
@@ -166,6 +245,18 @@ class cs_verify(unittest.TestCase):
         # Modification of mgNetworkVerify2 with 4 current sources instead of 1.
         test_network_mg(self, 'mgNetworkVerify3') 
         
+    def test_network_node_values(self):
+        # values are looked up by node name, the last listed value winning, as the scan of each listed node did
+        random_state = np.random.RandomState(6)
+        node_names = random_state.permutation(100)[0:40] + 1
+        named_values = np.column_stack((random_state.randint(0, 120, 60), random_state.uniform(0, 1, 60)))
+        expected = -9999 * np.ones(node_names.size)
+        for idx in range(0, named_values.shape[0]):
+            expected = np.where(node_names == named_values[idx,0], named_values[idx,1], expected)
+        self.assertTrue(np.array_equal(ComputeBase.node_values(node_names, named_values, -9999), expected))
+        self.assertTrue(np.array_equal(ComputeBase.node_values(node_names, named_values[0:0], 0), np.zeros(node_names.size)))
+        self.assertEquals(ComputeBase.node_values(node_names[0:0], named_values, 0).size, 0)
+
     def test_single_ground_all_pairs_resistances_1(self):
         test_sg(self, 'sgVerify1') 
  
@@ -208,6 +299,323 @@ class cs_verify(unittest.TestCase):
     def test_single_ground_all_pairs_resistances_14(self):
         # Tests nodata output and max current options
         test_sg(self, 'sgVerify14') 
+
+    def test_single_ground_all_pairs_resistances_cum_cur_map_only(self):
+        # currents of each pair are added into the cumulative and maximum maps, without a map of their own
+        pair_map = os.path.join(TESTS_OUT, 'sgVerify14_curmap_1_2.asc')
+        if os.path.isfile(pair_map):
+            os.remove(pair_map)
+        cs = load_config('sgVerify14', {'write_cum_cur_map_only': True, 'parallelize': True, 'max_parallel': 2})
+        cs.compute()
+        compare_results(self, 'sgVerify14', 'cum_curmap.asc', False)
+        compare_results(self, 'sgVerify14', 'curmap_max.asc', False)
+        self.assertFalse(os.path.isfile(pair_map))
+
+    def test_included_pairs_exclude_mode(self):
+        # pairs not listed in an exclude file are included, each row found without a dense matrix of all pairs
+        pairs = IncludeExcludePairs(os.path.join(TESTS_ROOT, 'verify', '1', 'exclude_pairs.txt'))
+        point_ids = np.array([9, 1, 4, 2, 3, 60, 5])
+        (idx1, idx2) = pairs.get_included_pair_idxs(point_ids)
+        expected = [(i, j) for i in range(0, point_ids.size) for j in range(i+1, point_ids.size) if pairs.is_included_pair(point_ids[i], point_ids[j])]
+        self.assertEquals(zip(idx1.tolist(), idx2.tolist()), expected)
+        self.assertTrue(len(expected) > 0)
+        self.assertEquals(pairs.get_included_pair_idxs(np.array([], int))[0].size, 0)
+        
+        # the matrix lookups of earlier releases are kept, with a warning
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter('always')
+            self.assertEquals(pairs.has_pair(1, 4) + pairs.has_pair(4, 1) > 0, True)
+            self.assertEquals(pairs.has_pair(1, 2) + pairs.has_pair(2, 1), 0)
+            self.assertEquals(pairs.has(1) > 0, True)
+            self.assertEquals(pairs.has(1000), 0)
+        self.assertEquals(len(caught), 6)
+        self.assertTrue(all(issubclass(warning.category, DeprecationWarning) for warning in caught))
+
+    def test_single_ground_all_pairs_resistances_excluded_pairs(self):
+        # pairs listed in an exclude file are left out, and all other pairs are solved. Only the listed pairs used to be solved
+        exclude_file = os.path.join(TESTS_ROOT, 'verify', '1', 'exclude_pairs.txt')
+        resistances_all, _solver_failed = load_config('sgVerify13', {'use_included_pairs': False}).compute()
+        resistances, _solver_failed = load_config('sgVerify13', {'included_pairs_file': exclude_file}).compute()
+        all_idxs = np.searchsorted(resistances_all[0, :], resistances[0, :])
+        expected = resistances_all[np.ix_(all_idxs, all_idxs)]
+        point_idxs = dict((int(point_id), idx) for (idx, point_id) in enumerate(expected[0, :]) if idx > 0)
+        for (id1, id2) in np.loadtxt(exclude_file, skiprows=1, dtype='int32'):
+            if (id1 != id2) and (id1 in point_idxs) and (id2 in point_idxs):
+                expected[point_idxs[id1], point_idxs[id2]] = expected[point_idxs[id2], point_idxs[id1]] = -1
+        self.assertEquals(approxEqual(expected, resistances), True)
+
+    def test_single_ground_all_pairs_resistances_batched_1(self):
+        # Focal pairs sharing an anchor node solved together as one multi-rhs solve
+        test_sg(self, 'sgVerify4', {'solver_batch_size': 3})
+
+    def test_single_ground_all_pairs_resistances_batched_2(self):
+        # Batched solves with focal regions and short-circuit regions
+        test_sg(self, 'sgVerify1', {'solver_batch_size': 4})
+
+    def test_single_ground_all_pairs_resistances_batched_3(self):
+        # Batched solves with the resistance calculation shortcut
+        test_sg(self, 'sgVerify12', {'solver_batch_size': 8})
+
+    def test_single_ground_batch_solver_failed_columns(self):
+        # Only the pairs of a batch whose solve failed are solved again on their own
+        random_state = np.random.RandomState(3)
+        n = 12
+        A = random_state.uniform(0, 1, (n, n))
+        G = sparse.csr_matrix(np.diag(n + np.ones(n)) - (A + A.T) / 2)
+        calls = []
+        def _factor(rhs):
+            calls.append(rhs.ndim)
+            x = np.linalg.solve(G.toarray(), rhs)
+            if rhs.ndim > 1:
+                x[:,1] = np.nan
+            return x
+        srcs = [3, 5, 0, 7]
+        dst = 0
+        results = cscape.Compute.single_ground_batch_solver(G, srcs, dst, 'cholesky', _factor)
+        self.assertEquals(calls, [2, 1])
+        for idx in range(0, len(srcs)):
+            rhs = np.zeros(n)
+            if srcs[idx] != dst:
+                rhs[srcs[idx]] = 1
+                rhs[dst] = -1
+            expected = np.linalg.solve(G.toarray(), rhs)
+            self.assertTrue(np.allclose(results[idx], expected - expected[dst]))
+
+    def test_single_ground_all_pairs_resistances_reuse_amg_1(self):
+        # One AMG hierarchy per component, grounded at a fixed reference node
+        test_sg(self, 'sgVerify4', {'reuse_amg_hierarchy': True})
+
+    def test_single_ground_all_pairs_resistances_reuse_amg_2(self):
+        # Reused hierarchy combined with batched solves
+        test_sg(self, 'sgVerify11', {'reuse_amg_hierarchy': True, 'solver_batch_size': 3})
+
+    def test_single_ground_all_pairs_resistances_warm_start_1(self):
+        test_sg(self, 'sgVerify4', {'warm_start_history': 4})
+
+    def test_single_ground_all_pairs_resistances_warm_start_2(self):
+        test_sg(self, 'sgVerify12', {'warm_start_history': 2, 'reuse_amg_hierarchy': True, 'solver_batch_size': 3})
+
+    def test_single_ground_all_pairs_resistances_solver_report(self):
+        test_sg(self, 'sgVerify12', {'solver_tol': 1e-8, 'solver_maxiter': 1000, 'write_solver_report': True, 'solver_batch_size': 2})
+        report = np.genfromtxt(os.path.join(TESTS_OUT, 'sgVerify12_solver_report.csv'), delimiter=',', names=True, dtype=None)
+        solves = report[report['num_rhs'] > 0]
+        self.assertTrue(solves.size > 0)
+        self.assertTrue(np.all(solves['residual'] < 1e-3))
+
+    def test_single_ground_all_pairs_resistances_amg_autotune(self):
+        test_sg(self, 'sgVerify4', {'amg_autotune': True})
+
+    def test_single_ground_all_pairs_resistances_amg_options(self):
+        test_sg(self, 'sgVerify1', {'amg_strength': 'evolution', 'amg_smoother': 'jacobi', 'amg_cycle': 'W'})
+
+    def test_single_ground_all_pairs_resistances_cached(self):
+        # second run takes graph, Laplacians and hierarchies from the cache written by the first
+        cache_dir = os.path.join(TESTS_OUT, 'cache')
+        shutil.rmtree(cache_dir, True)
+        try:
+            test_sg(self, 'sgVerify4', {'cache_dir': cache_dir, 'reuse_amg_hierarchy': True})
+            num_entries = len(os.listdir(cache_dir))
+            self.assertTrue(num_entries > 0)
+            test_sg(self, 'sgVerify4', {'cache_dir': cache_dir, 'reuse_amg_hierarchy': True})
+            self.assertEquals(len(os.listdir(cache_dir)), num_entries)
+        finally:
+            shutil.rmtree(cache_dir, True)
+
+    def test_single_ground_all_pairs_resistances_pinv_1(self):
+        test_sg(self, 'sgVerify12', {'pairwise_resistance_method': 'pinv'})
+
+    def test_single_ground_all_pairs_resistances_pinv_2(self):
+        test_sg(self, 'sgVerify12', {'pairwise_resistance_method': 'pinv', 'solver': 'cholesky', 'solver_batch_size': 4})
+
+    def test_single_ground_all_pairs_resistances_approximate(self):
+        # random landscape with enough focal nodes for random projections to be used instead of exact solves
+        cs = load_config('sgVerify12', {'solver': 'cholesky', 'solver_batch_size': 200, 'approximate_resistance_eps': 0.8})
+        random_state = np.random.RandomState(1)
+        g_map = 10**random_state.uniform(-3, 3, (25, 25))
+        cells = random_state.permutation(g_map.size)[0:200]
+        points_rc = np.column_stack((np.arange(1, 201), cells // 25, cells % 25))
+        fp = FocalPoints(points_rc, None, False)
+        g_habitat = HabitatGraph(g_map=g_map, poly_map=[])
+        
+        cs.options.pairwise_resistance_method = 'pinv'
+        resistances_exact, _solver_failed = cs.batched_all_pair_resistances(g_habitat, fp, False)
+        cs.options.pairwise_resistance_method = 'approximate'
+        resistances_approx, _solver_failed = cs.batched_all_pair_resistances(g_habitat, fp, False)
+        
+        off_diag = np.logical_not(np.eye(200, dtype='bool'))
+        rel_err = np.abs(resistances_approx[off_diag] - resistances_exact[off_diag]) / resistances_exact[off_diag]
+        self.assertTrue(rel_err.max() < 0.8)
+        self.assertTrue(rel_err.max() > 1e-6) # estimated, not solved exactly
+
+    def test_construct_laplacian(self):
+        # the Laplacian is that of the graph built from coordinates and its transpose
+        random_state = np.random.RandomState(3)
+        g_map = np.where(random_state.uniform(0, 1, (30, 40)) < 0.3, 0, 10**random_state.uniform(-2, 2, (30, 40)))
+        poly_map = np.zeros((30, 40), dtype='int32')
+        poly_map[3:6, 3:7] = 1
+        poly_map[20, 10:25] = 2
+        for connect_using_avg_resistances in [False, True]:
+            for connect_four_neighbors_only in [False, True]:
+                node_map = HabitatGraph._construct_node_map(g_map, poly_map)
+                G = HabitatGraph._construct_g_graph(g_map, node_map, connect_using_avg_resistances, connect_four_neighbors_only)
+                L = HabitatGraph._construct_laplacian(g_map, node_map, connect_using_avg_resistances, connect_four_neighbors_only)
+                self.assertTrue(L.has_sorted_indices)
+                self.assertTrue(abs(L - ComputeBase.laplacian(G)).max() < 1e-12)
+
+    def test_overlap_polymap_for_points(self):
+        # polygons are merged as burning the focal nodes in one at a time would merge them
+        random_state = np.random.RandomState(4)
+        for _trial in range(0, 20):
+            point_map = np.where(random_state.uniform(0, 1, (15, 15)) < 0.2, random_state.randint(1, 8, (15, 15)), 0)
+            poly_map = np.where(random_state.uniform(0, 1, (15, 15)) < 0.4, random_state.randint(1, 6, (15, 15)), 0)
+            points = random_state.randint(1, 9, 6)   # some repeated, some not in the map
+            new_poly_nums = poly_map.max() + 1 + np.arange(points.size)
+            self.assertTrue(np.array_equal(cscape.Compute.get_overlap_polymap_for_points(points, point_map, poly_map, new_poly_nums),
+                                           burn_points_into_polymap(points, point_map, poly_map, new_poly_nums)))
+
+    def test_contract_regions(self):
+        # contracting focal regions gives the graph built with them burned into the polygon map
+        random_state = np.random.RandomState(7)
+        g_map = np.where(random_state.uniform(0, 1, (20, 20)) < 0.5, 0, 10**random_state.uniform(-2, 2, (20, 20)))
+        poly_map = np.zeros((20, 20), dtype='int32')
+        poly_map[3:6, 3:7] = 1
+        poly_map[12, 2:18] = 2
+        point_map = np.zeros((20, 20), dtype='int32')
+        for point_id in range(1, 7):
+            point_map.flat[random_state.permutation(400)[0:5]] = point_id
+        g_habitat = HabitatGraph(g_map=g_map, poly_map=poly_map)
+        for point_ids in [np.array([1, 2]), np.array([3, 5]), np.array([1, 4, 6]), np.arange(1, 7)]:
+            regions = cscape.Compute.get_focal_regions(point_map, point_ids)
+            contracted = g_habitat.contract_regions(regions)
+            burned = cscape.Compute.get_overlap_polymap_for_points(point_ids, point_map, poly_map, poly_map.max() + 1 + np.arange(point_ids.size))
+            rebuilt = HabitatGraph(g_map=g_map, poly_map=burned)
+            self.assertTrue(np.array_equal(contracted.node_map, rebuilt.node_map))
+            self.assertTrue(np.array_equal(contracted.component_map, rebuilt.component_map))
+            self.assertTrue(np.array_equal(contracted.components, rebuilt.components))
+            self.assertTrue(abs(contracted.get_laplacian() - rebuilt.get_laplacian()).max() < 1e-10)
+        self.assertTrue(contracted.num_components < g_habitat.num_components) # regions join components
+
+    def test_prune_nodes_for_component(self):
+        # the graph of each component is that built from the component alone
+        random_state = np.random.RandomState(2)
+        g_map = np.where(random_state.uniform(0, 1, (30, 30)) < 0.45, 0, 10**random_state.uniform(-2, 2, (30, 30)))
+        poly_map = np.zeros((30, 30), dtype='int32')
+        poly_map[3:6, 3:7] = 1
+        poly_map[20, 10:25] = 2
+        g_habitat = HabitatGraph(g_map=g_map, poly_map=poly_map)
+        self.assertTrue(g_habitat.num_components > 2)
+        for c in range(1, g_habitat.num_components+1):
+            (G, node_map) = g_habitat.prune_nodes_for_component(c)
+            in_component = (g_habitat.component_map == c)
+            g_habitat_c = HabitatGraph(g_map=np.where(in_component, g_map, 0), poly_map=np.where(in_component, poly_map, 0))
+            (rows, cols) = np.where(np.ones((30, 30)))
+            self.assertTrue(np.array_equal(node_map[rows, cols], g_habitat_c.node_map[rows, cols]))
+            self.assertTrue(abs(G - g_habitat_c.get_laplacian()).max() < 1e-12)
+
+    def test_single_ground_all_pairs_resistances_parallel_1(self):
+        test_sg(self, 'sgVerify4', {'parallelize': True, 'max_parallel': 2})
+
+    def test_single_ground_all_pairs_resistances_parallel_2(self):
+        test_sg(self, 'sgVerify12', {'parallelize': True, 'max_parallel': 2, 'reuse_amg_hierarchy': True, 'solver_batch_size': 3})
+
+    def test_single_ground_all_pairs_resistances_parallel_3(self):
+        # focal regions, with cumulative current maps accumulated from the pair jobs
+        test_sg(self, 'sgVerify3', {'parallelize': True, 'max_parallel': 2})
+
+    def test_single_ground_all_pairs_resistances_parallel_4(self):
+        # one solver pool is forked for the component, and serves all its anchor nodes
+        num_pools = [0]
+        class CountedSolverPool(SolverPool):
+            def __init__(self, *args):
+                num_pools[0] += 1
+                SolverPool.__init__(self, *args)
+        cs_state.SolverPool = CountedSolverPool
+        try:
+            test_sg(self, 'sgVerify4', {'parallelize': True, 'max_parallel': 2})
+        finally:
+            cs_state.SolverPool = SolverPool
+        self.assertEquals(num_pools[0], 1)
+
+    def test_single_ground_all_pairs_resistances_parallel_5(self):
+        # components solved as parallel jobs add their currents into the maps of the run
+        inputs = {'habitat_file': os.path.join(TESTS_ROOT, 'verify', '4', 'cellmap5x5.asc'),
+                  'point_file': os.path.join(TESTS_ROOT, 'verify', '4', 'points5x5.txt'),
+                  'output_file': os.path.join(TESTS_OUT, 'sgParallelComponents.out'),
+                  'write_max_cur_maps': True}
+        results = []
+        for options in [inputs, dict(inputs, parallelize=True, max_parallel=2)]:
+            (resistances, _solver_failed) = load_config('sgVerify4', options).compute()
+            maps = [cscape.CSIO._ascii_grid_reader(os.path.join(TESTS_OUT, 'sgParallelComponents_' + name), 'float64') for name in ['cum_curmap.asc', 'curmap_max.asc']]
+            results.append([resistances] + maps)
+        for (serial, parallel) in zip(results[0], results[1]):
+            self.assertTrue(approxEqual(serial, parallel))
+        self.assertTrue(results[0][1].max() > 0)
+
+    def test_solver_pool(self):
+        load_config('sgVerify1') # sets up logging
+        results = solver_pool_results(SolverPool(2, solve_or_die, (2.0,), 4, 2), [[0, 1], [3]])
+        self.assertTrue(np.array_equal(results[0][1], 2*np.arange(0, 4.0) + 1))
+        self.assertTrue(np.array_equal(results[1][0], 2*np.arange(0, 4.0) + 3))
+        
+        # only rows are passed back
+        results = solver_pool_results(SolverPool(2, solve_or_die, (2.0,), 4, 2, np.array([1, 3])), [[0, 1]])
+        self.assertTrue(np.array_equal(results[0][1][[1, 3]], [3.0, 7.0]))
+
+    def test_solver_pool_worker_died(self):
+        # the task of a killed worker fails, instead of leaving the run waiting for it
+        load_config('sgVerify1') # sets up logging
+        results = solver_pool_results(SolverPool(2, solve_or_die, (2.0,), 4, 2), [[0, 1], [-1, 2], [3]])
+        self.assertEquals(results[1], [None, None])
+        self.assertTrue(np.array_equal(results[0][0], 2*np.arange(0, 4.0)))
+        self.assertTrue(np.array_equal(results[2][0], 2*np.arange(0, 4.0) + 3))
+
+    def test_single_ground_all_pairs_resistances_parallel_amg_autotune(self):
+        # presets are timed once before jobs are forked, rather than in every job
+        for (run_test, test_name) in [(test_sg, 'sgVerify6'), (test_sg, 'sgVerify5'), (test_one_to_all, 'oneToAllVerify3')]:
+            run_test(self, test_name, {'amg_autotune': True, 'write_solver_report': True, 'parallelize': True, 'max_parallel': 2})
+            report = np.genfromtxt(os.path.join(TESTS_OUT, test_name + '_solver_report.csv'), delimiter=',', names=True, dtype=None)
+            self.assertEquals(np.sum((report['label'] == 'autotune preset 0') & (report['num_rhs'] == 0)), 1)
+
+    def test_single_ground_all_pairs_resistances_distributed(self):
+        # a coordinator and a worker share the focal nodes; the claim left by a crashed process is taken over
+        run_dir = os.path.join(TESTS_OUT, 'distributed')
+        shutil.rmtree(run_dir, True)
+        os.makedirs(os.path.join(run_dir, 'claims'))
+        stale_claim = os.path.join(run_dir, 'claims', '0.claim')
+        open(stale_claim, 'w').close()
+        os.utime(stale_claim, (time.time() - 60, time.time() - 60))
+        try:
+            options = {'distributed_dir': run_dir, 'distributed_timeout': 2}
+            worker = multiprocessing.Process(target=run_distributed_worker, args=('sgVerify14', dict(options, distributed_role='worker')))
+            worker.start()
+            test_sg(self, 'sgVerify14', options)
+            worker.join()
+            self.assertEquals(worker.exitcode, 0)
+            
+            # results and maps are written per batch of tasks solved by a process, rather than per task
+            with open(os.path.join(run_dir, 'manifest.pkl'), 'rb') as f:
+                num_tasks = pickle.load(f)['num_tasks']
+            num_batches = len([name for name in os.listdir(os.path.join(run_dir, 'results')) if name.endswith('.tasks')])
+            self.assertTrue(0 < num_batches < num_tasks)
+        finally:
+            shutil.rmtree(run_dir, True)
+
+    def test_single_ground_all_pairs_resistances_resumed_1(self):
+        test_resumed(self, test_sg, 'sgVerify4')
+
+    def test_single_ground_all_pairs_resistances_resumed_2(self):
+        # focal regions
+        test_resumed(self, test_sg, 'sgVerify5')
+
+    def test_single_ground_all_pairs_resistances_resumed_3(self):
+        # with the resistance shortcut, a component is checkpointed after each solve rather than once done
+        done = test_resumed(self, test_sg, 'sgVerify12')
+        self.assertEquals(len(done), 1)
+        self.assertEquals(len(list(done)[0]), 3)
+
+    def test_single_ground_all_pairs_resistances_cholesky(self):
+        # One sparse factorization per component, shared by all batched focal pairs
+        test_sg(self, 'sgVerify1', {'solver': 'cholesky', 'solver_batch_size': 4})
          
          
     def test_multiple_ground_module_1(self):
@@ -224,6 +632,46 @@ class cs_verify(unittest.TestCase):
  
     def test_multiple_ground_module_5(self):
         test_mg(self, 'mgVerify5')         
+
+    def test_multiple_ground_module_amg_options(self):
+        test_mg(self, 'mgVerify3', {'solver': 'amg', 'amg_aggregate': 'lloyd', 'amg_cycle': 'F'})
+
+    def test_multiple_ground_module_parallel(self):
+        # components are set up and solved as separate jobs, so sources and grounds are resolved only there
+        num_resolved = [0]
+        resolve_conflicts = cscape.Compute.resolve_conflicts
+        def counted_resolve_conflicts(compute, sources, grounds):
+            num_resolved[0] += 1
+            return resolve_conflicts(compute, sources, grounds)
+        cscape.Compute.resolve_conflicts = counted_resolve_conflicts
+        try:
+            test_mg(self, 'mgVerify2', {'parallelize': True, 'max_parallel': 2})
+        finally:
+            cscape.Compute.resolve_conflicts = resolve_conflicts
+        self.assertEquals(num_resolved[0], 0)
+
+    def test_multiple_ground_module_batch(self):
+        # scenarios sharing grounds are solved together, and each gets its own maps
+        cs = load_config('mgVerify2')
+        scenario_file = os.path.join(TESTS_OUT, 'mgVerify2_scenarios.txt')
+        with open(scenario_file, 'w') as f:
+            for name in ['a', 'b']:
+                f.write(name + ' ' + os.path.abspath(cs.options.source_file) + ' ' + os.path.abspath(cs.options.ground_file) + '\n')
+        
+        for options in [{'solver_batch_size': 2}, {'solver_batch_size': 1, 'parallelize': True, 'max_parallel': 2}]:
+            options['scenario_file'] = scenario_file
+            cs = load_config('mgVerify2', options)
+            (names, solver_failed) = cs.compute()
+            self.assertEquals(names, ['a', 'b'])
+            self.assertFalse(solver_failed)
+            for name in names:
+                for result_file in ['curmap', 'voltmap']:
+                    computed = cscape.CSIO._ascii_grid_reader(os.path.join(TESTS_OUT, 'mgVerify2_' + result_file + '_' + name + '.asc'), 'float64')
+                    saved = cscape.CSIO._ascii_grid_reader(os.path.join(TESTS_BASELINE, 'mgVerify2_' + result_file + '.asc'), 'float64')
+                    self.assertEquals(approxEqual(saved, computed), True)
+
+    def test_multiple_ground_module_cholesky(self):
+        test_mg(self, 'mgVerify3', {'solver': 'cholesky'})
    
     def test_one_to_all_module_1(self):
         test_one_to_all(self, 'oneToAllVerify1') 
@@ -259,8 +707,51 @@ class cs_verify(unittest.TestCase):
         test_one_to_all(self, 'oneToAllVerify11') 
  
     def test_one_to_all_module_12(self):
-        test_one_to_all(self, 'oneToAllVerify12') 
+        # the baseline was computed by a release that shorted the source together with the last polygon
+        test_one_to_all(self, 'oneToAllVerify12', {'join_source_with_last_polygon': True}) 
+
+    def test_one_to_all_module_included_pairs_all(self):
+        # including every pair shorts each source with its own region only, as does a run without an include list
+        cs = load_config('oneToAllVerify12', {'use_included_pairs': False})
+        (resistances, _solver_failed) = cs.compute()
+        
+        point_ids = resistances[:,0].astype(int)
+        pairs_file = os.path.join(TESTS_OUT, 'oneToAllVerify12_all_pairs.txt')
+        with open(pairs_file, 'w') as f:
+            f.write('mode\tinclude\n')
+            for (idx, pt1) in enumerate(point_ids):
+                for pt2 in point_ids[idx+1:]:
+                    f.write(str(pt1) + '\t' + str(pt2) + '\n')
+        
+        cs = load_config('oneToAllVerify12', {'included_pairs_file': pairs_file})
+        (resistances_included, _solver_failed) = cs.compute()
+        self.assertEquals(approxEqual(resistances, resistances_included), True)
+
+    def test_one_to_all_module_13(self):
+        # included pairs without a polygon map, contracted into a graph built once
+        test_one_to_all(self, 'oneToAllVerify13')
+
+    def test_one_to_all_module_cholesky(self):
+        # Focal points in several components, some of which have no grounds
+        test_one_to_all(self, 'oneToAllVerify1', {'solver': 'cholesky'})
          
+    def test_one_to_all_module_resumed(self):
+        test_resumed(self, test_one_to_all, 'oneToAllVerify1')
+
+    def test_one_to_all_module_parallel_1(self):
+        test_one_to_all(self, 'oneToAllVerify1', {'parallelize': True, 'max_parallel': 2})
+
+    def test_one_to_all_module_parallel_2(self):
+        test_one_to_all(self, 'oneToAllVerify12', {'parallelize': True, 'max_parallel': 2, 'join_source_with_last_polygon': True})
+
+    def test_one_to_all_module_parallel_max_cur_map(self):
+        # maximum current maps accumulated from parallel solves match those of serial solves
+        max_maps = []
+        for parallelize in [False, True]:
+            test_one_to_all(self, 'oneToAllVerify1', {'parallelize': parallelize, 'max_parallel': 2, 'write_max_cur_maps': True})
+            max_maps.append(cscape.CSIO._ascii_grid_reader(os.path.join(TESTS_OUT, 'oneToAllVerify1_curmap_max.asc'), 'float64'))
+        self.assertEquals(approxEqual(max_maps[0], max_maps[1]), True)
+
     def test_all_to_one_module_1(self):
         test_all_to_one(self, 'allToOneVerify1') 
    
@@ -295,5 +786,27 @@ class cs_verify(unittest.TestCase):
         test_all_to_one(self, 'allToOneVerify11')   
          
     def test_all_to_one_module_12(self):
-        test_all_to_one(self, 'allToOneVerify12')           
+        # the baseline was computed by a release that shorted the source together with the last polygon
+        test_all_to_one(self, 'allToOneVerify12', {'join_source_with_last_polygon': True})           
+
+    def test_all_to_one_module_13(self):
+        # included pairs without a polygon map, contracted into a graph built once
+        test_all_to_one(self, 'allToOneVerify13')
+
+    def test_all_to_one_module_parallel(self):
+        test_all_to_one(self, 'allToOneVerify12', {'parallelize': True, 'max_parallel': 2, 'join_source_with_last_polygon': True})
          
+
+    def test_low_memory_retry_after_exception(self):
+        # a run left by an exception must not make the next run skip its solves
+        def _run(fail):
+            solved = []
+            while LowMemRetry.retry():
+                with LowMemRetry():
+                    if fail:
+                        raise RuntimeError()
+                    solved.append(True)
+            return solved
+        self.assertRaises(RuntimeError, _run, True)
+        self.assertEquals(_run(False), [True])
+        self.assertEquals(_run(False), [True])